@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+"""
+An array backed store for ASTs, for very large programs.
+
+Instead of one Tree object per node, an ASTArena keeps each field of every
+node in its own array, indexed by the node's id. The ids of each node's
+children are kept in a run of one shared pool array, so a child can be
+found by its position straight away. Values and types are interned in
+tables, so the arrays themselves only hold small integers.
+
+The compiler's passes see arena nodes through NodeViews, which behave just
+like Trees (a view's children act like a list, and changing them changes
+the arena), but are only made as the passes touch nodes.
+"""
+
+from array import array
+
+from tree import BaseTree
+
+NONE = -1
+
+class ASTArena(object):
+    """Holds every node of an AST in parallel arrays."""
+    
+    def __init__(self):
+        self.node_types = array('b')
+        self.values = array('i')
+        self.lines = array('i')
+        self.parents = array('i')
+        
+        # node nid's child_counts[nid] children start at child_starts[nid]
+        # in child_pool, with room for child_spaces[nid] before they move
+        self.child_starts = array('i')
+        self.child_counts = array('i')
+        self.child_spaces = array('i')
+        self.child_pool = array('i')
+        self.ice9_types = array('i')
+        self.loopcounts = array('i')
+        
+        # only the scope nodes have vars
+        self.vars = {}
+        
+        # interned node types, values and ice9 types
+        self.type_names = []
+        self.constants = []
+        self._interned = {}
+    
+    def __len__(self):
+        return len(self.node_types)
+    
+    def intern_type_name(self, node_type):
+        try:
+            return self._interned[('node_type', node_type)]
+        except KeyError:
+            self.type_names.append(node_type)
+            code = len(self.type_names) - 1
+            self._interned[('node_type', node_type)] = code
+            return code
+    
+    def intern(self, value):
+        """Returns the index of value in the constants table."""
+        if value is None:
+            return NONE
+        
+        try:
+            # True == 1, so the type is part of the key
+            key = (type(value), value)
+            hash(key)
+        except TypeError:
+            # array types are lists. Equal ones are usually the same list.
+            key = ('id', id(value))
+        
+        try:
+            return self._interned[key]
+        except KeyError:
+            self.constants.append(value)
+            index = len(self.constants) - 1
+            self._interned[key] = index
+            return index
+    
+    def constant(self, index):
+        if index == NONE:
+            return None
+        return self.constants[index]
+    
+    def new_node(self, node_type, value=None, line=None, children=(),
+                 ice9_type=None):
+        """Adds a node, adopting children (a list of views), and views it."""
+        nid = len(self.node_types)
+        self.node_types.append(self.intern_type_name(node_type))
+        self.values.append(self.intern(value))
+        self.lines.append(line is None and NONE or line)
+        self.parents.append(NONE)
+        self.child_starts.append(0)
+        self.child_counts.append(0)
+        self.child_spaces.append(0)
+        self.ice9_types.append(self.intern(ice9_type))
+        self.loopcounts.append(NONE)
+        
+        ids = [c.id for c in children]
+        self.link_children(nid, ids)
+        for c in ids:
+            self.parents[c] = nid
+        return NodeView(self, nid)
+    
+    def child_ids(self, nid):
+        start = self.child_starts[nid]
+        return self.child_pool[start:start + self.child_counts[nid]].tolist()
+    
+    def link_children(self, nid, ids):
+        """
+        Makes ids the children of nid. Like assigning a Tree's children,
+        this doesn't change the children's parents.
+        """
+        count = len(ids)
+        if count > self.child_spaces[nid]:
+            # move the run to the end of the pool. The old one is left
+            # unused; growing runs double, so appending one child at a
+            # time doesn't keep moving them.
+            space = max(count, 2 * self.child_spaces[nid])
+            self.child_starts[nid] = len(self.child_pool)
+            self.child_spaces[nid] = space
+            self.child_pool.extend(array('i', [NONE]) * space)
+        start = self.child_starts[nid]
+        self.child_pool[start:start + count] = array('i', ids)
+        self.child_counts[nid] = count
+    
+    def view(self, nid):
+        if nid == NONE:
+            return None
+        return NodeView(self, nid)
+
+def _field(array_name, to_python, from_python):
+    """A property storing a node field in one of the arena's arrays."""
+    def get(self):
+        n = getattr(self.arena, array_name)[self.id]
+        if n == NONE:
+            return None
+        return to_python(self.arena, n)
+    def set(self, value):
+        if value is None:
+            n = NONE
+        else:
+            n = from_python(self.arena, value)
+        getattr(self.arena, array_name)[self.id] = n
+    return property(get, set)
+
+def _int(arena, n):
+    return n
+
+class NodeView(BaseTree):
+    """A node in an ASTArena, which can be used just like a Tree."""
+    __slots__ = ('arena', 'id')
+    
+    def __init__(self, arena, nid):
+        self.arena = arena
+        self.id = nid
+    
+    def __eq__(self, other):
+        return (isinstance(other, NodeView) and other.arena is self.arena and
+                other.id == self.id)
+    
+    def __ne__(self, other):
+        return not self == other
+    
+    def __hash__(self):
+        return self.id
+    
+    node_type = _field('node_types',
+                       lambda arena, code: arena.type_names[code],
+                       ASTArena.intern_type_name)
+    value = _field('values', lambda arena, i: arena.constants[i],
+                   ASTArena.intern)
+    ice9_type = _field('ice9_types', lambda arena, i: arena.constants[i],
+                       ASTArena.intern)
+    line = _field('lines', _int, _int)
+    loopcount = _field('loopcounts', _int, _int)
+    parent = _field('parents', lambda arena, nid: NodeView(arena, nid),
+                    lambda arena, view: view.id)
+    
+    def get_vars(self):
+        return self.arena.vars.get(self.id)
+    def set_vars(self, value):
+        self.arena.vars[self.id] = value
+    vars = property(get_vars, set_vars)
+    
+    def get_children(self):
+        return ChildList(self.arena, self.id)
+    def set_children(self, children):
+        self.arena.link_children(self.id, [c.id for c in children])
+    children = property(get_children, set_children)
+    
+    def add_child(self, node_type=None, value=None, line=None,
+                  ice9_type=None):
+        child = self.arena.new_node(node_type, value, line,
+                                    ice9_type=ice9_type)
+        child.parent = self
+        self.children.append(child)
+        return child
+
+class ChildList(object):
+    """
+    The children of a node in an ASTArena, as a list. Changes to it are
+    made to the arena.
+    
+    Its length, indexing, appending and popping from either end take the
+    same time however many children there are. Other changes rewrite the
+    node's run of ids, as they'd shift a list's items.
+    """
+    __slots__ = ('arena', 'id')
+    
+    def __init__(self, arena, nid):
+        self.arena = arena
+        self.id = nid
+    
+    def _views(self, ids):
+        return [NodeView(self.arena, c) for c in ids]
+    
+    def _change(self, change):
+        """Applies change to a list of the children's ids."""
+        ids = self.arena.child_ids(self.id)
+        retval = change(ids)
+        self.arena.link_children(self.id, ids)
+        return retval
+    
+    def _position(self, index):
+        """Returns where child number index is in the arena's pool."""
+        count = self.arena.child_counts[self.id]
+        if index < 0:
+            index += count
+        if not 0 <= index < count:
+            raise IndexError('list index out of range')
+        return self.arena.child_starts[self.id] + index
+    
+    def __len__(self):
+        return self.arena.child_counts[self.id]
+    
+    def __iter__(self):
+        return iter(self._views(self.arena.child_ids(self.id)))
+    
+    def __reversed__(self):
+        return reversed(self._views(self.arena.child_ids(self.id)))
+    
+    def __contains__(self, view):
+        return view.id in self.arena.child_ids(self.id)
+    
+    def __getitem__(self, index):
+        if type(index) is slice:
+            return self._views(self.arena.child_ids(self.id)[index])
+        return NodeView(self.arena,
+                        self.arena.child_pool[self._position(index)])
+    
+    def __setitem__(self, index, value):
+        if type(index) is not slice:
+            self.arena.child_pool[self._position(index)] = value.id
+            return
+        
+        def change(ids):
+            ids[index] = [v.id for v in value]
+        self._change(change)
+    
+    def __delitem__(self, index):
+        def change(ids):
+            del ids[index]
+        self._change(change)
+    
+    def __add__(self, other):
+        return list(self) + list(other)
+    
+    def __radd__(self, other):
+        return list(other) + list(self)
+    
+    def __iadd__(self, other):
+        self.extend(other)
+        return self
+    
+    def index(self, view):
+        return self.arena.child_ids(self.id).index(view.id)
+    
+    def append(self, view):
+        arena = self.arena
+        count = arena.child_counts[self.id]
+        if count < arena.child_spaces[self.id]:
+            arena.child_pool[arena.child_starts[self.id] + count] = view.id
+            arena.child_counts[self.id] = count + 1
+        else:
+            self._change(lambda ids: ids.append(view.id))
+    
+    def extend(self, views):
+        new_ids = [v.id for v in views]
+        self._change(lambda ids: ids.extend(new_ids))
+    
+    def insert(self, index, view):
+        self._change(lambda ids: ids.insert(index, view.id))
+    
+    def pop(self, index=-1):
+        arena = self.arena
+        count = arena.child_counts[self.id]
+        if not count:
+            raise IndexError('pop from empty list')
+        if index not in (0, -1, count - 1):
+            return NodeView(arena, self._change(lambda ids: ids.pop(index)))
+        
+        child = arena.child_pool[self._position(index)]
+        if index == 0:
+            # the run now starts one further on
+            arena.child_starts[self.id] += 1
+            arena.child_spaces[self.id] -= 1
+        arena.child_counts[self.id] = count - 1
+        return NodeView(arena, child)
+    
+    def remove(self, view):
+        self._change(lambda ids: ids.remove(view.id))
+    
+    def reverse(self):
+        self._change(lambda ids: ids.reverse())
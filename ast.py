@@ -4,7 +4,7 @@
 Used for converting a parse tree into an AST.
 """
 
-from tree import Tree
+from parser import GRAMMAR_NAMES
 
 # global dictionary of transformation rules
 transform_rules = dict()
@@ -52,31 +52,11 @@ def root(n):
 def stm(n):
     pass
 
-@transformation_rule
-@collapsable
-def med(n):
-    pass
-
-@transformation_rule
-@collapsable
-def high(n):
-    pass
-
 @transformation_rule
 @collapsable
 def end(n):
     pass
 
-@transformation_rule
-@collapsable
-def low(n):
-    pass
-
-@transformation_rule
-@collapsable
-def expr(n):
-    pass
-
 @transformation_rule
 def stms(n):
     n.node_type = 'statements'
@@ -90,9 +70,6 @@ def program(n):
 
 # Now for the more complicated rules
 
-UNARY_OPS = list('?-')
-BINARY_OPS = list('=+-*/%<>') + ['<=', '>=', '!=']
-
 # let's go ahead and handle these transformations now
 
 # arrays
@@ -121,6 +98,8 @@ def value_or_assignment(va_node):
         
         va_node.parent.children.remove(va_node)
         va_node.parent.children += va_node.children
+        for c in va_node.children:
+            c.parent = va_node.parent
         va_node.parent.node_type = 'assignment'
         va_node.parent.value = ':='
 
@@ -214,21 +193,20 @@ def proc_call(proc_call_node):
     p.node_type = 'proc_call'
     p.value = p.children[0].value
     p.children = proc_call_node.children
+    for c in p.children:
+        c.parent = p
 
 @transformation_rule
 def type_id(t_node):
     t_node.node_type = 'type'
     t_node.value = t_node.children.pop(0).value
     siblings = t_node.parent.children
-    myindex = siblings.index(t_node)
-    for right_sibling in list(siblings[myindex+1:]):
-        if (right_sibling.node_type == 'literal' and 
-            right_sibling.ice9_type == 'int'):
-                t_node.children.insert(0, right_sibling)
-                right_sibling.parent = t_node
-                siblings.remove(right_sibling)
-        else:
-            break
+    right = t_node.child_index() + 1
+    while (right < len(siblings) and siblings[right].node_type == 'literal'
+           and siblings[right].ice9_type == 'int'):
+        right_sibling = siblings.pop(right)
+        t_node.children.insert(0, right_sibling)
+        right_sibling.parent = t_node
 
 @transformation_rule
 def ice9_type(type_node):
@@ -255,11 +233,11 @@ def var(var_node):
         assert id_list.value == 'id_list'
         for def_id in id_list.children:
             assert def_id.node_type == 'ident'
-            var_node.add_child(node_type = 'define',
-                               value = def_id.value,
-                               children = type_info[:],
-                               line = def_id.line
-                               )
+            define = var_node.add_child(node_type = 'define',
+                                        value = def_id.value,
+                                        line = def_id.line
+                                        )
+            define.children = type_info[:]
     
     var_node.remove_and_promote()
     
@@ -304,97 +282,96 @@ def proc_end(pe_node):
 
 # Handles the driving logic of changing a parse tree into an AST
 
+# tokens which become their parent operator
+OPERATOR_KEYWORDS = ('write', 'writes', 'break', 'exit', 'return', 'read')
+
+# rule expansions which are kept even when they're empty
+KEPT_WHEN_EMPTY = ('proc_call', 'program', 'stms')
+
+def punctuation(node):
+    # go ahead and filter unncessary punctuation tokens
+    node.kill()
+
+def str_literal(node):
+    node.node_type = 'literal'
+    node.ice9_type = 'str'
+    node.value = node.value[1:-1] # remove the quotes
+
+def int_literal(node):
+    node.node_type = 'literal'
+    node.ice9_type = 'int'
+    node.value = int(node.value)
+
+def bool_literal(node):
+    node.node_type = 'literal'
+    node.ice9_type = 'bool'
+    node.value = node.value == 'true'
+
+def ident(node):
+    node.node_type = 'ident'
+
+def keyword(node):
+    if node.value in OPERATOR_KEYWORDS:
+        node.parent.node_type = 'operator'
+        node.parent.value = node.value
+        assert node.parent.children.pop(0) == node
+
+def prunable(rule):
+    """
+    Kills empty rule expansions, and runs rule (if there is one) on the rest.
+    """
+    def _pruned_rule(node):
+        if len(node.children) == 0:
+            # Empty node, let's just kill it and go onto the next
+            node.kill()
+        elif rule is not None:
+            rule(node)
+    return _pruned_rule
+
+# What parse2ast does with each kind of node. Tokens are looked up by their
+# token type, and everything else by its value.
+dispatch = {
+    ('token', 'SOF'): punctuation,
+    ('token', 'EOF'): punctuation,
+    ('token', 'punc'): punctuation,
+    ('token', 'str'): str_literal,
+    ('token', 'int'): int_literal,
+    ('token', 'bool'): bool_literal,
+    ('token', 'ident'): ident,
+    ('token', 'keyword'): keyword,
+}
+
+for rule_name in GRAMMAR_NAMES.keys() + ['root']:
+    if rule_name in KEPT_WHEN_EMPTY:
+        if rule_name in transform_rules:
+            dispatch['rule-expansion', rule_name] = transform_rules[rule_name]
+    else:
+        dispatch['rule-expansion', rule_name] = prunable(
+                                                transform_rules.get(rule_name))
+
 def parse2ast(parse_tree):
     """
     Converts a parse tree into an AST.
     """
-    for node in list(parse_tree.postfix_iter()):
-        if node.node_type == 'token':
-            if node.token_type in ('SOF', 'EOF', 'punc'):
-                # go ahead and filter unncessary punctuation tokens
-                node.kill()
-            
-            elif node.token_type in ('str', 'int', 'bool'):
-                # it's a literal
-                node.node_type = 'literal'
-                setattr(node, 'ice9_type', node.token_type)
-                
-                if node.ice9_type == 'str':
-                    node.value = node.value[1:-1] # remove the quotes                
-                elif node.ice9_type == 'int':
-                    node.value = int(node.value) 
-                elif node.ice9_type == 'bool':
-                    if node.value == 'true':
-                        node.value = True
-                    elif node.value == 'false':
-                        node.value = False
-            
-            elif node.token_type == 'ident':
-                node.node_type = 'ident'
-            
-            elif node.value in ('write', 'writes', 'break', 'exit', 'return', 'read'):
-                node.parent.node_type = 'operator'
-                node.parent.value = node.value
-                assert node.parent.children.pop(0) == node
-                
-        elif node.node_type == 'rule-expansion':
-            if (len(node.children) == 0 and node.value != 'proc_call' and 
-                node.value != 'program' and node.value != 'stms'):
-                # Empty node, let's just kill it and go onto the next
-                node.kill()
-                continue
-            elif len(node.children) >= 2:
-                if (node.children[0].node_type == 'token' and
-                      node.children[0].value in UNARY_OPS and
-                      node.value == 'high'):
-                        #  node.parent         node.parent
-                        #     |                |
-                        #    node       =>     op
-                        #    /  \              |
-                        #  op   right          right
-                        p = node.parent
-                        op = node.children[0].value
-                        node.node_type = 'operator'
-                        node.value = op
-                        node.line = node.children[0].line
-                        node.children.pop(0)
-                        continue
-                elif (node.children[0].node_type == 'token' and 
-                    node.children[0].value in BINARY_OPS and
-                    node.parent.node_type == 'rule-expansion'):
-                        if (node.parent.value != node.value):
-                            # end of the chain
-                            # node.parent
-                            #   /   \
-                            #  a   (  node  )
-                            #     /  /  |  \  \
-                            #    op1 b op2  c  ...
-                            p = node.parent
-                            index = p.children.index(node)
-                            a = p.children.pop(index - 1)
-                            
-                            # node contains an expression a OP b OP c ...
-                            # where OP are all of the same precedence. We
-                            # need to turn it into a left oriented tree.
-                            
-                            leftnode = a
-                            children = node.children
-                            while len(children) > 0:
-                                op = children.pop(0)
-                                operand = children.pop(0)
-                                newleft = Tree(value=op.value, node_type='operator', line=op.line)
-                                newleft.children = [leftnode, operand]
-                                leftnode.parent = newleft
-                                operand.parent = leftnode
-                                leftnode = newleft
-                            
-                            leftnode.parent = node
-                            node.children = [leftnode]
-                        
-                        node.remove_and_promote()
-                        continue
-            
-            if node.value in transform_rules:
-                transform_rules[node.value](node)
-            
+    # Transforms the tree bottom up in a single walk, children right to left
+    # like postfix_iter. A node goes on the stack, then a None to mark that
+    # it's next once everything above the None is done, then its children.
+    # So each node's children are copied as the walk reaches it, which
+    # matters: transformations move nodes around, and a node moved into an
+    # already transformed node (by adopt_left_sibling) still needs its turn.
+    stack = [parse_tree]
+    pop, push, push_all = stack.pop, stack.append, stack.extend
+    rule_for = dispatch.get
+    while stack:
+        node = pop()
+        if node is None:
+            node = pop()
+            rule = rule_for((node.node_type, node.token_type or node.value))
+            if rule is not None:
+                rule(node)
+        else:
+            push(node)
+            push(None)
+            push_all(node.children)
+    
     return parse_tree
\ No newline at end of file
@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+
+"""
+A front end which builds the AST directly while parsing, skipping the
+concrete parse tree and parse2ast entirely.
+
+It follows grammar.txt exactly like parser.py does (including where
+syntax errors get reported), but each rule returns the finished AST node
+rather than a rule-expansion. The result is the same tree parse2ast
+would have produced.
+"""
+
+from types import GeneratorType
+
+from lexer import lex_tokens
+from parser import Ice9SyntaxError, BINARY_PRECEDENCE, COMPARISON_PRECEDENCE
+from parser import UNARY_OPS
+from tree import Tree
+
+class ASTStream:
+    """Walks over the tokens, handing them to the rules."""
+    line = 1
+    position = 0
+    stream = None
+    
+    def __init__(self, tokens, arena=None):
+        self.arena = arena
+        if type(tokens) not in (list, tuple):
+            tokens = list(tokens)
+        self.stream = tokens
+        self.length = len(tokens)
+        # remove the SOF token
+        self.next_type_is('SOF')
+    
+    def current_word(self):
+        if self.position < self.length:
+            return self.stream[self.position]
+        return None
+    
+    def next(self):
+        self.position += 1
+        if self.position < self.length:
+            self.line = self.stream[self.position][2]
+    
+    def is_next(self, expected):
+        """
+        Returns the current token and moves forward if its value is
+        expected. Otherwise returns None.
+        """
+        token = self.stream[self.position]
+        if token[1] == expected:
+            self.next()
+            return token
+        return None
+    
+    def next_is(self, expected):
+        """Like is_next, but raises a syntax error if it isn't found."""
+        token = self.is_next(expected)
+        if token is None:
+            raise Ice9SyntaxError(self)
+        return token
+    
+    def is_next_type(self, expected_type):
+        """Returns the current token and moves forward if it's expected_type."""
+        token = self.stream[self.position]
+        if token[0] == expected_type:
+            self.next()
+            return token
+        return None
+    
+    def next_type_is(self, expected_type):
+        """Like is_next_type, but raises a syntax error if it isn't found."""
+        token = self.is_next_type(expected_type)
+        if token is None:
+            raise Ice9SyntaxError(self)
+        return token
+    
+    def node(self, node_type, value, line, children=(), ice9_type=None):
+        """
+        Makes a new AST node, adopting children. It's a Tree, or a node in
+        the arena if we're building one.
+        """
+        if self.arena is not None:
+            return self.arena.new_node(node_type, value, line, children,
+                                       ice9_type)
+        
+        n = Tree(node_type=node_type, value=value, line=line,
+                 ice9_type=ice9_type)
+        n.children = list(children)
+        for c in n.children:
+            c.parent = n
+        return n
+
+
+def mandatory(result, stream):
+    """Raises a syntax error if a rule which must match didn't."""
+    if result is None:
+        raise Ice9SyntaxError(stream)
+    return result
+
+# The rules are generators, so that nesting in the program doesn't nest on
+# the Python stack. A rule calls another with
+#
+#     result = yield other_rule(stream)
+#
+# and hands back its own result by yielding anything other than a
+# generator; it is never resumed after that. run() keeps the stack of rules
+# which are waiting on a result.
+
+def run(rule):
+    """Runs a rule (and every rule it calls) to completion."""
+    stack = [rule]
+    value = None
+    while True:
+        result = stack[-1].send(value)
+        if type(result) is GeneratorType:
+            stack.append(result)
+            value = None
+        else:
+            stack.pop()
+            if not stack:
+                return result
+            value = result
+
+# declarations ---------------------------------------------------------------
+
+def program(stream):
+    line = stream.line
+    decls = []
+    while True:
+        if stream.is_next('var'):
+            decls += var_list(stream)
+        elif stream.current_word()[1] == 'type':
+            decls.append(define_type(stream))
+        elif stream.current_word()[1] == 'forward':
+            decls.append(forward(stream))
+        elif stream.current_word()[1] == 'proc':
+            decls.append((yield proc(stream)))
+        else:
+            break
+    
+    decls.append((yield stms(stream)))
+    yield stream.node('program', '', line, decls)
+
+def id_list(stream):
+    """Returns the ident tokens in an id list, or None."""
+    first = stream.is_next_type('ident')
+    if first is None:
+        return None
+    
+    idents = [first]
+    while stream.is_next(','):
+        idents.append(stream.next_type_is('ident'))
+    return idents
+
+def type_id(stream, dimensions=False):
+    """
+    Reads a type name, and optionally any array dimensions after it. The
+    dimensions are stored innermost first, like parse2ast does.
+    """
+    name = stream.next_type_is('ident')
+    sizes = []
+    if dimensions:
+        while stream.is_next('['):
+            sizes.insert(0, literal(stream, stream.next_type_is('int')))
+            stream.next_is(']')
+    return stream.node('type', name[1], name[2], sizes)
+
+def var_list(stream):
+    """
+    Reads the var lists following a 'var', and returns their define nodes.
+    Later lists come out first, which is the order parse2ast leaves them in.
+    """
+    groups = []
+    while True:
+        idents = mandatory(id_list(stream), stream)
+        stream.next_is(':')
+        typenode = type_id(stream, True)
+        groups.insert(0, [stream.node('define', ident[1], ident[2],
+                                      [typenode]) for ident in idents])
+        if not stream.is_next(','):
+            break
+    
+    defines = []
+    for group in groups:
+        defines += group
+    return defines
+
+def define_type(stream):
+    stream.next_is('type')
+    name = stream.next_type_is('ident')
+    stream.next_is('=')
+    return stream.node('define_type', name[1], name[2],
+                       [type_id(stream, True)])
+
+def dec_list(stream, params):
+    """Reads a (possibly empty) declaration list into params."""
+    idents = id_list(stream)
+    if idents is not None:
+        stream.next_is(':')
+        name = stream.next_type_is('ident')
+        for ident in idents:
+            params.append(stream.node('param', ident[1], ident[2],
+                                      [stream.node('type', name[1], name[2])]))
+        
+        while stream.is_next(','):
+            dec_list(stream, params)
+    
+    return params
+
+def forward(stream):
+    stream.next_is('forward')
+    name = stream.next_type_is('ident')
+    stream.next_is('(')
+    params = dec_list(stream, [])
+    stream.next_is(')')
+    
+    if stream.is_next(':'):
+        params.insert(0, type_id(stream))
+    
+    return stream.node('forward', name[1], name[2], params)
+
+def proc(stream):
+    stream.next_is('proc')
+    name = stream.next_type_is('ident')
+    stream.next_is('(')
+    children = dec_list(stream, [])
+    stream.next_is(')')
+    
+    if stream.is_next(':'):
+        children.insert(0, type_id(stream))
+    
+    # the body
+    line = stream.line
+    body = []
+    while True:
+        if stream.is_next('var'):
+            body += var_list(stream)
+        elif stream.current_word()[1] == 'type':
+            body.append(define_type(stream))
+        else:
+            break
+    
+    while (yield stm(stream, body)):
+        pass
+    stream.next_is('end')
+    
+    children.append(stream.node('statements', '', line, body))
+    yield stream.node('proc', name[1], name[2], children)
+
+# statements -----------------------------------------------------------------
+
+def stms(stream):
+    line = stream.line
+    statements = []
+    if not (yield stm(stream, statements)):
+        raise Ice9SyntaxError(stream)
+    
+    while (yield stm(stream, statements)):
+        pass
+    
+    yield stream.node('statements', '', line, statements)
+
+def stm(stream, statements):
+    """
+    Reads a single statement, appending it to statements. Yields whether
+    it found one.
+    
+    Like the parse tree's stm rule, a do or fa with a bad expression after
+    its keyword just fails, and the remaining alternatives are tried from
+    wherever that left us. Those keywords still count towards the line of
+    the statement, just as they do there.
+    """
+    line = stream.line
+    word = stream.current_word()[1]
+    statement = None
+    
+    if word == 'if':
+        statement = yield cond(stream)
+    
+    if word == 'do':
+        statement = yield do_loop(stream)
+        word = stream.current_word()[1]
+    
+    if statement is None and word == 'fa':
+        statement = yield for_loop(stream)
+        word = stream.current_word()[1]
+    
+    if statement is not None:
+        pass
+    
+    elif word in ('break', 'exit', 'return'):
+        stream.next()
+        stream.next_is(';')
+        statement = stream.node('operator', word, line)
+    
+    elif word in ('write', 'writes'):
+        stream.next()
+        value = mandatory((yield expr(stream)), stream)
+        stream.next_is(';')
+        statement = stream.node('operator', word, line, [value])
+    
+    else:
+        statement = yield expr(stream)
+        if statement is None:
+            # the empty statement
+            yield stream.is_next(';') is not None
+        stream.next_is(';')
+    
+    statements.append(statement)
+    yield True
+
+def cond(stream):
+    token = stream.next_is('if')
+    children = []
+    
+    test = yield expr(stream)
+    while True:
+        if test is None:
+            raise Ice9SyntaxError(stream)
+        stream.next_is('->')
+        children += [test, (yield stms(stream))]
+        
+        if not stream.is_next('[]'):
+            stream.next_is('fi')
+            break
+        
+        if stream.is_next('else'):
+            stream.next_is('->')
+            children.append((yield stms(stream)))
+            stream.next_is('fi')
+            break
+        
+        test = yield expr(stream)
+    
+    yield stream.node('cond', '', token[2], children)
+
+def do_loop(stream):
+    token = stream.next_is('do')
+    test = yield expr(stream)
+    if test is None:
+        yield None
+    stream.next_is('->')
+    body = yield stms(stream)
+    stream.next_is('od')
+    yield stream.node('do_loop', '', token[2], [test, body])
+
+def for_loop(stream):
+    token = stream.next_is('fa')
+    var = stream.next_type_is('ident')
+    stream.next_is(':=')
+    lower = yield expr(stream)
+    if lower is None:
+        yield None
+    stream.next_is('to')
+    upper = yield expr(stream)
+    if upper is None:
+        yield None
+    stream.next_is('->')
+    body = yield stms(stream)
+    stream.next_is('af')
+    yield stream.node('for_loop', '', token[2],
+                      [stream.node('ident', var[1], var[2]), lower, upper,
+                       body])
+
+# expressions ----------------------------------------------------------------
+
+def expr(stream):
+    """Yields the AST of an expression, or None if there isn't one here."""
+    tree = yield climb(stream, COMPARISON_PRECEDENCE)
+    yield tree
+
+def climb(stream, min_precedence):
+    """
+    Precedence climbing, just like parser.climb: reads an expression whose
+    binary operators all bind at least as tightly as min_precedence.
+    """
+    left = yield unary(stream)
+    if left is None:
+        yield None
+    
+    while True:
+        op = stream.current_word()
+        precedence = BINARY_PRECEDENCE.get(op[1])
+        if precedence is None or precedence < min_precedence:
+            break
+        
+        stream.next()
+        right = mandatory((yield climb(stream, precedence + 1)), stream)
+        left = stream.node('operator', op[1], op[2], [left, right])
+        
+        if precedence == COMPARISON_PRECEDENCE:
+            break
+    
+    yield left
+
+def unary(stream):
+    op = stream.current_word()
+    if op[1] in UNARY_OPS:
+        stream.next()
+        operand = mandatory((yield unary(stream)), stream)
+        yield stream.node('operator', op[1], op[2], [operand])
+    
+    operand = yield end(stream)
+    yield operand
+
+def literal(stream, token):
+    """Converts an int, str or bool token into a literal node."""
+    toktype, value, line = token[0:3]
+    if toktype == 'str':
+        value = value[1:-1] # remove the quotes
+    elif toktype == 'int':
+        value = int(value)
+    elif toktype == 'bool':
+        value = value == 'true'
+    
+    return stream.node('literal', value, line, ice9_type=toktype)
+
+def end(stream):
+    token = stream.current_word()
+    toktype, value = token[0:2]
+    
+    if value == '(':
+        stream.next()
+        inner = mandatory((yield expr(stream)), stream)
+        stream.next_is(')')
+        yield inner
+    
+    if toktype == 'keyword' and value == 'read':
+        stream.next()
+        yield stream.node('operator', 'read', token[2])
+    
+    if toktype in ('int', 'str', 'bool'):
+        stream.next()
+        yield literal(stream, token)
+    
+    if toktype != 'ident':
+        yield None
+    
+    stream.next()
+    if stream.is_next('('):
+        call = yield proc_call(stream, token)
+        yield call
+    
+    # lvalue
+    bracket = stream.is_next('[')
+    if bracket is None:
+        lvalue = stream.node('ident', value, token[2])
+    else:
+        indexes = []
+        while True:
+            indexes.append(mandatory((yield expr(stream)), stream))
+            stream.next_is(']')
+            if not stream.is_next('['):
+                break
+        lvalue = stream.node('array_reference', value, bracket[2], indexes)
+    
+    assign = stream.is_next(':=')
+    if assign is not None:
+        value = mandatory((yield expr(stream)), stream)
+        yield stream.node('assignment', ':=', assign[2], [lvalue, value])
+    yield lvalue
+
+def proc_call(stream, name):
+    args = []
+    if not stream.is_next(')'):
+        args.append(mandatory((yield expr(stream)), stream))
+        while stream.is_next(','):
+            args.append(mandatory((yield expr(stream)), stream))
+        stream.next_is(')')
+    
+    yield stream.node('proc_call', name[1], name[2], args)
+
+def parse_ast(source, arena=None):
+    """
+    Parses source straight into an AST, ready for check_semantics. If an
+    arena.ASTArena is given, the AST is built in it.
+    """
+    return parse_tokens_ast(lex_tokens(source), arena)
+
+def parse_tokens_ast(tokens, arena=None):
+    """Like parse_ast, but parses already lexed tokens."""
+    stream = ASTStream(tokens, arena)
+    ast = run(program(stream))
+    stream.next_type_is('EOF')
+    return ast
@@ -0,0 +1,396 @@
+#!/usr/bin/env python
+"""
+Micro-benchmarks for the compiler. Run with
+
+    $ python bench.py [benchmark ...]
+
+With no arguments every benchmark is run.
+"""
+
+import os
+import sys
+import time
+from glob import glob
+
+# benchmark utilities -------------------------------------------------------
+
+def corpus():
+    """Returns the source of every example and community test program."""
+    files = glob('examples/*.9.txt') + glob('community_tests/tests/*.9')
+    files.sort()
+    return [open(f).read() for f in files]
+
+def synthetic_program(nstatements):
+    """
+    Generates a long, but fairly typical, ice9 program with about
+    nstatements statements.
+    """
+    lines = ['var i, j, total : int', 'var a : int[10]', '']
+    for n in xrange(nstatements // 4):
+        lines.append('total := total + %d * (i - j) / 3;' % n)
+        lines.append('if total > %d -> total := total %% 7; [] else -> j := j + 1; fi' % n)
+        lines.append('a[%d] := total;' % (n % 10))
+        lines.append('writes a[%d];' % (n % 10))
+    return '\n'.join(lines) + '\n'
+
+def best_time(fn, repeat=5):
+    """Runs fn repeat times and returns the fastest wall time in seconds."""
+    best = None
+    for i in xrange(repeat):
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def memory_growth(fn):
+    """
+    Runs fn in a forked child, and returns how far (in kilobytes) it pushed
+    the child's peak resident memory above where it started.
+    """
+    import resource
+    
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        fn()
+        after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        os.write(write_end, str(after - before))
+        os._exit(0)
+    
+    os.close(write_end)
+    growth = int(os.read(read_end, 64))
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    return growth
+
+def report(name, count, unit, seconds):
+    print "%-40s %10d %s in %8.4fs (%12.0f %s/s)" % (
+            name, count, unit, seconds, count / seconds, unit)
+
+# benchmarks ----------------------------------------------------------------
+
+def legacy_lex_source(source):
+    """The old lexer, which built a brand new Scanner on every call."""
+    from lexer import TOKENS
+    from re import Scanner
+    
+    def make_token(typ):
+        if typ == 'whitespace' or typ == 'comment':
+            return None
+        def _fn(scanner, token):
+            return typ, token
+        return _fn
+    
+    scanner = Scanner([(regex, make_token(typ)) for typ, regex in TOKENS])
+    tokenized, unused = scanner.scan(source)
+    tokenized.insert(0, ('SOF', 'start of file'))
+    tokenized.append(('EOF', 'end of file'))
+    return tokenized
+
+class LegacyTree:
+    """The old Tree, which kept its attributes in a per-node __dict__."""
+    def __init__(self, parent=None, **kwargs):
+        self.parent = parent
+        self.children = []
+        for k, v in kwargs.iteritems():
+            setattr(self, k, v)
+
+def bench_nodes():
+    """Memory and attribute access for slotted vs dict based tree nodes."""
+    from tree import Tree
+    
+    count = 200000
+    def build(cls):
+        root = cls(node_type='statements', value='')
+        for i in xrange(count):
+            node = cls(parent=root, node_type='literal', value=i, line=i)
+            node.ice9_type = 'int'
+            node.vars = []
+            root.children.append(node)
+        return root
+    
+    def typecheck(root):
+        # the kind of attribute traffic semantic analysis produces
+        for n in root.children:
+            if n.node_type == 'literal' and n.ice9_type == 'int':
+                n.loopcount = n.line
+    
+    for name, cls in (('dict nodes', LegacyTree), ('slotted nodes', Tree)):
+        print "%-40s %10d KB for %d nodes" % (name,
+                memory_growth(lambda: build(cls)), count)
+        root = build(cls)
+        report('%s attribute access' % name, count, 'nodes',
+               best_time(lambda: typecheck(root)))
+
+def bench_lexer():
+    """Tokens per second lexing every file in the corpus, one call per file."""
+    from lexer import lex_source
+    
+    sources = corpus()
+    ntokens = sum(len(lex_source(s)) for s in sources)
+    
+    def run(lexer):
+        return lambda: [lexer(s) for s in sources]
+    
+    report('lexer (rebuilt Scanner per call)', ntokens, 'tokens',
+           best_time(run(legacy_lex_source)))
+    report('lexer (precompiled master pattern)', ntokens, 'tokens',
+           best_time(run(lex_source)))
+
+def bench_parser_scaling():
+    """Parse time as the program grows; time per token should stay flat."""
+    from lexer import lex_tokens
+    from parser import parse_tokens
+    
+    for nstatements in (1000, 2000, 4000, 8000, 16000):
+        tokens = list(lex_tokens(synthetic_program(nstatements)))
+        seconds = best_time(lambda: parse_tokens(tokens), 1)
+        report('parse (%d statements)' % nstatements, len(tokens), 'tokens',
+               seconds)
+
+def bench_codegen_scaling():
+    """Code generation time as the program grows; should be linear."""
+    from ice9 import parse_source
+    from semantic import check_semantics
+    from codegenerator import generate_code
+    
+    for nstatements in (2000, 4000, 8000, 16000, 32000):
+        ast = check_semantics(parse_source(synthetic_program(nstatements), True))
+        report('generate_code (%d statements)' % nstatements, nstatements,
+               'statements', best_time(lambda: generate_code(ast), 1))
+
+def bench_parse_allocations():
+    """Parse tree nodes allocated vs kept when parsing the corpus."""
+    from parser import parse
+    import tree
+    
+    allocated = [0]
+    original_init = tree.Tree.__init__
+    def counting_init(self, *args, **kwargs):
+        allocated[0] += 1
+        original_init(self, *args, **kwargs)
+    
+    tree.Tree.__init__ = counting_init
+    try:
+        sources = corpus()
+        kept = 0
+        for source in sources:
+            kept += len(list(parse(source).prefix_iter()))
+        seconds = best_time(lambda: [parse(s) for s in sources], 1)
+    finally:
+        tree.Tree.__init__ = original_init
+    
+    # the timing run allocated everything a second time
+    allocated = allocated[0] / 2
+    print "parse tree nodes: %d allocated, %d kept, %d thrown away" % (
+            allocated, kept, allocated - kept)
+    report('parse (corpus)', allocated, 'nodes', seconds)
+
+def bench_incremental():
+    """Full reparse vs incremental reparse after small edits."""
+    from parser import parse
+    from incremental import IncrementalParse
+    
+    # an edit should cost the same however long the file is
+    for nstatements in (8000, 64000):
+        source = synthetic_program(nstatements)
+        nlines = source.count('\n')
+        # edit a digit on a line in the middle of the file
+        position = source.index('total + ', len(source) // 2) + len('total + ')
+        
+        report('full parse (%d lines)' % nlines, 1, 'edits',
+               best_time(lambda: parse(source), 1))
+        
+        parsed = IncrementalParse(source)
+        report('incremental reparse (%d lines)' % nlines, 1, 'edits',
+               best_time(lambda: parsed.edit(position, position + 1, '9')))
+        
+        # breaking the line moves every line after it down, and joining it
+        # again moves them back
+        def break_line():
+            parsed.edit(position, position, '\n')
+            parsed.edit(position, position + 1, '')
+        report('incremental line break (%d lines)' % nlines, 2, 'edits',
+               best_time(break_line))
+
+def bench_frontend():
+    """Parse tree + parse2ast vs building the AST directly."""
+    from ice9 import parse_source
+    
+    source = synthetic_program(8000)
+    nlines = source.count('\n')
+    front_ends = (('parse tree + parse2ast', lambda: parse_source(source, False)),
+                  ('direct AST', lambda: parse_source(source, True)))
+    
+    # measure memory before timing anything, so neither child starts out
+    # with memory freed by the other's runs
+    for name, front_end in front_ends:
+        print "%-40s %10d KB peak memory growth" % (name,
+                                                    memory_growth(front_end))
+    for name, front_end in front_ends:
+        report('%s (%d lines)' % (name, nlines), nlines, 'lines',
+               best_time(front_end, 3))
+
+def bench_parse2ast():
+    """Time to turn an already built parse tree into an AST."""
+    from parser import parse
+    from ast import parse2ast
+    
+    source = synthetic_program(16000)
+    trees = [parse(source) for i in xrange(3)]
+    report('parse2ast (16000 statements)', 16000, 'statements',
+           best_time(lambda: parse2ast(trees.pop()), 3))
+
+def bench_scopes():
+    """Semantic checking and code generation in deeply nested scopes."""
+    from ice9 import parse_source
+    from semantic import check_semantics
+    from codegenerator import generate_code
+    
+    depth = 150
+    lines = ['var %s : int' % ', '.join(['g%d' % i for i in xrange(50)])]
+    for n in xrange(10):
+        lines.append('proc p%d(x : int) : int' % n)
+        lines += ['fa i%d := 1 to x ->' % i for i in xrange(depth)]
+        lines += ['g%d := g%d + i%d + x;' % (i % 50, (i * 7) % 50, i)
+                  for i in xrange(depth)]
+        lines += ['af'] * depth
+        lines.append('end')
+    lines.append('write p0(1);')
+    source = '\n'.join(lines) + '\n'
+    
+    asts = [parse_source(source, True) for i in xrange(3)]
+    report('check_semantics (fa nested %d deep)' % depth, depth * 10,
+           'statements', best_time(lambda: check_semantics(asts.pop()), 3))
+    ast = check_semantics(parse_source(source, True))
+    report('generate_code (fa nested %d deep)' % depth, depth * 10,
+           'statements', best_time(lambda: generate_code(ast), 1))
+
+def bench_types():
+    """Semantic checking of a program full of type aliases and arrays."""
+    from ice9 import parse_source
+    from semantic import check_semantics
+    
+    lines = ['type t0 = int']
+    lines += ['type t%d = t%d[2]' % (i, i - 1) for i in xrange(1, 13)]
+    lines += ['type a%d = t%d' % (i, i % 13) for i in xrange(200)]
+    lines.append('var %s : a12' % ', '.join(['v%d' % i for i in xrange(20)]))
+    lines.append('proc f(x, y : a12, z : a25) : int f := x%s; end'
+                 % ('[1]' * 12))
+    for n in xrange(2000):
+        lines.append('v%d%s := v%d%s + f(v%d, v%d, v%d);' % (n % 20,
+                     '[1]' * 12, (n * 3) % 20, '[0]' * 12, n % 20,
+                     (n * 7) % 20, (n * 11) % 20))
+    source = '\n'.join(lines) + '\n'
+    
+    asts = [parse_source(source, True) for i in xrange(5)]
+    report('check_semantics (type aliases)', 2000, 'statements',
+           best_time(lambda: check_semantics(asts.pop()), 5))
+
+def bench_nesting():
+    """Direct AST parse time as if statements nest deeper; should be flat."""
+    from astparser import parse_ast
+    
+    for depth in (5000, 10000, 20000, 40000):
+        source = ('var x : int\n' + 'if x < 1 -> ' * depth + 'x := 1;' +
+                  ' fi' * depth + '\n')
+        report('parse %d nested ifs' % depth, depth, 'levels',
+               best_time(lambda: parse_ast(source), 1))
+
+def bench_arena():
+    """Trees vs the array backed AST arena on a 100k statement program."""
+    from ice9 import parse_source, compile
+    from semantic import check_semantics
+    from astoptimizer import optimize_ast
+    
+    source = synthetic_program(100000)
+    def middle_end(arena):
+        ast = check_semantics(parse_source(source, True, arena))
+        optimize_ast(ast)
+        return ast
+    
+    # the AST on its own, and then everything the compiler keeps alongside it
+    stores = (('trees', False), ('arena', True))
+    for name, arena in stores:
+        print "%-40s %10d KB peak memory growth" % (name + ' AST (100k statements)',
+                memory_growth(lambda: middle_end(arena)))
+        print "%-40s %10d KB peak memory growth" % (name + ' full compile',
+                memory_growth(lambda: compile(source, arena=arena)))
+    for name, arena in stores:
+        report('%s full compile' % name, 100000, 'statements',
+               best_time(lambda: compile(source, arena=arena), 1))
+
+def bench_batch():
+    """Batch compiling the community tests, in one process vs a pool."""
+    import shutil
+    import tempfile
+    from multiprocessing import cpu_count
+    from ice9 import compile_batch
+    
+    outdir = tempfile.mkdtemp()
+    try:
+        files = [(f, os.path.join(outdir, os.path.basename(f) + '.tm'))
+                 for f in sorted(glob('community_tests/tests/*.9'))]
+        for processes in sorted(set([1, 2, cpu_count()])):
+            report('batch compile (%d processes)' % processes, len(files),
+                   'files', best_time(lambda: list(compile_batch(files,
+                                                                 processes)),
+                                      1))
+    finally:
+        shutil.rmtree(outdir)
+
+def bench_server():
+    """Compiling a small file with a fresh ice9.py vs a warm compile server."""
+    import shutil
+    import tempfile
+    import threading
+    from subprocess import Popen, PIPE
+    from server import CompileServer, request
+    
+    source = open('examples/fact.9.txt').read()
+    def cold():
+        Popen([sys.executable, 'ice9.py'], stdin=PIPE,
+              stdout=PIPE).communicate(source)
+    report('ice9.py (fact.9)', 1, 'files', best_time(cold))
+    
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'ice9.sock')
+    server = CompileServer(path)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        report('compile server (fact.9)', 1, 'files',
+               best_time(lambda: request(path, source)))
+        report('compile server, unoptimized (fact.9)', 1, 'files',
+               best_time(lambda: request(path, source, ['-s'])))
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+        shutil.rmtree(directory)
+
+benchmarks = {
+    'server': bench_server,
+    'batch': bench_batch,
+    'arena': bench_arena,
+    'nesting': bench_nesting,
+    'parse2ast': bench_parse2ast,
+    'scopes': bench_scopes,
+    'types': bench_types,
+    'frontend': bench_frontend,
+    'incremental': bench_incremental,
+    'allocations': bench_parse_allocations,
+    'lexer': bench_lexer,
+    'nodes': bench_nodes,
+    'parser': bench_parser_scaling,
+    'codegen': bench_codegen_scaling,
+}
+
+if __name__ == '__main__':
+    names = sys.argv[1:] or sorted(benchmarks)
+    for name in names:
+        benchmarks[name]()
@@ -0,0 +1,161 @@
+#!/usr/bin/env python
+
+"""
+An on-disk cache of compiled programs, so that compiling a file that hasn't
+changed since it was last compiled only means reading a file.
+
+Compiled programs are stored under a hash of their source, whether they
+were optimized, and the compiler itself, so changing any of them (even
+editing the compiler) means a fresh compile. Entries are written to a
+temporary file and renamed into place, so any number of compilers can share
+one cache directory; temporary files left behind by a compiler that died
+while writing one are removed once they're old enough. When the cache grows
+past its size limit, the entries used least recently are thrown away.
+"""
+
+import os
+import tempfile
+import time
+
+try:
+    from hashlib import sha1
+except ImportError:
+    from sha import new as sha1
+
+# every file whose contents affect the compiled program
+COMPILER_FILES = ('ice9.py', 'lexer.py', 'grammar.py', 'grammar.txt',
+                  'parser.py', 'tree.py', 'ast.py', 'astparser.py',
+                  'arena.py', 'symbols.py', 'semantic.py', 'astoptimizer.py',
+                  'codegenerator.py', 'cfg.py', 'optimizer.py')
+
+# how old a temporary file has to be before it's taken to have been left
+# behind by a compiler that died while writing it
+STALE_TEMP_AGE = 60 * 60
+
+_compiler_version = None
+
+def compiler_version():
+    """Returns a hash of the compiler's own source."""
+    global _compiler_version
+    if _compiler_version is None:
+        directory = os.path.dirname(os.path.abspath(__file__))
+        h = sha1()
+        for name in COMPILER_FILES:
+            h.update(open(os.path.join(directory, name), 'rb').read())
+        _compiler_version = h.hexdigest()
+    return _compiler_version
+
+class CompileCache(object):
+    """
+    A cache of compiled programs in directory, which is kept under
+    max_size bytes. A leading ~ in directory is expanded, since the shell
+    won't expand it in --cache=~/dir.
+    """
+    
+    def __init__(self, directory, max_size=64 * 1024 * 1024):
+        directory = os.path.expanduser(directory)
+        self.directory = directory
+        self.max_size = max_size
+        if not os.path.isdir(directory):
+            try:
+                os.makedirs(directory)
+            except OSError:
+                # another compiler may have just made it
+                if not os.path.isdir(directory):
+                    raise
+    
+    def key(self, source, optimize):
+        """Returns the key the program compiled from source is kept under."""
+        h = sha1(compiler_version())
+        h.update(optimize and 'optimized\n' or 'unoptimized\n')
+        h.update(source)
+        return h.hexdigest()
+    
+    def path(self, key):
+        return os.path.join(self.directory, key + '.tm')
+    
+    def get(self, key):
+        """Returns the compiled program kept under key, or None."""
+        path = self.path(key)
+        try:
+            f = open(path, 'rb')
+        except IOError:
+            return None
+        try:
+            compiled = f.read()
+        finally:
+            f.close()
+        
+        # mark it as recently used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        return compiled
+    
+    def put(self, key, compiled):
+        """Keeps the compiled program under key."""
+        fd, temp = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            f = os.fdopen(fd, 'wb')
+            try:
+                f.write(compiled)
+            finally:
+                f.close()
+            # readers only ever see the whole entry, or none of it
+            os.rename(temp, self.path(key))
+        except:
+            os.remove(temp)
+            raise
+        
+        self.evict()
+    
+    def entries(self, suffix='.tm'):
+        """
+        Returns (last used, size, path) for every entry in the cache, or
+        every file with the given suffix.
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(suffix):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                # evicted by someone else
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+        return entries
+    
+    def evict(self):
+        """
+        Removes temporary files left behind by writes that never finished,
+        then the least recently used entries until the cache fits. Temporary
+        files still being written count towards the cache's size.
+        """
+        size = 0
+        stale = time.time() - STALE_TEMP_AGE
+        for mtime, temp_size, path in self.entries('.tmp'):
+            if mtime < stale:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+            else:
+                size += temp_size
+        
+        entries = self.entries()
+        size += sum([e[1] for e in entries])
+        if size <= self.max_size:
+            return
+        
+        entries.sort()
+        for mtime, entry_size, path in entries:
+            if size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            size -= entry_size
@@ -82,11 +82,20 @@ def construct_CFG(code5):
     # build the beginning linked list.
     cfg = None
     node = None
+    labels = {} # the node each label is at
+    waiting = [] # labels waiting for the next node
     for inst5 in code5:
+        if inst5[0] == 'label':
+            waiting.append(inst5[1])
+            continue
+        
         node = CFGNode(inst5, node)
         if cfg is None:
             # need to keep the link to the first one
             cfg = node
+        for name in waiting:
+            labels[name] = node
+        waiting = []
     
     # Now we want to look for any jumps
     
@@ -98,7 +107,10 @@ def construct_CFG(code5):
             
             # this instruction, depending on value of reg[r], 
             # jumps to s + reg[t].
-            if t == PC:
+            if type(s) is str:
+                # jump to a label
+                jumpto = labels[s]
+            elif t == PC:
                 # relative jump
                 jumpto = node[s + 1]
             elif t == ZERO:
@@ -111,7 +123,10 @@ def construct_CFG(code5):
             jumpto.inlinks.add(node)
             node.outlink = jumpto
         elif inst in LOAD_INST and r == PC:
-            if inst == 'LDA':
+            if type(s) is str:
+                # jump to a label
+                jumpto = labels[s]
+            elif inst == 'LDA':
                 # loading an offset
                 assert t == PC # don't know how to handle any other case
                 jumpto = node[s + 1]
@@ -145,18 +160,33 @@ def yield_blocks(cfg):
         yield block
 
 def fix_jumps(cfg):
+    # every node's index(), found in one pass rather than by walking back
+    # from each jump and its target
+    indexes = {}
+    for i, cfgnode in enumerate(cfg):
+        indexes[cfgnode] = i + 1
+    
+    def index(node):
+        # a jump can still point at a removed node, whose index() counts
+        # back through the nodes before it
+        removed = 0
+        while node is not None and node not in indexes:
+            removed += 1
+            node = node.prev
+        return indexes.get(node, 0) + removed
+    
     for cfgnode in cfg:
         if cfgnode.outlink:
             inst, r, s, t, com = cfgnode.inst5
             if inst in JUMP_INSTS and t == PC:
-                s = cfgnode.outlink.index() - cfgnode.index() - 1
+                s = index(cfgnode.outlink) - indexes[cfgnode] - 1
                 if inst == 'JEQ' and r == ZERO:
                     inst = 'LDA'
                     r = PC
             elif inst == 'LDA' and r == PC and t == PC:
-                s = cfgnode.outlink.index() - cfgnode.index() - 1
+                s = index(cfgnode.outlink) - indexes[cfgnode] - 1
             elif r == PC and (inst == 'LDC' or (inst == 'LDA' and t == ZERO)):
-                s = cfgnode.outlink.index() - 1
+                s = index(cfgnode.outlink) - 1
             cfgnode.inst5 = (inst, r, s, t, com)
                 
     
\ No newline at end of file
@@ -1,7 +1,10 @@
     #!/usr/bin/env python
 
-from semantic import first_definition
+import threading
+
+from symbols import SymbolTable
 from itertools import izip
+from types import GeneratorType
 
 # REGISTERS
 ZERO = 0 # always zero
@@ -13,93 +16,192 @@ FP   = 5 # points to the start of the frame
 SP   = 6 # points to the top of the stack
 PC   = 7 # points to the next instruction
 
-activation_record_size = [0]
+class CodegenContext(object):
+    """
+    Where everything is while generating code for one program. Every program
+    gets a context of its own, so several can be generated at the same time
+    in different threads.
+    """
+    
+    def __init__(self):
+        self.activation_record_size = [0]
+        
+        # variable locations, scoped the same as in type checking
+        self.variables = SymbolTable()
+        # and their types, scoped the same way
+        self.types = SymbolTable()
+        # global dictionary of proc labels
+        self.procs = {}
+        
+        # where breaks jump to, innermost loop last
+        self.loop_ends = []
+        # how many fa loops we're in, whose variables are kept in AC3
+        self.fa_depth = 0
+        # the proc being generated (None in the program's body), and where
+        # its returns jump to
+        self.proc = None
+        self.proc_end = None
+        # where exits jump to, and failed array bounds checks (None until
+        # one is generated)
+        self.halt = None
+        self.out_of_bounds = None
+        
+        # the code generated so far, and how many labels it has used
+        self.code5 = []
+        self.labels = 0
+        
+        # the registers each expression needs (see label_registers)
+        self.register_labels = {}
+
+# the context of the program being generated in each thread
+current = threading.local()
+
+# Code emission -------------------------------------------------------------
 
-# variable locations, done the same as in type checking
-# a global stack of dictionaries.
-variables = [{}]
-# global dictionary of proc locations
-procs = {}
+# Every rule appends its code to the end of the context's code, instead of
+# returning a list of its own for its parent to copy, so generating code
+# takes time linear in the size of the program. Jumps go to labels rather
+# than offsets, so no rule needs to know how long any code is, and the
+# labels are only turned into offsets once the whole program has been
+# generated (see assemble).
+
+def emit(code5):
+    """Appends the instructions in code5 to the code being generated."""
+    current.context.code5.extend(code5)
+
+def new_label():
+    """Returns a label that hasn't been used yet."""
+    ctx = current.context
+    ctx.labels += 1
+    return 'L%d' % ctx.labels
+
+# Rules which generate code for other nodes are generators, like the rules in
+# astparser.py, so that nesting in the program doesn't nest on the Python
+# stack. A rule generates a node's code with
+#
+#     yield code_for(node)
+#
+# and calls another such rule the same way, getting its result with
+#
+#     result = yield other_rule(...)
+#
+# A rule hands back a result by yielding anything other than a generator,
+# and is never resumed after that; one that just ends hands back None.
+# run() keeps the stack of rules which are waiting on a result.
+
+def run(rule):
+    """Runs a rule (and every rule it calls) to completion."""
+    stack = [rule]
+    value = None
+    while True:
+        try:
+            result = stack[-1].send(value)
+        except StopIteration:
+            result = None
+        else:
+            if type(result) is GeneratorType:
+                stack.append(result)
+                value = None
+                continue
+        stack.pop()
+        if not stack:
+            return result
+        value = result
+
+def done(result):
+    """A rule which has already finished, handing back result."""
+    yield result
 
 # Code generation utilities -------------------------------------------------
 
 def type9_size(ice9_type):
-    """Returns the full size of the ice9 type in words."""
-    size = 1
-    while type(ice9_type) is list and ice9_type[0] == "array":
-        size *= ice9_type[2]
-        ice9_type = ice9_type[1]
-    return size
+    """Returns the full size of the (expanded) ice9 type in words."""
+    if type(ice9_type) is tuple and ice9_type[0] == "array":
+        # worked out once, when the type was expanded
+        return ice9_type[3]
+    return 1
 
 def memlookup(varname, ast):
     """
-    Returns a tuple (code5, memloc, relreg) meaning after code5,
-    varname will be in memory[memloc + reg[relreg]].
+    Emits code after which varname will be in memory[memloc + reg[relreg]],
+    and hands back (memloc, relreg).
     """
-    code5 = []
-    memloc, relreg = first_definition(variables, varname)
+    ctx = current.context
+    memloc, relreg = ctx.variables.lookup(varname)
     
     if ast and len(ast.children) > 0:
         # array reference. We need to do all our index calculations and such
-        p = ast.parent
-        while True:
-            if hasattr(p, 'vars') and any(x == varname for x, t in p.vars):
-                break
-            else:
-                p = p.parent
-        
         arrayindexes = []
-        vartype = dict(p.vars)[varname]
-        while type(vartype) is list and vartype[0] == "array":
+        vartype = ctx.types.lookup(varname)
+        while type(vartype) is tuple and vartype[0] == "array":
             arrayindexes.append(vartype[2])
             vartype = vartype[1]
         
-        code5 += comment('%s is an array of size %s' % (varname, arrayindexes))
-        
-        from tree import Tree
-        fakeast = Tree(node_type='operator', value='write')
-        fakeast.children = [Tree(node_type='literal', value='Arrays bounds violation', ice9_type='str')]
-        failcode  = comment('Array out of bounds error code:')
-        failcode += generate_code(fakeast)
-        failcode += [('HALT', 0, 0, 0, 'Array out of bounds')]
-        failcode += comment('End array out of bounds error code')
-        
-        indexcode  = comment('Calculating memory location:')
+        failure = out_of_bounds_label()
+        emit(comment('%s is an array of size %s' % (varname, arrayindexes)))
+        emit(comment('Calculating memory location:'))
         
         if relreg == FP:
             # we're in a proc, so what we have is a pointer that we'll
             # still need to dereference again
-            indexcode += [('LD', AC4, memloc, relreg, 'Go ahead and dereference %s' % varname)]
+            emit([('LD', AC4, memloc, relreg, 'Go ahead and dereference %s' % varname)])
             memloc, relreg = 0, AC4
         else:
             # we're just in the main body, so we already know the
             # direct location of the array.
-            indexcode += [('LDA', AC4, memloc, relreg, 'Start array indexing at 0')]
+            emit([('LDA', AC4, memloc, relreg, 'Start array indexing at 0')])
             memloc, relreg = 0, AC4
         
         iteration = izip(ast.children, arrayindexes, arrayindexes[1:] + [1])
         for indexast, dimension_size, mul_size in iteration:
-            indexcode += push_register(AC4, "Pushing array address to stack")
-            indexcode += generate_code(indexast)
-            indexcode += pop_register(AC4, "Popping array address from stack")
-            jumpsize = code_length(failcode + indexcode)
-            indexcode += [('JLT', AC1, - jumpsize - 1, PC, 'Check index >= 0'),
-                          ('LDA', AC1, - dimension_size, AC1, 'Prepare for dimension check'),
-                          ('JGE', AC1, - jumpsize - 3, PC, 'Check index < size'),
-                          ('LDA', AC1, dimension_size, AC1, 'Undo dimension check'),
-                          ('LDC', AC2, mul_size, 0, 'Prepare for dimension multiply'),
-                          ('MUL', AC2, AC2, AC1, 'Multiply index * arraysize'),
-                          ('ADD', AC4, AC4, AC2, 'Add this increment to our offset.')]
-        
-        code5 += [('JEQ', ZERO, code_length(failcode), PC, 'Skip array out of bounds failure.')]
-        code5 += failcode
-        code5 += indexcode
+            registers = [r for r in expression_registers() if r != AC4]
+            labels = label_registers(indexast)
+            if labels[0] <= len(registers):
+                # the index can be worked out without touching AC4
+                yield evaluate(indexast, labels, registers[0], registers[1:])
+            else:
+                emit(push_register(AC4, "Pushing array address to stack"))
+                yield code_for(indexast)
+                emit(pop_register(AC4, "Popping array address from stack"))
+            emit([('JLT', AC1, failure, PC, 'Check index >= 0'),
+                  ('LDA', AC1, - dimension_size, AC1, 'Prepare for dimension check'),
+                  ('JGE', AC1, failure, PC, 'Check index < size'),
+                  ('LDA', AC1, dimension_size, AC1, 'Undo dimension check'),
+                  ('LDC', AC2, mul_size, 0, 'Prepare for dimension multiply'),
+                  ('MUL', AC2, AC2, AC1, 'Multiply index * arraysize'),
+                  ('ADD', AC4, AC4, AC2, 'Add this increment to our offset.')])
+    
+    yield memloc, relreg
+
+def out_of_bounds_label():
+    """
+    Returns the label of the program's array out of bounds trap, which every
+    bounds check jumps to when it fails.
+    """
+    ctx = current.context
+    if ctx.out_of_bounds is None:
+        ctx.out_of_bounds = new_label()
+    return ctx.out_of_bounds
+
+def out_of_bounds_trap():
+    """Generates the trap array bounds checks jump to, if any do."""
+    ctx = current.context
+    if ctx.out_of_bounds is None:
+        return
     
-    return code5, memloc, relreg
+    from tree import Tree
+    fakeast = Tree(node_type='operator', value='write')
+    fakeast.children = [Tree(node_type='literal', value='Arrays bounds violation', ice9_type='str')]
+    emit(label(ctx.out_of_bounds))
+    emit(comment('Array out of bounds error code:'))
+    yield code_for(fakeast)
+    emit([('HALT', 0, 0, 0, 'Array out of bounds')])
+    emit(comment('End array out of bounds error code'))
 
 def is_comment(inst5):
     "Returns whether this 'instruction' is just a comment."
-    return type(inst5) is tuple and inst5[0] in ('comment', 'string', 'data')
+    return type(inst5) is tuple and inst5[0] in ('comment', 'string', 'data',
+                                                 'label')
 
 def code_length(code5):
     """Returns the length of the code with comments removed."""
@@ -127,279 +229,485 @@ def comment(comment):
     """Makes a comment line."""
     return [('comment', 0, 0, 0, comment)]
 
+def label(name):
+    """Makes a label line. Jumps to name go to the instruction after it."""
+    return [('label', name, 0, 0, 'label %s' % name)]
+
 def passthru(ast):
     """
     Code generated by this item is the sequential concatenation of its
     children. Useful for statements, etc.
     """
-    from operator import add
-    return reduce(add, [generate_code(c) for c in ast.children], [])
+    for c in ast.children:
+        yield code_for(c)
+
+# ASSEMBLY ----------------------------------------------------------------
+
+def resolve_jump(inst5, address, target):
+    """
+    Returns the jump inst5, at address, with its label replaced by the
+    address target: as an offset if it's relative to the PC, or as the
+    address itself if it's relative to ZERO.
+    """
+    inst, r, s, t, com = inst5
+    if t == PC:
+        s = target - address - 1
+    else:
+        s = target
+    return (inst, r, s, t, com)
+
+def assemble(code5):
+    """
+    Returns code5 with its labels removed, and every jump to a label
+    jumping to the instruction after it instead. The code is only gone
+    through once: a jump to a label that hasn't been seen yet is filled in
+    when it is.
+    """
+    labels = {}   # the address of every label seen so far
+    waiting = {}  # the jumps to each label not seen yet
+    realcode5 = []
+    address = 0
+    for inst5 in code5:
+        if inst5[0] == 'label':
+            name = inst5[1]
+            labels[name] = address
+            for index, jumpaddress in waiting.pop(name, ()):
+                realcode5[index] = resolve_jump(realcode5[index],
+                                                jumpaddress, address)
+            continue
+        
+        if not is_comment(inst5):
+            target = inst5[2]
+            if type(target) is str:
+                if target in labels:
+                    inst5 = resolve_jump(inst5, address, labels[target])
+                else:
+                    waiting.setdefault(target, []).append((len(realcode5),
+                                                           address))
+            address += 1
+        realcode5.append(inst5)
+    
+    if waiting:
+        raise ValueError("Jumps to missing labels: %s" %
+                         ', '.join(sorted(waiting)))
+    return realcode5
 
 # NODE_TYPE RULES ---------------------------------------------------------
 
-def literal(ast):
-    """Generates code for literal constants."""
+def literal(ast, reg=AC1):
+    """Generates code for literal constants, loading ints and bools into reg."""
+    ctx = current.context
     if ast.ice9_type == 'int' or ast.ice9_type == 'bool':
-        return [('LDC', AC1, int(ast.value), 0, 'load constant: %s' % ast.value)]
+        emit([('LDC', reg, int(ast.value), 0, 'load constant: %s' % ast.value)])
     elif ast.ice9_type == 'str':
-        heapsize = activation_record_size[-1]
+        heapsize = ctx.activation_record_size[-1]
         address = heapsize
         heapsize += len(ast.value) + 1
-        activation_record_size[-1] = heapsize
-        return [('string', ast.value, 0, 0, 'string literal'),
-                ('LDC', AC1, address, 0, 'Load pointer to string into memory.')]
+        ctx.activation_record_size[-1] = heapsize
+        emit([('string', ast.value, 0, 0, 'string literal'),
+              ('LDC', AC1, address, 0, 'Load pointer to string into memory.')])
 
 def writes(ast):
     """Handles writing to output."""
     value = ast.children[0]
-    valuecode = generate_code(value)
+    yield code_for(value)
     
     if value.ice9_type in ('int', 'bool'):
-        return valuecode + [('OUT', AC1, 0, 0, 'writing int')]
+        emit([('OUT', AC1, 0, 0, 'writing int')])
     elif value.ice9_type == 'str':
-        return valuecode + push_register(AC2) + [
+        # nothing is kept in AC2 between statements
+        emit([
             ('LD', AC2, 0, AC1, 'Load next character into memory.'),
             ('JEQ', AC2, 3, PC, 'If we find the null terminator, stop.'),
             ('OUTC', AC2, 0, 0, 'Output the character'),
             ('LDA', AC1, 1, AC1, 'Increment character pointer'),
             ('JEQ', ZERO, -5, PC, 'Continue until null terminator')
-        ] + pop_register(AC2)
-    
-    return valuecode
+        ])
 
 def write(ast):
     """Handles write command (contains a newline)."""
-    return writes(ast) + [('OUTNL', 0, 0, 0, 'newline for write')]
+    yield writes(ast)
+    emit([('OUTNL', 0, 0, 0, 'newline for write')])
 
 def read(ast):
-    return [('IN', AC1, 0, 0, 'Read input from command line.')]
+    emit([('IN', AC1, 0, 0, 'Read input from command line.')])
 
 def return9(returnnode):
-    return [('return', 0, 0, 0, 'return')]
+    ctx = current.context
+    if ctx.proc is None:
+        # returning from the program's body ends it
+        exit9(returnnode)
+    else:
+        emit([('JEQ', ZERO, ctx.proc_end, PC, 'early return in %s' % ctx.proc)])
 
 def exit9(exitnode):
-    return [('exit', 0, 0, 0, 'exit')]
+    emit([('JEQ', ZERO, current.context.halt, PC, 'early exit!')])
 
 def break9(breaknode):
-    return [('break', 0, 0, 0, 'break')]
+    emit([('JEQ', ZERO, current.context.loop_ends[-1], PC, 'break')])
 
-def ident(ast):
+def ident(ast, reg=AC1):
     varname = ast.value
-    code5, memloc, relreg = memlookup(varname, ast)
-    if type(ast.ice9_type) is list and ast.ice9_type[0] == "array":
-        code5 += [('LDA', AC1, memloc, relreg, 'Load pointer to %s in register 1' % varname)]
+    memloc, relreg = yield memlookup(varname, ast)
+    if type(ast.ice9_type) is tuple and ast.ice9_type[0] == "array":
+        emit([('LDA', reg, memloc, relreg, 'Load pointer to %s in register %d' % (varname, reg))])
     elif relreg == SP or relreg == FP or relreg == ZERO or relreg == AC4:
-        code5 += [('LD', AC1, memloc, relreg, 'Load %s to register 1' % varname)]
+        emit([('LD', reg, memloc, relreg, 'Load %s to register %d' % (varname, reg))])
     else:
-        code5 += [('LDA', AC1, memloc, relreg, 'Load %s to register 1' % varname)]
-    
-    return code5
+        emit([('LDA', reg, memloc, relreg, 'Load %s to register %d' % (varname, reg))])
 
 def assignment(ast):
     var, val = ast.children
     varname = var.value
-    lookupcode5, memloc, relreg = memlookup(varname, var)
     
-    code5  = comment('ASSIGN to %s:' % varname) + generate_code(val)
-    code5 += push_register(AC1, 'saving the set value to the stack')
-    code5 += lookupcode5
-    code5 += pop_register(AC1, 'getting the set value off the stack')
-    code5 += [('ST', AC1, memloc, relreg, 'STORE variable %s' % varname)]
-    code5 += comment('END ASSIGN TO %s' % varname)
-    return code5
+    emit(comment('ASSIGN to %s:' % varname))
+    yield code_for(val)
+    if len(var.children) > 0:
+        # working out where an array element is uses AC1
+        emit(push_register(AC1, 'saving the set value to the stack'))
+        memloc, relreg = yield memlookup(varname, var)
+        emit(pop_register(AC1, 'getting the set value off the stack'))
+    else:
+        memloc, relreg = yield memlookup(varname, var)
+    emit([('ST', AC1, memloc, relreg, 'STORE variable %s' % varname)])
+    emit(comment('END ASSIGN TO %s' % varname))
 
 def program(ast):
-    """Generates code for a whole program."""
-    # make sure variable and proc locations are reset
-    global variables, procs, activation_record_size
-    variables = [{}]
-    procs = {}
-    
-    code5 = comment("PREAMBLE")
-    code5 += [('LD', SP, ZERO, ZERO, 'Set the stack pointer'),]
+    """Generates code for a whole program, in a context of its own."""
+    # the program may be generated inside another one, in this thread
+    outer_context = getattr(current, 'context', None)
+    current.context = CodegenContext()
+    try:
+        return run(program_code(ast))
+    finally:
+        current.context = outer_context
+
+def program_code(ast):
+    """
+    Generates code for a whole program in the current context, and hands
+    back all of it.
+    """
+    ctx = current.context
+    emit(comment("PREAMBLE"))
+    emit([('LD', SP, ZERO, ZERO, 'Set the stack pointer'),])
     # variable declarations:
     address = 1
     for var, type9 in ast.vars:
-        variables[0][var] = address, ZERO
+        ctx.variables.define(var, (address, ZERO))
+        ctx.types.define(var, type9)
         address += type9_size(type9)
-        code5 += comment('DECLARE "%s" (size: %s)' % (var, type9_size(type9)))
-        code5 += [('data', 0, 0, 0, '%s initialization' % var)] * type9_size(type9)
+        emit(comment('DECLARE "%s" (size: %s)' % (var, type9_size(type9))))
+        emit([('data', 0, 0, 0, '%s initialization' % var)] * type9_size(type9))
+    
+    ctx.activation_record_size = [address]
     
-    activation_record_size = [address]
+    start = new_label()
+    emit([('JEQ', ZERO, start, PC, 'skip proc definitions')])
+    emit(comment("END PREAMBLE"))
     
-    proccode5 = []
     children = ast.children
-    # general program code.
-    while len(children) > 0 and children[0].node_type == 'proc':
-        procnode = children.pop(0)
-        procname = procnode.value
-        proclocation = code_length(proccode5) + 2
-        procs[procname] = proclocation
-        proccode5 += generate_code(procnode)
-        
-    code5 += [('JEQ', ZERO, code_length(proccode5), PC, 'skip proc definitions')]
+    hasprocs = len(children) > 0 and children[0].node_type == 'proc'
+    if hasprocs:
+        emit(comment("BEGIN PROCS"))
     
-    code5 += comment("END PREAMBLE")
+    ctx.halt = new_label()
+    while len(children) > 0 and children[0].node_type == 'proc':
+        yield code_for(children.pop(0))
     
-    if len(proccode5) > 0:    
-        code5 += comment("BEGIN PROCS")
-        code5 += proccode5
-        code5 += comment("END PROCS")
+    if hasprocs:
+        emit(comment("END PROCS"))
     
-    code5 += comment("START OF PROGRAM")
+    emit(label(start))
+    emit(comment("START OF PROGRAM"))
     
-    code5 += passthru(ast)
+    # general program code.
+    yield passthru(ast)
     
-    # handle all remaining exits and returns
-    code5 += [('HALT', 0, 0, 0, 'END OF PROGRAM')]
-    codelen = code_length(code5)
-    instno = 0
-    for i, inst5 in enumerate(code5):
-        if is_comment(inst5):
-            continue
-        
-        if inst5[0] == "return" or inst5[0] == "exit":
-            code5[i] = ('JEQ', ZERO, codelen - instno - 2, PC, 'early exit!')
-        instno += 1
+    # all exits (and returns outside of procs) end up here
+    emit(label(ctx.halt))
+    emit([('HALT', 0, 0, 0, 'END OF PROGRAM')])
     
+    # shared by the whole program, out of the way after its end
+    yield out_of_bounds_trap()
+    yield ctx.code5
+
+# Binary operators ---------------------------------------------------------
+
+# Integer arithmetic is evaluated Sethi-Ullman style: every subexpression is
+# labelled with the number of registers it needs, the operand needing more
+# is evaluated first, and the other one into a register that's still free,
+# so operands only go through the stack once the accumulators run out.
+# Anything that isn't arithmetic on constants and variables (proc calls,
+# array lookups, comparisons and so on) is generated as usual, leaving its
+# value in AC1 after using whatever registers it likes, so it's counted as
+# needing all of them.
+
+# the instruction for each arithmetic operator
+ARITHMETIC = {'+': 'ADD', '-': 'SUB', '*': 'MUL', '/': 'DIV'}
+
+# more registers than there are
+ALL_REGISTERS = 5
+
+def expression_registers():
+    """Returns the registers expressions may use, AC1 first."""
+    if current.context.fa_depth > 0:
+        # AC3 is holding the fa variable
+        return [AC1, AC2, AC4]
+    return [AC1, AC2, AC4, AC3]
+
+def arithmetic(ast):
+    """Returns the instruction for ast if it's integer arithmetic, or None."""
+    if (ast.node_type == 'operator' and ast.ice9_type == 'int' and
+        len(ast.children) == 2):
+        return ARITHMETIC.get(ast.value)
+    return None
+
+def is_constant(ast):
+    return ast.node_type == 'literal' and ast.ice9_type in ('int', 'bool')
+
+def is_variable(ast):
+    return (ast.node_type == 'ident' and len(ast.children) == 0 and
+            not (type(ast.ice9_type) is tuple and ast.ice9_type[0] == "array"))
+
+def is_impure(ast):
+    """Returns whether ast itself calls a proc or reads input."""
+    if ast.node_type == 'proc_call' and ast.value != 'int':
+        return True
+    return ast.node_type == 'operator' and ast.value == 'read'
+
+def immediate_operand(opinst, left, right):
+    """
+    For x + c, c + x and x - c, where c is a constant, returns which operand
+    x is (0 or 1) and what to add to it. Otherwise returns None.
+    """
+    if opinst in ('ADD', 'SUB') and is_constant(right):
+        if opinst == 'ADD':
+            return 0, int(right.value)
+        return 0, - int(right.value)
+    elif opinst == 'ADD' and is_constant(left):
+        return 1, int(left.value)
+    return None
+
+def label_registers(ast):
+    """
+    Returns (registers needed to evaluate ast, whether it's pure (can't call
+    a proc or read input), labels of its left operand, labels of its right
+    operand). The operands' labels are None unless ast is arithmetic.
     
-    # we need to go back and add all our proc call jumps
-    realcode5 = []
-    for inst5 in code5:
-        inst, r, s, t, com = inst5
-        if inst == 'call':
-            procname = r
-            memloc = procs[procname]
-            realcode5.append(('LDC', PC, memloc, ZERO, com))
+    Every node under ast is labelled from its children's labels, keeping
+    its own stack, so expressions can be as deep as they like. Each node is
+    only labelled once, however many of the expressions around it are.
+    """
+    known = current.context.register_labels
+    # each node being labelled, and its children still to be labelled
+    stack = [(ast, iter(ast.children))]
+    while stack:
+        node, children = stack[-1]
+        for child in children:
+            if child not in known:
+                stack.append((child, iter(child.children)))
+                break
         else:
-            realcode5.append(inst5)
-            
-    code5 = realcode5
-    return code5
+            stack.pop()
+            known[node] = node_labels(node,
+                                      [known[c] for c in node.children])
+    return known[ast]
 
-# Binary operators ---------------------------------------------------------
-def binary_operator(opinst, ast):
+def node_labels(ast, children_labels):
+    """Labels ast, given the labels of each of its children."""
+    opinst = arithmetic(ast)
+    if opinst is not None:
+        return label_operands(opinst, ast, *children_labels)
+    elif is_constant(ast) or is_variable(ast):
+        return (1, True, None, None)
+    else:
+        pure = not is_impure(ast) and all(l[1] for l in children_labels)
+        return (ALL_REGISTERS, pure, None, None)
+
+def label_operands(opinst, ast, leftlabels, rightlabels):
+    """
+    Labels the operator opinst applied to the two operands of ast, which
+    are labelled leftlabels and rightlabels.
+    """
+    left, right = ast.children
+    
+    immediate = immediate_operand(opinst, left, right)
+    if immediate is not None:
+        need = (leftlabels, rightlabels)[immediate[0]][0]
+    elif leftlabels[0] == rightlabels[0]:
+        need = leftlabels[0] + 1
+    else:
+        need = max(leftlabels[0], rightlabels[0])
+    return (need, leftlabels[1] and rightlabels[1], leftlabels, rightlabels)
+
+def evaluate(ast, labels, reg, free):
+    """
+    Emits code leaving the value of ast in reg, using no registers other
+    than reg and those in free. labels are ast's, from label_registers.
+    """
+    opinst = arithmetic(ast)
+    if opinst is not None:
+        yield operate(opinst, ast, labels, reg, free)
+    elif is_constant(ast):
+        literal(ast, reg)
+    elif is_variable(ast):
+        yield ident(ast, reg)
+    else:
+        # this uses whatever registers it likes, so it's never evaluated
+        # while another value is being kept in one
+        yield code_for(ast)
+        if reg != AC1:
+            emit([('LDA', reg, 0, AC1, 'Move the result to reg %d' % reg)])
+
+def operate(opinst, ast, labels, reg, free):
     """
-    Generic binary operator handler. opinst should one of ADD, SUB, DIV or 
-    MUL. ast is the AST including the operator node.
+    Emits code leaving opinst applied to the two operands of ast in reg,
+    using no registers other than reg and those in free.
     """
     left, right = ast.children
+    need, pure, leftlabels, rightlabels = labels
     
-    # Store the result of the left operand on the stack.
-    code5  = generate_code(left)
-    code5 += push_register(AC1)
+    immediate = immediate_operand(opinst, left, right)
+    if immediate is not None:
+        i, value = immediate
+        yield evaluate(ast.children[i], labels[2 + i], reg, free)
+        emit([('LDA', reg, value, reg, 'Add %d' % value)])
+        return
     
-    # store value of right operand is in AC1
-    code5 += generate_code(right)
+    # evaluate the operand needing more registers first, unless that could
+    # change what either of them does
+    swap = (rightlabels[0] > leftlabels[0] and
+            (is_constant(left) or (leftlabels[1] and rightlabels[1])))
+    if swap:
+        first, firstlabels, second, secondlabels = right, rightlabels, left, leftlabels
+    else:
+        first, firstlabels, second, secondlabels = left, leftlabels, right, rightlabels
     
-    # Get the left value off the stack and put it in AC2
-    code5 += pop_register(AC2)
+    yield evaluate(first, firstlabels, reg, free)
+    other = free[0]
+    if secondlabels[0] <= len(free):
+        # there's room to keep the first operand in reg meanwhile
+        yield evaluate(second, secondlabels, other, free[1:])
+        left_in_reg = not swap
+    else:
+        # out of registers, so keep it on the stack
+        emit(push_register(reg))
+        yield evaluate(second, secondlabels, reg, free)
+        emit(pop_register(other))
+        left_in_reg = swap
     
-    # And add the two and store in AC1
-    code5 += [(opinst, AC1, AC2, AC1, '%s left and right.' % opinst)]
-    return code5
+    if left_in_reg:
+        emit([(opinst, reg, reg, other, '%s left and right.' % opinst)])
+    else:
+        emit([(opinst, reg, other, reg, '%s left and right.' % opinst)])
+
+def binary_operator(opinst, ast):
+    """
+    Generic binary operator handler. opinst should one of ADD, SUB, DIV or
+    MUL. ast is the AST including the operator node. The result is left in
+    AC1.
+    """
+    registers = expression_registers()
+    left, right = ast.children
+    labels = label_operands(opinst, ast, label_registers(left),
+                            label_registers(right))
+    yield operate(opinst, ast, labels, registers[0], registers[1:])
 
 def add(ast):
     """Handles integer addition and boolean OR."""
     if ast.ice9_type == 'int':
         # integer addition
-        return binary_operator('ADD', ast)
+        yield binary_operator('ADD', ast)
     else:
         assert ast.ice9_type == 'bool'
         # boolean OR
         left, right = ast.children
-        leftcode = generate_code(left)
-        rightcode = generate_code(right)
         
-        code5  = comment('boolean OR')
-        code5 += leftcode
-        code5 += [('JNE', AC1, code_length(rightcode), PC, 'short circuit boolean OR')]
-        code5 += rightcode
-        code5 += comment('end boolean OR')
-        return code5
+        shortcircuit = new_label()
+        emit(comment('boolean OR'))
+        yield code_for(left)
+        emit([('JNE', AC1, shortcircuit, PC, 'short circuit boolean OR')])
+        yield code_for(right)
+        emit(label(shortcircuit))
+        emit(comment('end boolean OR'))
 
 def mul(ast):
     """Handles integer multiplication and boolean AND."""
     if ast.ice9_type == 'int':
         # integer multiplication
-        return binary_operator('MUL', ast)
+        yield binary_operator('MUL', ast)
     else:
         # boolean AND
         assert ast.ice9_type == 'bool'
         left, right = ast.children
-        leftcode = generate_code(left)
-        rightcode = generate_code(right)
         
-        code5  = comment('boolean AND')
-        code5 += leftcode
-        code5 += [('JEQ', AC1, code_length(rightcode), PC, 'short circuit boolean AND')]
-        code5 += rightcode
-        code5 += comment('end boolean AND')
-        return code5
+        shortcircuit = new_label()
+        emit(comment('boolean AND'))
+        yield code_for(left)
+        emit([('JEQ', AC1, shortcircuit, PC, 'short circuit boolean AND')])
+        yield code_for(right)
+        emit(label(shortcircuit))
+        emit(comment('end boolean AND'))
 
 def div(ast):
     """Handles division."""
-    return binary_operator('DIV', ast)
+    yield binary_operator('DIV', ast)
 
 def sub(ast):
     """Handles both binary and unary subtraction."""
     if len(ast.children) == 1:
+        yield code_for(ast.children[0])
         if ast.ice9_type == 'int':
             # unary subtract, we really should just multiply by -1
-            return generate_code(ast.children[0]) + comment('integer negation:') + [
-                        ('LDC', AC2, -1, ZERO, 'Prepare to invert sign.'),
-                        ('MUL', AC1, AC1, AC2, 'Invert sign.')
-                    ]
+            emit(comment('integer negation:'))
+            emit([('LDC', AC2, -1, ZERO, 'Prepare to invert sign.'),
+                  ('MUL', AC1, AC1, AC2, 'Invert sign.')])
         else:
             # boolean negation
             assert ast.ice9_type == 'bool'
-            return generate_code(ast.children[0]) + comment('boolean negation:') + [
-                        ('LDC', AC2, -1, ZERO, 'Prepare invert sign.'),
-                        ('MUL', AC1, AC1, AC2, 'Invert sign.'),
-                        ('LDA', AC1, 1, AC1, 'Convert back to boolean.')
-                    ]
+            emit(comment('boolean negation:'))
+            emit([('LDC', AC2, -1, ZERO, 'Prepare invert sign.'),
+                  ('MUL', AC1, AC1, AC2, 'Invert sign.'),
+                  ('LDA', AC1, 1, AC1, 'Convert back to boolean.')])
     else:
         # integer subtraction
         assert len(ast.children) == 2, "Subtract should only have two nodes"
         assert ast.ice9_type == 'int', "Must be integer subtraction"
-        return binary_operator('SUB', ast)
+        yield binary_operator('SUB', ast)
 
 def modulus(modnode):
     # a % b = c => a - (a / b * b) = c
     left, right = modnode.children
-    leftcode, rightcode = generate_code(left), generate_code(right)
-    code5  = comment("Begin modulus")
-    code5 += leftcode
-    code5 += push_register(AC1, "Store left mod operand")
-    code5 += rightcode
-    code5 += pop_register(AC2, "Restore left mod operator")
-    code5 += push_register(AC4, "Store old AC4 for modulus calculation")
+    emit(comment("Begin modulus"))
+    yield code_for(left)
+    emit(push_register(AC1, "Store left mod operand"))
+    yield code_for(right)
+    emit(pop_register(AC2, "Restore left mod operator"))
+    emit(push_register(AC4, "Store old AC4 for modulus calculation"))
     # AC1 = b, AC2 = a
-    code5 += [('DIV', AC4, AC2, AC1, 'modcalc: a / b'),
-              ('MUL', AC4, AC1, AC4, 'modcalc: (a / b) * b'),
-              ('SUB', AC1, AC2, AC4, 'modcalc: c = a - ((a / b) * b)')]
-    code5 += pop_register(AC4, "Restore old AC4 after modulus calculation")
-    code5 += comment("End modulus")
-    return code5
+    emit([('DIV', AC4, AC2, AC1, 'modcalc: a / b'),
+          ('MUL', AC4, AC1, AC4, 'modcalc: (a / b) * b'),
+          ('SUB', AC1, AC2, AC4, 'modcalc: c = a - ((a / b) * b)')])
+    emit(pop_register(AC4, "Restore old AC4 after modulus calculation"))
+    emit(comment("End modulus"))
 
 def comparison(comparenode):
-    jumpinstrs = {'=': 'JEQ', '!=': 'JNE', 
-                  '>': 'JGT', '>=': 'JGE', 
+    jumpinstrs = {'=': 'JEQ', '!=': 'JNE',
+                  '>': 'JGT', '>=': 'JGE',
                   '<': 'JLT', '<=': 'JLE'}
     
     op = comparenode.value
     inst = jumpinstrs[op]
     
-    code5  = comment("BEGIN COMPARISON %s" % op)
-    code5 += binary_operator('SUB', comparenode)
-    code5 += [
+    emit(comment("BEGIN COMPARISON %s" % op))
+    yield binary_operator('SUB', comparenode)
+    emit([
         (inst, AC1, 2, PC, 'skip set to false'),
         ('LDC', AC1, 0, 0, 'comparison is bad, set reg 1 to false'),
         ('JEQ', ZERO, 1, PC, 'skip set to true'),
         ('LDC', AC1, 1, 0, 'compairson is good, set reg 1 to true'),
-    ]
-    code5 += comment("END COMPARISON %s" % op)
-    return code5
+    ])
+    emit(comment("END COMPARISON %s" % op))
 
 # end binary operators ------------------------------------------------------
 
@@ -407,78 +715,50 @@ def comparison(comparenode):
 def cond(ast):
     children = ast.children
     
-    code5 = []
+    end = new_label()
     
     while len(children) > 1:
         cond = children.pop(0)
         dothen = children.pop(0)
         
-        stmtcode = generate_code(dothen)
-        condcode = generate_code(cond)
-        
-        code5 += comment('IF condition:')
-        code5 += condcode
-        code5 += [('JEQ', AC1, code_length(stmtcode) + 1, PC, 'if false, jump to next cond')]
-        code5 += comment('IF was true, THEN:')
-        code5 += stmtcode
-        code5 += ['jumpend']
-        
-    if len(children) == 1:
-        stmtcode = generate_code(children.pop(0))
-        code5 += comment("ELSE:") + stmtcode
+        nextcond = new_label()
+        emit(comment('IF condition:'))
+        yield code_for(cond)
+        emit([('JEQ', AC1, nextcond, PC, 'if false, jump to next cond')])
+        emit(comment('IF was true, THEN:'))
+        yield code_for(dothen)
+        emit([('JEQ', ZERO, end, PC, 'jump to end of if-then-else')])
+        emit(label(nextcond))
     
-    # total number of instructions with comments excluded
-    codecount = code_length(code5)
-    
-    # need to go back and replace our jump labels with the real instruction offsets
-    realcode5 = []
-    i = 0
-    for inst5 in code5:
-        if inst5 == 'jumpend':
-            # label telling us to jump to the end of the statement
-            numleft = codecount - i - 1
-            realcode5.append(('JEQ', ZERO, numleft, PC, 'jump to end of if-then-else'))
-        else:
-            realcode5.append(inst5)
-        
-        if not is_comment(inst5):
-            i += 1
-
-    code5 = realcode5
+    if len(children) == 1:
+        emit(comment("ELSE:"))
+        yield code_for(children.pop(0))
     
-    return code5
+    emit(label(end))
 
 def do_loop(ast):
+    ctx = current.context
     cond, body = ast.children
-    condcode = generate_code(cond)
-    bodycode = generate_code(body)
-    
-    codelen = code_length(bodycode)
-    realbody = []
-    i = 0
-    for inst5 in bodycode:
-        inst, r, s, t, com = inst5
-        if inst == 'break':
-            realbody.append(('JEQ', ZERO, codelen - i, PC, 'break'))
-        else:
-            realbody.append(inst5)
-        if not is_comment(inst5):
-            i += 1
-    
-    code5  = comment('BEGIN DO COND')
-    code5 += condcode
-    code5 += [('JEQ', AC1, code_length(bodycode) + 1, PC, 'jump if do cond is false')]
-    code5 += comment('cond true, DO:')
-    code5 += realbody
-    code5 += [('JEQ', ZERO, -code_length(condcode + realbody) - 2, PC, 
-                      'End of DO, go back to beginning')]
+    start, end = new_label(), new_label()
     
-    return code5
+    emit(comment('BEGIN DO COND'))
+    emit(label(start))
+    yield code_for(cond)
+    emit([('JEQ', AC1, end, PC, 'jump if do cond is false')])
+    emit(comment('cond true, DO:'))
+    ctx.loop_ends.append(end)
+    yield code_for(body)
+    ctx.loop_ends.pop()
+    emit([('JEQ', ZERO, start, PC, 'End of DO, go back to beginning')])
+    emit(label(end))
 
 def for_loop(fornode):
-    variables.insert(0, {})
+    ctx = current.context
+    ctx.variables.enter()
+    ctx.types.enter()
+    ctx.fa_depth += 1
     
-    code5  = comment('BEGIN FA:')
+    emit(comment('BEGIN FA:'))
     
     if fornode.loopcount > 1:
         # we're in a nested for loop. Need to push the last fa variable onto
@@ -489,70 +769,61 @@ def for_loop(fornode):
             p = p.parent
         # p contains the last for loop
         outer_fa_varname = p.children[0].value
-        pmemloc = activation_record_size[0]
-        activation_record_size[0] += 1
+        pmemloc = ctx.activation_record_size[0]
+        ctx.activation_record_size[0] += 1
         
-        if len(activation_record_size) == 1: 
+        if len(ctx.activation_record_size) == 1:
             # global fa loop's go with global variables
             outervar = (pmemloc, ZERO)
-            code5 += [('data', 0, 0, 0, '%s initialization' % outer_fa_varname),
-                      ('ST', AC3, pmemloc, ZERO, 'storing fa variable %s in heap' % outer_fa_varname)]
+            emit([('data', 0, 0, 0, '%s initialization' % outer_fa_varname),
+                  ('ST', AC3, pmemloc, ZERO, 'storing fa variable %s in heap' % outer_fa_varname)])
         else:
             # proc fa loops go in the activation_record
-            code5 += comment('NESTED FA IN PROC, STORE LAST FA VAR ON THE STACK')
-            code5 += push_register(AC3, 'storing last for loop variable')
+            emit(comment('NESTED FA IN PROC, STORE LAST FA VAR ON THE STACK'))
+            emit(push_register(AC3, 'storing last for loop variable'))
             outervar = (pmemloc - 1, FP)
         
-        variables[0][outer_fa_varname] = outervar
+        ctx.variables.define(outer_fa_varname, outervar)
     
     var, lower, upper, body = fornode.children
     varname = var.value
-    variables[0][varname] = (0, AC3) # store the fa variable in AC3
+    ctx.variables.define(varname, (0, AC3)) # store the fa variable in AC3
+    ctx.types.define(varname, var.ice9_type)
     
-    code5 += generate_code(lower)
-    code5 += [('LDA', AC3, 0, AC1, 'Store the loop lower in AC3')]
+    top, check, end = new_label(), new_label(), new_label()
+    yield code_for(lower)
+    emit([('LDA', AC3, 0, AC1, 'Store the loop lower in AC3')])
+    emit([('JEQ', ZERO, check, PC, 'Skip body until we check upper bound')])
     
-    temp = generate_code(body)
-    bodycode  = comment('LOOP %s BODY:' % varname)
-    bodycode += temp
-    bodycode += [('LDA', AC3, 1, AC3, 'increment loop variable %s' % varname)]
-    bodycode += comment('END OF FA BODY')
+    emit(label(top))
+    emit(comment('LOOP %s BODY:' % varname))
+    ctx.loop_ends.append(end)
+    yield code_for(body)
+    ctx.loop_ends.pop()
+    emit([('LDA', AC3, 1, AC3, 'increment loop variable %s' % varname)])
+    emit(comment('END OF FA BODY'))
     
-    codelen = code_length(bodycode)
-    realbody = []
-    i = 0
-    for inst5 in bodycode:
-        inst, r, s, t, com = inst5
-        if inst == 'break':
-            realbody.append(('JEQ', ZERO, codelen - i + 2, PC, 'break'))
-        else:
-            realbody.append(inst5)
-        if not is_comment(inst5):
-            i += 1
-    
-    code5 += [('JEQ', ZERO, code_length(bodycode), PC, 'Skip body until we check upper bound')]
-    code5 += realbody
-    
-    uppercode = generate_code(upper)
-    code5 += uppercode
-    code5 += comment('LOADED FA UPPER VALUE INTO AC1')
-    jumpsize = code_length(uppercode + bodycode)
-    code5 += [('SUB', AC1, AC3, AC1, 'DIFFERENCE BETWEEN %s AND UPPER BOUND' % varname),
-              ('JLE', AC1, - jumpsize - 2, PC, 'FA REPEAT JUMP')]
-    code5 += comment('END FA')
+    emit(label(check))
+    yield code_for(upper)
+    emit(comment('LOADED FA UPPER VALUE INTO AC1'))
+    emit([('SUB', AC1, AC3, AC1, 'DIFFERENCE BETWEEN %s AND UPPER BOUND' % varname),
+          ('JLE', AC1, top, PC, 'FA REPEAT JUMP')])
+    emit(label(end))
+    emit(comment('END FA'))
     
     if fornode.loopcount > 1:
-        if len(activation_record_size) == 1:
+        if len(ctx.activation_record_size) == 1:
             # get the global var back off the heap
             pmemloc, relreg = outervar
-            code5 += [('LD', AC3, pmemloc, relreg, 'restore old loop var off heap')]
+            emit([('LD', AC3, pmemloc, relreg, 'restore old loop var off heap')])
         else:
             # get it off the stack
-            code5 += pop_register(AC3, "restore old for loop variable")
-        
+            emit(pop_register(AC3, "restore old for loop variable"))
+    
     # remove the variable stack
-    variables.pop(0)
-    return code5
+    ctx.variables.leave()
+    ctx.types.leave()
+    ctx.fa_depth -= 1
 
 # proc stuff ---------------------------------------------------------------
 
@@ -564,91 +835,98 @@ def for_loop(fornode):
 #       sp                    fp          fp + fpoffset           dmem
 
 def proc(procnode):
-    global variables, activation_record_size
-    variables.insert(0, {})
+    ctx = current.context
+    ctx.variables.enter()
+    ctx.types.enter()
     
     children = procnode.children
     procname = procnode.value
     body = children.pop(-1)
     
-    code5  = comment('BEGIN PROC %s' % procname)
-    code5 += [('LDA', FP, 0, SP, 'Set frame pointer')]
+    ctx.proc = procname
+    ctx.proc_end = new_label()
+    
+    emit(label(proc_label(procname)))
+    emit(comment('BEGIN PROC %s' % procname))
+    emit([('LDA', FP, 0, SP, 'Set frame pointer')])
     
     # set memory locations of local variables
     i = 0
     if procnode.ice9_type[1] != 'nil':
         i += 1
     for var, type9 in procnode.vars:
-        code5 += push_var(var, type9)
+        emit(push_var(var, type9))
         i += type9_size(type9)
-        variables[0][var] = (- i, FP)
+        ctx.variables.define(var, (- i, FP))
+        ctx.types.define(var, type9)
     
     # set memory locations of params
-    fpoffset = 1 
+    fpoffset = 1
     for p in children:
         paramname = p.value
         paramloc = fpoffset
-        variables[0][paramname] = (fpoffset, FP)
+        ctx.variables.define(paramname, (fpoffset, FP))
         fpoffset += 1
     
     # set location of return value
     if procnode.ice9_type[1] != 'nil':
         procnode.vars.insert(0, (procname, procnode.ice9_type[1]))
-        variables[0][procname] = (-1, FP)
+        ctx.variables.define(procname, (-1, FP))
+        ctx.types.define(procname, procnode.ice9_type[1])
     
-    activation_record_size.insert(0, i)
+    ctx.activation_record_size.insert(0, i)
     
     # generate code of proc
-    bodycode = generate_code(body)
-    bodylen = code_length(bodycode)
-    instno = 0
-    for i, inst5 in enumerate(bodycode):
-        if not is_comment(inst5):
-            instno += 1
-        if inst5[0] == "return":
-            bodycode[i] = ('JEQ', ZERO, bodylen - instno + 1, PC, 'early return in %s' % procname)
-        
-    code5 += bodycode
+    yield code_for(body)
+    emit(label(ctx.proc_end))
     
     if procnode.ice9_type != 'nil':
         # handle return value
-        code5 += [('LD', AC1, -1, FP, 'Store the return value in AC1')]
+        emit([('LD', AC1, -1, FP, 'Store the return value in AC1')])
     
-    code5 += pop_register(AC2, 'pop return address')
+    emit(pop_register(AC2, 'pop return address'))
     
-    code5 += [('LDA', SP, fpoffset, FP, 'Pop off local values from the stack')]
-    code5 += [('LD', PC, 0, FP, 'Moving return address into PC')]
-    code5 += comment('END PROC %s' % procname)
+    emit([('LDA', SP, fpoffset, FP, 'Pop off local values from the stack')])
+    emit([('LD', PC, 0, FP, 'Moving return address into PC')])
+    emit(comment('END PROC %s' % procname))
     
-    activation_record_size.pop(0)
-    variables.pop(0)
-    return code5
+    ctx.activation_record_size.pop(0)
+    ctx.variables.leave()
+    ctx.types.leave()
+    ctx.proc = ctx.proc_end = None
+
+def proc_label(procname):
+    """Returns the label at the start of the proc procname."""
+    ctx = current.context
+    if procname not in ctx.procs:
+        ctx.procs[procname] = new_label()
+    return ctx.procs[procname]
 
 def str_to_int(strnode):
-    code5  = comment("converting string to integer:")
-    code5 += passthru(strnode)
+    emit(comment("converting string to integer:"))
+    yield passthru(strnode)
     # okay, a pointer to the string should be in AC1
-    code5 += push_register(AC2)
-    code5 += push_register(AC4)
-    code5 += [('LDC', AC4, 0, 0, 'Start with a sum of 0'),
-              ('LD', AC2, 0, AC1, 'Load the next character into memory')]
-    
-    loop  = push_register(AC1)
-    loop += [('LDC', AC1, 10, 0, 'Prepare for multiply'),
-              ('MUL', AC4, AC4, AC1, 'sum = sum * 10')]
-    loop += pop_register(AC1)
-    loop += [('LDA', AC2, -ord("0"), AC2, "Subtract the ascii '0'"),
-             ('ADD', AC4, AC4, AC2, 'sum = sum + nextdigit'),
-             ('LDA', AC1, 1, AC1, 'increment string pointer'),
-             ('JEQ', ZERO, -code_length(loop) - 6, PC, 'Loop through rest of string')]
-    
-    code5 += [('JEQ', AC2, code_length(loop), PC, "Skip if we've hit the null terminator")]
-    code5 += loop
-    code5 += [('LDA', AC1, 0, AC4, 'Move the int value int AC1')]
-    code5 += pop_register(AC4)
-    code5 += pop_register(AC2)
-    
-    return code5
+    emit(push_register(AC2))
+    emit(push_register(AC4))
+    nextchar, done = new_label(), new_label()
+    emit([('LDC', AC4, 0, 0, 'Start with a sum of 0')])
+    emit(label(nextchar))
+    emit([('LD', AC2, 0, AC1, 'Load the next character into memory')])
+    emit([('JEQ', AC2, done, PC, "Skip if we've hit the null terminator")])
+    
+    emit(push_register(AC1))
+    emit([('LDC', AC1, 10, 0, 'Prepare for multiply'),
+          ('MUL', AC4, AC4, AC1, 'sum = sum * 10')])
+    emit(pop_register(AC1))
+    emit([('LDA', AC2, -ord("0"), AC2, "Subtract the ascii '0'"),
+          ('ADD', AC4, AC4, AC2, 'sum = sum + nextdigit'),
+          ('LDA', AC1, 1, AC1, 'increment string pointer')])
+    emit([('JEQ', ZERO, nextchar, PC, 'Loop through rest of string')])
+    emit(label(done))
+    
+    emit([('LDA', AC1, 0, AC4, 'Move the int value int AC1')])
+    emit(pop_register(AC4))
+    emit(pop_register(AC2))
 
 def proc_call(pcnode):
     # push the return address
@@ -656,30 +934,30 @@ def proc_call(pcnode):
     
     if procname == 'int':
         # special case
-        return str_to_int(pcnode)
+        yield str_to_int(pcnode)
+        return
     
-    code5  = comment('BEGIN PROC CALL %s' % procname)
+    emit(comment('BEGIN PROC CALL %s' % procname))
     for r in (AC2, AC3, AC4):
-        code5 += push_register(r, 'save registers before proc call')
+        emit(push_register(r, 'save registers before proc call'))
     
-    code5 += push_register(FP, 'store the frame pointer before the call')
+    emit(push_register(FP, 'store the frame pointer before the call'))
     
     params = pcnode.children # calling parameters
     params.reverse() # we want to push on in reverse so they'll be in order in mem
     for p in params:
-        code5 += generate_code(p)
-        code5 += push_register(AC1, 'push parameter %s' % p.value)
+        yield code_for(p)
+        emit(push_register(AC1, 'push parameter %s' % p.value))
     
-    code5 += [('LDA', AC2, 3, PC, 'Store return address in AC2')]
-    code5 += push_register(AC2, 'store the return address')
-    code5 += [('call', procname, 0, 0, 'CALL %s' % procname)]
-    code5 += pop_register(FP, 'pop the frame pointer after call')
+    emit([('LDA', AC2, 3, PC, 'Store return address in AC2')])
+    emit(push_register(AC2, 'store the return address'))
+    emit([('LDC', PC, proc_label(procname), ZERO, 'CALL %s' % procname)])
+    emit(pop_register(FP, 'pop the frame pointer after call'))
     
     for r in (AC4, AC3, AC2):
-        code5 += pop_register(r, 'remember registers from before proc call')
+        emit(pop_register(r, 'remember registers from before proc call'))
     
-    code5 += comment('END PROC CALL %s' % procname)
-    return code5
+    emit(comment('END PROC CALL %s' % procname))
 
 # core algorithm ---------------------------------------------------------
 
@@ -715,24 +993,33 @@ callbacks = {
     'read': read,
 }
 
-def generate_code(ast):
-    """
-    Generates a list of 5-tuples describing instructions for TM code of the form
-        (inst, r, s, t, comment)
-    """
-    def noop(ast):
-        # returns empty code
-        return comment('NOOP')
-    
-    code5 = []
+def noop(ast):
+    # generates empty code
+    emit(comment('NOOP'))
+
+def code_for(ast):
+    """Returns the rule generating ast's code, for run() or a rule to yield."""
     if ast.node_type == 'operator':
         cb = callbacks.get(ast.value, noop)
     else:
         cb = callbacks.get(ast.node_type, noop)
     
-    # code 5 because callbacks return 5-tuples.
-    setattr(ast, 'code5', cb(ast)) 
-    return ast.code5
+    result = cb(ast)
+    if type(result) is GeneratorType:
+        return result
+    # the callback didn't need to generate code for any other node, so it
+    # has already finished
+    return done(result)
+
+def generate_code(ast):
+    """
+    Generates TM code for ast onto the end of the code being generated. Code
+    is a list of 5-tuples describing instructions of the form
+        (inst, r, s, t, comment)
+    and generating a whole program returns all of its code, with labels for
+    assemble to resolve.
+    """
+    return run(code_for(ast))
 
 # STRING OUTPUT ------------------------------------------------------------
 
@@ -760,9 +1047,9 @@ def code5str(code5):
             output.append('.DATA  \t\t0\t\t\t* null terminator')
         else:
             raise ValueError("Can't print this instruction: %s" % inst)
-
+    
     return "\n".join(output) + "\n"
 
 def generate_code_str(ast):
     """Shorthand for creating the TM string code for the ast."""
-    return code5str(generate_code(ast))
+    return code5str(assemble(generate_code(ast)))
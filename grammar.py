@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+
+"""
+Reads the predictive grammar in grammar.txt and computes its FIRST and
+FOLLOW sets, so the parser can decide which rule to expand by looking at
+a single token.
+
+Terminals are represented as pairs: ('value', 'if') matches a token by its
+text, and ('type', 'ident') matches any token of that type.
+"""
+
+import os
+import re
+
+GRAMMAR_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'grammar.txt')
+
+# rules in grammar.txt which are really token types from the lexer
+TOKEN_TYPES = {
+    'id': 'ident',
+    'int': 'int',
+    'string': 'str',
+}
+
+# grammar.txt isn't completely consistent with its capitalization
+ALIASES = {
+    'exp': 'expr',
+}
+
+GRAMMAR_TOKEN = re.compile(r"'[^']*'|[{}|]|[A-Za-z_][A-Za-z0-9_]*")
+
+def read_rules(text):
+    """
+    Returns a dictionary of rule name -> list of alternatives, where each
+    alternative is a list of items:
+        ('terminal', (kind, text))
+        ('rule', name)
+        ('repeat', alternatives)     for { ... }
+    Rule names are lowercased.
+    """
+    definitions = []
+    for line in text.split('\n'):
+        line = line.split('#')[0].rstrip()
+        if not line.strip():
+            continue
+        if '->' in line and not line[0].isspace():
+            name, body = line.split('->', 1)
+            definitions.append([name.strip().lower(), body])
+        else:
+            # continuation of the last rule
+            definitions[-1][1] += ' ' + line
+    
+    rules = {}
+    for name, body in definitions:
+        if name in TOKEN_TYPES:
+            continue
+        tokens = GRAMMAR_TOKEN.findall(body)
+        alternatives, rest = _read_alternatives(tokens)
+        assert not rest, 'trailing junk in rule %s' % name
+        rules[name] = alternatives
+    return rules
+
+def _read_alternatives(tokens):
+    """Reads alternatives until the end of tokens or an unmatched '}'."""
+    alternatives = [[]]
+    while tokens and tokens[0] != '}':
+        tok = tokens.pop(0)
+        if tok == '|':
+            alternatives.append([])
+        elif tok == '{':
+            inner, tokens = _read_alternatives(tokens)
+            assert tokens and tokens[0] == '}', 'unclosed {'
+            tokens.pop(0)
+            alternatives[-1].append(('repeat', inner))
+        elif tok.startswith("'"):
+            alternatives[-1].append(('terminal', ('value', tok[1:-1])))
+        elif tok in TOKEN_TYPES:
+            alternatives[-1].append(('terminal', ('type', TOKEN_TYPES[tok])))
+        else:
+            tok = tok.lower()
+            alternatives[-1].append(('rule', ALIASES.get(tok, tok)))
+    return alternatives, tokens
+
+# FIRST and FOLLOW computation --------------------------------------------
+
+def _first_of_sequence(items, first, nullable):
+    """Returns (FIRST, nullable) of a sequence of items."""
+    result = set()
+    for kind, value in items:
+        if kind == 'terminal':
+            result.add(value)
+            return result, False
+        elif kind == 'rule':
+            result |= first[value]
+            if not nullable[value]:
+                return result, False
+        elif kind == 'repeat':
+            for alternative in value:
+                result |= _first_of_sequence(alternative, first, nullable)[0]
+    return result, True
+
+def compute_first(rules):
+    """Returns (FIRST, NULLABLE) dictionaries for every rule."""
+    first = dict((name, set()) for name in rules)
+    nullable = dict((name, False) for name in rules)
+    
+    changed = True
+    while changed:
+        changed = False
+        for name, alternatives in rules.iteritems():
+            for alternative in alternatives:
+                f, n = _first_of_sequence(alternative, first, nullable)
+                if not f <= first[name]:
+                    first[name] |= f
+                    changed = True
+                if n and not nullable[name]:
+                    nullable[name] = True
+                    changed = True
+    return first, nullable
+
+def _follow_sequence(items, trailer, first, nullable, follow):
+    """
+    Adds to FOLLOW for every rule in items, given that trailer can follow
+    the whole sequence. Returns whether anything changed.
+    """
+    changed = False
+    trailer = set(trailer)
+    for kind, value in reversed(items):
+        if kind == 'terminal':
+            trailer = set([value])
+        elif kind == 'rule':
+            if not trailer <= follow[value]:
+                follow[value] |= trailer
+                changed = True
+            if nullable[value]:
+                trailer = trailer | first[value]
+            else:
+                trailer = set(first[value])
+        elif kind == 'repeat':
+            # a repetition can be followed by itself or whatever comes next
+            repeat_first = _first_of_sequence([(kind, value)], first, nullable)[0]
+            inner_trailer = repeat_first | trailer
+            for alternative in value:
+                if _follow_sequence(alternative, inner_trailer, first,
+                                    nullable, follow):
+                    changed = True
+            trailer = inner_trailer
+    return changed
+
+def compute_follow(rules, first, nullable, start='program'):
+    """Returns the FOLLOW dictionary for every rule."""
+    follow = dict((name, set()) for name in rules)
+    follow[start].add(('type', 'EOF'))
+    
+    changed = True
+    while changed:
+        changed = False
+        for name, alternatives in rules.iteritems():
+            for alternative in alternatives:
+                if _follow_sequence(alternative, follow[name], first,
+                                    nullable, follow):
+                    changed = True
+    return follow
+
+def lookahead_sets(terminals):
+    """
+    Splits a set of terminals into (token values, token types), for quickly
+    testing a token against them.
+    """
+    values = frozenset([text for kind, text in terminals if kind == 'value'])
+    types = frozenset([text for kind, text in terminals if kind == 'type'])
+    return values, types
+
+RULES = read_rules(open(GRAMMAR_FILE).read())
+FIRST, NULLABLE = compute_first(RULES)
+FOLLOW = compute_follow(RULES, FIRST, NULLABLE)
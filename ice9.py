@@ -1,5 +1,13 @@
 #!/usr/bin/env python
+import os
 import sys
+import time
+
+# Whether run_pass resets the process's peak memory when each pass starts.
+# That changes what every thread in the process sees as its peak, so it's
+# off unless the command line was asked to report memory (--mem-passes or
+# --pass-stats).
+RESET_PEAK_MEMORY = False
 
 class Ice9Error(Exception):
     line = 1
@@ -12,40 +20,435 @@ class Ice9Error(Exception):
     def __str__(self):
         return "line %d: %s" % (self.line, str(self.error))
 
-def compile(source, optimize=True):
-    from parser import parse
+def count_nodes(ast):
+    # counted as they're walked, so counting doesn't raise the peak memory
+    # the pass is reported with
+    return sum(1 for node in ast.prefix_iter())
+
+def count_lines(output):
+    if output is None:
+        return 0
+    return output.count("\n")
+
+def peak_memory():
+    """This process's peak resident memory so far, in kilobytes."""
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def memory_status(field):
+    """
+    Returns the given field (VmRSS, VmHWM...) of /proc/self/status, in
+    kilobytes.
+    """
+    for line in open('/proc/self/status'):
+        name, value = line.split(':', 1)
+        if name == field:
+            return int(value.split()[0])
+    raise ValueError("no %s in /proc/self/status" % field)
+
+def reset_peak_memory():
+    """
+    Starts this process's peak resident memory afresh from what it's using
+    now, and returns that in kilobytes. Only Linux can do this; elsewhere
+    nothing is reset and None is returned.
+    
+    The peak belongs to the whole process, not the caller: anything else
+    in it that reads its own peak (another compile in a batch or server
+    thread, or a program embedding the compiler) sees it reset too.
+    """
+    try:
+        f = open('/proc/self/clear_refs', 'w')
+        try:
+            f.write('5')
+        finally:
+            f.close()
+        return memory_status('VmRSS')
+    except (IOError, ValueError):
+        return None
+
+def pass_peak_memory(start_memory):
+    """
+    Returns how far above start_memory, from reset_peak_memory, this
+    process's peak resident memory has gone since, in kilobytes.
+    """
+    return max(memory_status('VmHWM') - start_memory, 0)
+
+def run_pass(stats, name, unit, size, fn, *args):
+    """
+    Runs the compiler pass fn(*args) and returns its result.
+    
+    If stats is a list, a dict describing the pass is appended to it: its
+    name, how long it took, how far (in kilobytes) the process's memory
+    went above what it was using when the pass started, and how many units
+    (tokens, nodes, instructions...) its result has, as counted by size.
+    The dicts only hold strings and numbers, so they can be saved as they
+    are with json.
+    
+    If RESET_PEAK_MEMORY is set, the peak is measured by resetting the
+    process's peak memory when the pass starts (see reset_peak_memory), so
+    anything else running in other threads meanwhile is counted too.
+    Otherwise, or where that can't be done (anywhere but Linux), it's only
+    how far the pass pushed up the process's peak so far, which is 0 for
+    any pass that stays under an earlier one.
+    """
+    if stats is None:
+        return fn(*args)
+    
+    if RESET_PEAK_MEMORY:
+        start_memory = reset_peak_memory()
+    else:
+        start_memory = None
+    if start_memory is None:
+        memory = peak_memory()
+    start = time.time()
+    result = fn(*args)
+    seconds = time.time() - start
+    if start_memory is None:
+        peak = peak_memory() - memory
+    else:
+        peak = pass_peak_memory(start_memory)
+    stats.append({'pass': name,
+                  'seconds': seconds,
+                  'peak_memory_kb': peak,
+                  'size': size(result),
+                  'unit': unit})
+    return result
+
+def print_pass_stats(stats, times=True, memory=True, out=sys.stderr):
+    """Prints a table of the stats gathered by run_pass."""
+    for s in stats:
+        line = "%-16s" % s['pass']
+        if times:
+            line += " %9.4fs" % s['seconds']
+        if memory:
+            line += " %9d KB peak" % s['peak_memory_kb']
+        out.write(line + " %9d %s\n" % (s['size'], s['unit']))
+    if times:
+        out.write("%-16s %9.4fs\n" % ('total',
+                                       sum([s['seconds'] for s in stats])))
+
+def parse_source(source, direct_ast=True, arena=False, stats=None):
+    """
+    Runs the front end over source, returning its AST. With direct_ast,
+    the AST is built while parsing instead of from a full parse tree; only
+    that parser can take programs nested arbitrarily deep. With arena, it's
+    also stored in an arena.ASTArena rather than in Trees.
+    
+    If stats is a list, each pass's stats are added to it (see run_pass).
+    """
+    from lexer import lex_tokens
+    tokens = run_pass(stats, 'lex', 'tokens', len, list, lex_tokens(source))
+    
+    if arena:
+        from astparser import parse_tokens_ast
+        from arena import ASTArena
+        return run_pass(stats, 'parse', 'nodes', count_nodes,
+                        parse_tokens_ast, tokens, ASTArena())
+    
+    if direct_ast:
+        from astparser import parse_tokens_ast
+        return run_pass(stats, 'parse', 'nodes', count_nodes,
+                        parse_tokens_ast, tokens)
+    
+    from parser import parse_tokens
     from ast import parse2ast
+    tree = run_pass(stats, 'parse', 'nodes', count_nodes, parse_tokens, tokens)
+    return run_pass(stats, 'parse2ast', 'nodes', count_nodes, parse2ast, tree)
+
+def compile(source, optimize=True, direct_ast=True, arena=False,
+            all_errors=False, stats=None, cache=None):
+    """
+    Compiles source to TM code. If stats is a list, each pass's stats are
+    added to it (see run_pass). If cache is a cache.CompileCache, the
+    program is only compiled if it isn't already in the cache.
+    """
+    if cache is not None:
+        key = cache.key(source, optimize)
+        compiled = run_pass(stats, 'cache', 'lines', count_lines,
+                            cache.get, key)
+        if compiled is not None:
+            return compiled
+        compiled = compile(source, optimize, direct_ast, arena, all_errors,
+                           stats)
+        cache.put(key, compiled)
+        return compiled
+    
     from semantic import check_semantics
-    from codegenerator import generate_code, code5str
+    from codegenerator import generate_code, assemble, code5str, code_length
     
-    ast = check_semantics(parse2ast(parse(source)))
+    ast = parse_source(source, direct_ast, arena, stats)
+    ast = run_pass(stats, 'semantics', 'nodes', count_nodes,
+                   check_semantics, ast, all_errors)
     if optimize:
         from astoptimizer import optimize_ast
-        optimize_ast(ast)
+        run_pass(stats, 'optimize_ast', 'nodes', lambda r: count_nodes(ast),
+                 optimize_ast, ast)
     
-    code = generate_code(ast)
+    code = run_pass(stats, 'codegen', 'instructions', code_length,
+                    generate_code, ast)
     if optimize:
         import optimizer
-        code = optimizer.optimize(code)
+        code = run_pass(stats, 'optimize', 'instructions', code_length,
+                        optimizer.optimize, code)
+    code = run_pass(stats, 'assemble', 'instructions', code_length,
+                    assemble, code)
     
-    return code5str(code)
+    return run_pass(stats, 'code5str', 'lines', count_lines, code5str, code)
 
-def main(*args):
+def save_pass_stats(stats, filename):
+    """Saves the stats gathered by run_pass to filename as JSON."""
+    try:
+        import json
+    except ImportError:
+        import simplejson as json
+    
+    f = open(filename, 'w')
+    json.dump(stats, f, indent=2)
+    f.close()
+
+def profile_compile(filename, top, *args):
+    """
+    Runs compile(*args) under cProfile and returns its result. The profile
+    is saved to filename, for pstats, and its top functions by time spent
+    in them are printed to stderr.
+    """
+    import cProfile
+    import pstats
+    
+    profiler = cProfile.Profile()
+    try:
+        return profiler.runcall(compile, *args)
+    finally:
+        # save what we have, even if the compile failed
+        profiler.dump_stats(filename)
+        stats = pstats.Stats(filename, stream=sys.stderr)
+        stats.sort_stats('time').print_stats(top)
+
+def compile_errors():
+    """
+    Returns the exceptions compile raises for a program that doesn't
+    compile. Importing them loads the compiler, so callers only ask once
+    something has been raised; a cache hit never loads it.
+    """
     from parser import Ice9SyntaxError
     from lexer import Ice9LexicalError
     from semantic import Ice9SemanticError
+    return (Ice9Error, Ice9LexicalError, Ice9SyntaxError, Ice9SemanticError)
+
+def compile_file(job):
+    """
+    Compiles the file job[0] into job[1], with job[2] the keyword arguments
+    for compile. Returns the error message if it doesn't compile, or None.
+    """
+    infile, outfile, options = job
+    try:
+        compiled = compile(open(infile).read(), **options)
+        f = open(outfile, 'w')
+        f.write(compiled)
+        f.close()
+    except EnvironmentError, e:
+        return str(e)
+    except Exception, e:
+        if isinstance(e, compile_errors()):
+            return str(e)
+        # a bug in the compiler shouldn't stop the rest of the batch
+        import traceback
+        return "internal compiler error:\n" + traceback.format_exc()
+    
+    return None
+
+def compile_batch(files, processes=None, **options):
+    """
+    Compiles each (input file, output file) pair in files, spread over a
+    pool of processes (one per core by default), passing options on to
+    compile. Yields (input file, error message or None) pairs as each file
+    is done, in the order they were given.
+    """
+    jobs = [(infile, outfile, options) for infile, outfile in files]
+    if processes == 1 or len(jobs) < 2:
+        for job in jobs:
+            yield job[0], compile_file(job)
+        return
+    
+    from itertools import izip
+    from multiprocessing import Pool
+    pool = Pool(processes)
+    try:
+        for job, error in izip(jobs, pool.imap(compile_file, jobs)):
+            yield job[0], error
+    finally:
+        pool.terminate()
+        pool.join()
+
+def read_manifest(filename):
+    """
+    Reads a batch manifest: one file to compile per line, each followed by
+    the file to write it to. Without one, a.9 is compiled to a.tm. Blank
+    lines and lines starting with # are skipped.
+    """
+    files = []
+    for line in open(filename):
+        words = line.split()
+        if not words or words[0].startswith('#'):
+            continue
+        if len(words) == 1:
+            words.append(os.path.splitext(words[0])[0] + '.tm')
+        files.append((words[0], words[1]))
+    return files
+
+def main_batch(files, processes, options):
+    """
+    Compiles a batch of files, reporting each error on stderr. Exits with
+    status 0 if every file compiled, and 1 otherwise.
+    """
+    failed = 0
+    for infile, error in compile_batch(files, processes, **options):
+        if error is not None:
+            failed += 1
+            sys.stderr.write("%s: %s\n" % (infile, error))
     
+    if failed:
+        sys.stderr.write("%d of %d files failed to compile\n" %
+                         (failed, len(files)))
+        sys.exit(1)
+    sys.exit(0)
+
+def usage_error(message):
+    """Reports a mistake in the command line, and exits with status 2."""
+    sys.stderr.write(message + "\n")
+    sys.exit(2)
+
+def main(*args):
+    global RESET_PEAK_MEMORY
     optimize = True
-    for i, a in enumerate(args):
+    direct_ast = True
+    arena = False
+    all_errors = False
+    time_passes = False
+    mem_passes = False
+    stats_file = None
+    profile_file = None
+    profile_top = 20
+    batch = False
+    manifest = None
+    processes = None
+    server = None
+    connect = None
+    cache_dir = None
+    cache_size = None
+    flags = [a for a in args if a in ('-o', '-s', '-d', '-p', '-a', '-e',
+                                      '--time-passes', '--mem-passes',
+                                      '--batch') or
+                                a.startswith('--pass-stats=') or
+                                a.startswith('--profile') or
+                                a.startswith('--manifest=') or
+                                a.startswith('--jobs=') or
+                                a.startswith('--server=') or
+                                a.startswith('--connect=') or
+                                a == '--cache' or
+                                a.startswith('--cache=') or
+                                a.startswith('--cache-size=')]
+    args = [a for a in args if a not in flags]
+    for a in flags:
         if a == '-o':
             optimize = True
-            args = args[:i] + args[i+1:]
-            break
         elif a == '-s':
             optimize = False
-            args = args[:i] + args[i+1:]
-            break
+        elif a == '-d':
+            direct_ast = True
+        elif a == '-p':
+            direct_ast = False
+        elif a == '-a':
+            arena = True
+        elif a == '-e':
+            all_errors = True
+        elif a == '--time-passes':
+            time_passes = True
+        elif a == '--mem-passes':
+            mem_passes = True
+        elif a.startswith('--pass-stats='):
+            stats_file = a[len('--pass-stats='):]
+        elif a.startswith('--profile-top='):
+            try:
+                profile_top = int(a[len('--profile-top='):])
+            except ValueError:
+                profile_top = -1
+            if profile_top < 0:
+                usage_error("--profile-top must be a number of functions")
+        elif a == '--profile':
+            profile_file = 'ice9.pstats'
+        elif a.startswith('--profile='):
+            profile_file = a[len('--profile='):]
+        elif a == '--batch':
+            batch = True
+        elif a.startswith('--manifest='):
+            manifest = a[len('--manifest='):]
+        elif a.startswith('--jobs='):
+            try:
+                processes = int(a[len('--jobs='):])
+            except ValueError:
+                processes = 0
+            if processes < 1:
+                usage_error("--jobs must be a number of processes")
+        elif a.startswith('--server='):
+            server = a[len('--server='):]
+        elif a.startswith('--connect='):
+            connect = a[len('--connect='):]
+        elif a == '--cache' or a == '--cache=':
+            usage_error("--cache needs a directory: --cache=DIR")
+        elif a.startswith('--cache='):
+            cache_dir = a[len('--cache='):]
+        elif a.startswith('--cache-size='):
+            # in megabytes
+            try:
+                cache_size = int(float(a[len('--cache-size='):]) * 1024 * 1024)
+            except (ValueError, OverflowError):
+                cache_size = -1
+            if cache_size < 0:
+                usage_error("--cache-size must be a number of megabytes")
+    
+    if cache_size is not None and cache_dir is None:
+        usage_error("--cache-size needs a cache: --cache=DIR")
+    
+    if cache_dir:
+        from cache import CompileCache
+        if cache_size is None:
+            cache = CompileCache(cache_dir)
+        else:
+            cache = CompileCache(cache_dir, cache_size)
+    else:
+        cache = None
+    
+    if server:
+        import socket
+        from server import serve
+        try:
+            serve(server, cache)
+        except socket.error, e:
+            sys.stderr.write("can't serve on %s: %s\n" % (server, e))
+            sys.exit(1)
+        sys.exit(0)
+    
+    if batch or manifest:
+        files = zip(args[0::2], args[1::2])
+        if len(args) % 2:
+            sys.stderr.write("--batch needs an output file for %s\n" %
+                             args[-1])
+            sys.exit(2)
+        if manifest:
+            files += read_manifest(manifest)
+        main_batch(files, processes, {'optimize': optimize,
+                                      'direct_ast': direct_ast,
+                                      'arena': arena,
+                                      'all_errors': all_errors,
+                                      'cache': cache})
     
+    if time_passes or mem_passes or stats_file:
+        stats = []
+    else:
+        stats = None
+    # only this process's own compile is running, so its peak can be reset
+    RESET_PEAK_MEMORY = mem_passes or bool(stats_file)
     
     if len(args) == 0:
         sourcefile = sys.stdin
@@ -59,16 +462,49 @@ def main(*args):
     
     source = sourcefile.read()
     
-    try:
-        # try to parse the source and exit cleanly
-        compiled = compile(source, optimize)
-        outfile.write(compiled)
-        outfile.close()
-        sys.exit(0)
-    except (Ice9Error, Ice9LexicalError, Ice9SyntaxError, Ice9SemanticError), e:
-        # but if there's an error, print it out and exit.
-        sys.stderr.write(str(e) + "\n")
+    if connect:
+        # let a compile server do the work; this doesn't import the compiler
+        import socket
+        from server import request
+        compile_flags = [a for a in flags if a in ('-o', '-s', '-d', '-p',
+                                                   '-a', '-e')]
+        try:
+            compiled, output = request(connect, source, compile_flags)
+        except (socket.error, EOFError, ValueError), e:
+            sys.stderr.write("can't reach the compile server on %s: %s\n"
+                             % (connect, e))
+            sys.exit(1)
+        if compiled:
+            outfile.write(output)
+            outfile.close()
+            sys.exit(0)
+        sys.stderr.write(output + "\n")
         sys.exit(1)
+    
+    try:
+        try:
+            # try to parse the source and exit cleanly
+            args = (source, optimize, direct_ast, arena, all_errors, stats,
+                    cache)
+            if profile_file:
+                compiled = profile_compile(profile_file, profile_top, *args)
+            else:
+                compiled = compile(*args)
+            outfile.write(compiled)
+            outfile.close()
+            sys.exit(0)
+        except Exception, e:
+            if not isinstance(e, compile_errors()):
+                raise
+            # but if there's an error, print it out and exit.
+            sys.stderr.write(str(e) + "\n")
+            sys.exit(1)
+    finally:
+        # report on the passes that finished, even if a later one failed
+        if time_passes or mem_passes:
+            print_pass_stats(stats, time_passes, mem_passes)
+        if stats_file:
+            save_pass_stats(stats, stats_file)
 
 if __name__ == '__main__':
     main(*sys.argv[1:])
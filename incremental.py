@@ -0,0 +1,442 @@
+#!/usr/bin/env python
+
+"""
+Incremental re-lexing and re-parsing, for editors that reparse on every
+keystroke.
+
+Tokens never span lines, so after an edit only the lines it touches are
+lexed again. The parse tree records how many tokens each rule expansion
+covered (its ntokens), which lets us find the statements or procs the
+damaged tokens fall in and parse just those again. If the smallest
+enclosing statements don't parse cleanly on their own, we keep widening
+the region, and fall back to a full parse at the root.
+
+Nothing outside the damaged region is walked. The statements are found by
+binary search over where each node's children start, and the tokens and
+nodes after the edit aren't renumbered when it adds or removes lines; both
+of those are shifted lazily (see Shifts). Only the source and the token
+list are copied, which doesn't take long even for very large files.
+"""
+
+from bisect import bisect_left, bisect_right
+
+from lexer import scan_source, lex_tokens, Ice9LexicalError
+from parser import TokenStream, Ice9SyntaxError, parse_tokens, stm, proc
+
+# rules which may be reparsed on their own, along with the rule that
+# parses one of them. Both only appear in repetitions, so a damaged run
+# of them can be replaced by any number of new ones.
+REPARSE_RULES = {
+    'stm': stm,
+    'proc': proc,
+}
+
+def node_length(node):
+    """Returns the number of tokens node covers."""
+    if node.node_type == 'token':
+        return 1
+    return node.ntokens
+
+class Shifts(object):
+    """
+    Deltas waiting to be added to every item of a list from some index on.
+    Adding one costs as much as there are deltas, rather than as much as
+    the list is long, and so does finding an item's total. Whoever keeps
+    them applies them all once there are more than the square root of the
+    list's length, which keeps both costs down to that too.
+    """
+    
+    def __init__(self):
+        # sorted, and only one delta for each index
+        self.indexes = []
+        self.deltas = []
+    
+    def __len__(self):
+        return len(self.indexes)
+    
+    def total(self, k):
+        """Returns the sum of the deltas for item k."""
+        return sum(self.deltas[:bisect_right(self.indexes, k)])
+    
+    def totals(self, length):
+        """Returns the sum of the deltas for each of the first length items."""
+        totals = []
+        total = 0
+        for index, delta in zip(self.indexes, self.deltas):
+            totals.extend([total] * (min(index, length) - len(totals)))
+            total += delta
+        totals.extend([total] * (length - len(totals)))
+        return totals
+    
+    def add(self, index, delta):
+        """Adds delta to every item from index on."""
+        if delta == 0:
+            return
+        n = bisect_left(self.indexes, index)
+        if n < len(self.indexes) and self.indexes[n] == index:
+            self.deltas[n] += delta
+        else:
+            self.indexes.insert(n, index)
+            self.deltas.insert(n, delta)
+    
+    def replace(self, start, end, count):
+        """
+        Notes that items [start, end) of the list were replaced by count new
+        ones. The new items get total(start), so should be stored less it;
+        those after them keep the total they had.
+        """
+        n = bisect_right(self.indexes, start)
+        m = bisect_right(self.indexes, end)
+        moved = sum(self.deltas[n:m])
+        shift = count - (end - start)
+        later = zip([index + shift for index in self.indexes[m:]],
+                    self.deltas[m:])
+        
+        del self.indexes[n:]
+        del self.deltas[n:]
+        self.add(start + count, moved)
+        for index, delta in later:
+            self.indexes.append(index)
+            self.deltas.append(delta)
+
+class IncrementalParse(object):
+    """
+    A source file, along with its tokens and parse tree, which edit keeps
+    up to date. The tokens and tree attributes are what a full parse of
+    the source would give.
+    
+    An edit which raises still changes the source, as it would in an
+    editor, but may leave the tokens and tree half updated. Until an edit
+    parses again, each one lexes and parses the whole source from scratch.
+    """
+    
+    def __init__(self, source):
+        self.source = source
+        self._parse()
+    
+    def _parse(self):
+        """Lexes and parses the whole source from scratch."""
+        self._broken = True
+        self._tokens = list(lex_tokens(self.source))
+        self._tree = parse_tokens(self._tokens)
+        
+        # Line deltas for the tokens, and so for the nodes, since a node's
+        # line is the line of the token it starts at. Operators are the
+        # exception, but an expression is always inside one statement, and
+        # every token in a statement gets the same delta (see _settle_lines).
+        self._lines = Shifts()
+        
+        # For each rule expansion we've searched through, where each of its
+        # children starts relative to it, and the Shifts for those. Others
+        # are worked out when they're first needed (see _child_offsets).
+        self._offsets = {}
+        self._broken = False
+    
+    @property
+    def tokens(self):
+        if self._broken:
+            self._parse()
+        self._renumber_lines()
+        return self._tokens
+    
+    @property
+    def tree(self):
+        if self._broken:
+            self._parse()
+        self._renumber_lines()
+        return self._tree
+    
+    def edit(self, start, end, text):
+        """
+        Applies the edit source[start:end] = text, updating the tokens and
+        parse tree in place.
+        
+        Raises the same errors a full parse would.
+        """
+        source = self.source
+        if self._broken:
+            self.source = source[:start] + text + source[end:]
+            self._parse()
+            return
+        try:
+            self._edit(start, end, text)
+        except (Ice9LexicalError, Ice9SyntaxError):
+            self.source = source[:start] + text + source[end:]
+            self._broken = True
+            raise
+    
+    def _edit(self, start, end, text):
+        """Applies an edit to a source which last parsed cleanly."""
+        i, nold, nnew = self._relex(start, end, text)
+        delta = nnew - nold
+        
+        path = self._damaged_path(i, i + nold)
+        while len(path) > 1:
+            node, offset, index = path[-1]
+            run = self._damaged_run(node, offset, i, i + nold)
+            if run is not None:
+                first, last, run_start, run_end = run
+                rulename = node.children[first].value
+                self._settle_lines(run_start, run_end + delta)
+                new_nodes = _reparse_run(self._tokens, rulename, run_start,
+                                         run_end + delta)
+                if new_nodes is not None and (new_nodes or
+                                              node.value != 'stms' or
+                                              last - first < len(node.children)):
+                    break
+            path.pop()
+        else:
+            # we had to go all the way back up to the root
+            self._renumber_tokens()
+            self._offsets = {}
+            self._tree = parse_tokens(self._tokens)
+            return
+        
+        starts, shifts = self._offsets[node]
+        shifts.replace(first, last, len(new_nodes))
+        new_start = run_start - offset - shifts.total(first)
+        new_starts = []
+        for n in new_nodes:
+            n.parent = node
+            new_starts.append(new_start)
+            new_start += node_length(n)
+        
+        for c in node.children[first:last]:
+            for n in c.prefix_iter():
+                self._offsets.pop(n, None)
+        node.children[first:last] = new_nodes
+        starts[first:last] = new_starts
+        shifts.add(first + len(new_nodes), delta)
+        
+        # everything above grew or shrank along with the damage, along with
+        # each later sibling's start, and may now start on a different line
+        for depth in xrange(1, len(path)):
+            ancestor, offset, index = path[depth]
+            self._offsets[path[depth - 1][0]][1].add(index + 1, delta)
+            ancestor.ntokens += delta
+            ancestor.line = self._tokens[offset][2]
+        
+        if len(self._lines) ** 2 > len(self._tokens):
+            self._renumber_lines()
+    
+    def _relex(self, start, end, text):
+        """
+        Applies the edit source[start:end] = text to the source and token
+        list. Returns (first damaged token index, number of old tokens
+        replaced, number of new tokens).
+        """
+        source = self.source
+        tokens = self._tokens
+        new_source = source[:start] + text + source[end:]
+        
+        # the damaged region is every line the edit touches
+        region_start = source.rfind('\n', 0, start) + 1
+        region_end = source.find('\n', end)
+        if region_end == -1:
+            region_end = len(source)
+        new_region_end = region_end + len(text) - (end - start)
+        
+        first_line = source.count('\n', 0, region_start) + 1
+        last_line = first_line + source.count('\n', region_start, region_end)
+        
+        try:
+            new_tokens = list(scan_source(new_source[region_start:new_region_end]))
+        except Ice9LexicalError, e:
+            raise Ice9LexicalError(e.line + first_line - 1, e.error)
+        
+        region_eof = new_tokens.pop()
+        line_delta = region_eof[2] - 1 - (last_line - first_line)
+        new_tokens = [token for token in new_tokens if token[0] != 'newline']
+        
+        # tokens[0] is SOF and tokens[-1] is EOF.
+        i = self._first_token_after_line(first_line - 1, 1, len(tokens) - 1)
+        j = self._first_token_after_line(last_line, i, len(tokens) - 1)
+        
+        # the new tokens are stored less the deltas they'll be given
+        self._lines.replace(i, j, len(new_tokens))
+        line_shift = first_line - 1 - self._lines.total(i)
+        tokens[i:j] = [(typ, tok, line + line_shift, col)
+                        for typ, tok, line, col in new_tokens]
+        self._lines.add(i + len(new_tokens), line_delta)
+        
+        if region_end == len(source):
+            # the edit reached the end of the file, so EOF moved too. Its
+            # line has moved by line_delta, like everything after the edit.
+            tokens[-1] = tokens[-1][:3] + (region_eof[3],)
+        
+        self.source = new_source
+        return i, j - i, len(new_tokens)
+    
+    def _first_token_after_line(self, line, lo, hi):
+        """
+        Binary search for the first token in tokens[lo:hi] whose line is
+        greater than line.
+        """
+        tokens = self._tokens
+        lines = self._lines
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if tokens[mid][2] + lines.total(mid) > line:
+                hi = mid
+            else:
+                lo = mid + 1
+        return lo
+    
+    def _settle_lines(self, start, end):
+        """
+        Stores tokens[start:end] so that they all get total(start), ready to
+        be parsed again.
+        """
+        lines = self._lines
+        tokens = self._tokens
+        n = bisect_right(lines.indexes, start)
+        if n == len(lines) or lines.indexes[n] >= end:
+            return
+        
+        extra = 0
+        for k in xrange(lines.indexes[n], end):
+            if n < len(lines) and lines.indexes[n] == k:
+                extra += lines.deltas[n]
+                n += 1
+            typ, tok, line, col = tokens[k]
+            tokens[k] = (typ, tok, line + extra, col)
+        lines.replace(start, end, end - start)
+    
+    def _renumber_tokens(self):
+        """
+        Applies the line deltas to the tokens, returning the total for each
+        token, or None if there weren't any.
+        """
+        if not len(self._lines):
+            return None
+        tokens = self._tokens
+        totals = self._lines.totals(len(tokens))
+        for k in xrange(self._lines.indexes[0], len(tokens)):
+            typ, tok, line, col = tokens[k]
+            tokens[k] = (typ, tok, line + totals[k], col)
+        self._lines = Shifts()
+        return totals
+    
+    def _renumber_lines(self):
+        """Applies the line deltas to the tokens and the tree."""
+        totals = self._renumber_tokens()
+        if totals is None:
+            return
+        
+        stack = [(self._tree, 0)]
+        while stack:
+            node, offset = stack.pop()
+            if node.node_type == 'operator':
+                # operator tokens aren't children, so the offsets of what's
+                # inside aren't simple sums, but they all get the same total
+                for n in node.prefix_iter():
+                    n.line += totals[offset]
+                continue
+            
+            if node.line is not None:
+                node.line += totals[offset]
+            for c in node.children:
+                stack.append((c, offset))
+                offset += node_length(c)
+    
+    def _child_offsets(self, node):
+        """
+        Returns (starts, shifts) for node's children: where each of them
+        starts relative to node is its entry in starts plus its total in
+        shifts.
+        """
+        offsets = self._offsets.get(node)
+        if offsets is None or len(offsets[1]) ** 2 > len(node.children):
+            starts = []
+            start = 0
+            for c in node.children:
+                starts.append(start)
+                start += node_length(c)
+            offsets = self._offsets[node] = (starts, Shifts())
+        return offsets
+    
+    def _first_child_ending_at(self, node, offset, position):
+        """
+        Returns the index of node's first child which ends at or after the
+        token index position, and where that child starts. If none do, that
+        index is len(node.children) and the start is None.
+        """
+        starts, shifts = self._child_offsets(node)
+        children = node.children
+        lo, hi = 0, len(children)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            end = (offset + starts[mid] + shifts.total(mid) +
+                   node_length(children[mid]))
+            if end < position:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(children):
+            return lo, None
+        return lo, offset + starts[lo] + shifts.total(lo)
+    
+    def _damaged_path(self, i, j):
+        """
+        Returns the path of (node, start token index, index in its parent's
+        children) triples from the root down to the deepest rule expansion
+        covering the damaged tokens [i, j).
+        """
+        path = [(self._tree, 0, None)]
+        node, offset = self._tree, 0
+        while True:
+            # every child from here on ends at or after j, so the first
+            # rule expansion starting at or before i covers the damage.
+            # Nothing under an operator can be reparsed on its own.
+            index, start = self._first_child_ending_at(node, offset, j)
+            children = node.children
+            while index < len(children) and start <= i:
+                c = children[index]
+                if c.node_type == 'rule-expansion':
+                    break
+                start += node_length(c)
+                index += 1
+            else:
+                return path
+            node, offset = c, start
+            path.append((node, offset, index))
+    
+    def _damaged_run(self, node, offset, i, j):
+        """
+        Finds the run of node's children which touch the damaged tokens
+        [i, j). Returns (first child index, last child index + 1, start
+        token, end token) if they can all be reparsed on their own and
+        cover the damage, or None.
+        """
+        index, start = self._first_child_ending_at(node, offset, i)
+        first = index
+        run_start = start
+        children = node.children
+        while index < len(children) and start <= j:
+            c = children[index]
+            if c.node_type == 'token' or c.value not in REPARSE_RULES:
+                return None
+            start += node_length(c)
+            index += 1
+        
+        if index == first or not (run_start <= i and j <= start):
+            return None
+        return first, index, run_start, start
+
+def _reparse_run(tokens, rulename, start, end):
+    """
+    Parses tokens[start:end] as a sequence of rulename expansions. Returns
+    the list of new nodes, or None if the tokens aren't exactly that.
+    """
+    rule = REPARSE_RULES[rulename]
+    eof = ('EOF', 'end of file') + tokens[end][2:4]
+    stream = TokenStream([tokens[0]] + tokens[start:end] + [eof])
+    try:
+        while stream.current_word()[0] != 'EOF':
+            if not rule(stream):
+                return None
+    except Ice9SyntaxError:
+        return None
+    
+    # the first child is the SOF token
+    return stream.ast.children[1:]
@@ -1,14 +1,9 @@
 #!/usr/bin/env python
+import re
 import sys
 from ice9 import Ice9Error
-try: 
-    # sre is deprecated in >=python2.5
-    from re import Scanner
-except ImportError:
-    # the old way, as on the unity machines
-    from sre import Scanner
 
-__all__ = ['TOKENS', 'lex_source', 'Ice9LexicalError']
+__all__ = ['TOKENS', 'lex_source', 'lex_tokens', 'scan_source', 'Ice9LexicalError']
 
 # parser handlers
 # in part from http://code.activestate.com/recipes/457664/.
@@ -28,44 +23,88 @@ TOKENS = (
     ('str',        r"'[^'\n]*'"),
 )
 
+# token types which are matched but never handed to the parser
+IGNORED_TOKENS = ('whitespace', 'comment')
+
 class Ice9LexicalError(Ice9Error):
     pass
 
-def make_token(typ):
+def build_master_pattern(tokens):
+    """
+    Combines all the token regexes into one big alternation, with each
+    entry wrapped in its own named group. Returns the compiled pattern and
+    a dictionary mapping group names back to token types (or None for
+    tokens that should be thrown away).
+    
+    Alternatives are tried in order, so this matches exactly like python's
+    Scanner class did.
+    """
+    alternatives = []
+    group_types = {}
+    for i, (typ, regex) in enumerate(tokens):
+        groupname = 'T%d' % i
+        alternatives.append('(?P<%s>%s)' % (groupname, regex))
+        if typ in IGNORED_TOKENS:
+            group_types[groupname] = None
+        else:
+            group_types[groupname] = typ
+    
+    return re.compile('|'.join(alternatives)), group_types
+
+# compiled once at import; lexing a file is then pure scanning.
+MASTER_PATTERN, GROUP_TYPES = build_master_pattern(TOKENS)
+
+def scan_source(source):
     """
-    Used for python's builtin Scanner class. Tokens are passed through
-    filter functions. This builts filter functions that attach the type
-    of regex they matched.
+    Generator over every significant token in source, including newlines,
+    as (token type, token string, line, column) tuples. Lines and columns
+    both start at 1.
+    
+    Raises an Ice9LexicalError on an illegal character.
     """
-    # ignore whitespace and comments right away
-    if typ == 'whitespace' or typ == 'comment':
-        return None
+    match = MASTER_PATTERN.match
+    group_types = GROUP_TYPES
     
-    # otherwise, return the token type along with the text of the token
-    def _fn(scanner, token):
-        return typ, token
+    line = 1
+    line_start = 0
+    pos = 0
+    end = len(source)
+    while pos < end:
+        m = match(source, pos)
+        if m is None:
+            # unexpected character broke the flow!
+            raise Ice9LexicalError(line, 'illegal character (%s)' % source[pos])
+        
+        typ = group_types[m.lastgroup]
+        if typ is not None:
+            yield typ, m.group(), line, pos - line_start + 1
+            if typ == 'newline':
+                line += 1
+                line_start = m.end()
+        pos = m.end()
     
-    return _fn
+    yield 'EOF', 'end of file', line, pos - line_start + 1
+
+def lex_tokens(source):
+    """
+    Lexes the source lazily, for the parser. Yields 
+    (token type, token string, line, column) tuples with newlines already
+    dropped, surrounded by SOF and EOF markers.
+    
+    May raise an Ice9LexicalError in case of an illegal character.
+    """
+    yield 'SOF', 'start of file', 1, 1
+    for token in scan_source(source):
+        if token[0] != 'newline':
+            yield token
 
 def lex_source(source):
     """
     Lexes the source into ice9 tokens. Returns a list of 
     (token type, token string) pairs.
     
-    May raise a ValueError in case of a syntax error.
+    May raise an Ice9LexicalError in case of an illegal character.
     """
-    scanner_tokens = [(regex, make_token(typ)) for typ, regex in TOKENS]
-    scanner = Scanner(scanner_tokens)
-    
-    # use python's scanner class to tokenize the input
-    tokenized, unused = scanner.scan(source)
-    
-    if unused != '':
-        # unexpected character broke the flow!
-        lineno = sum(1 for typ,tok in tokenized if typ == 'newline') + 1
-        raise Ice9LexicalError(lineno, 'illegal character (%s)' % unused[0])
-    
-    # mark the start and end of the file
-    tokenized.insert(0, ('SOF', 'start of file'))
-    tokenized.append(('EOF', 'end of file'))
+    tokenized = [('SOF', 'start of file')]
+    tokenized.extend([(typ, tok) for typ, tok, line, col in scan_source(source)])
     return tokenized
@@ -1,5 +1,5 @@
 import re
-from cfg import construct_CFG, yield_blocks, fix_jumps
+from cfg import construct_CFG, fix_jumps
 from itertools import izip
 from codegenerator import is_comment, code5str
 from codegenerator import ZERO, AC1, AC2, AC3, AC4, SP, FP, PC
@@ -15,7 +15,10 @@ def reformat_code5(code5):
     data = []
     realcode = []
     for inst5 in code5:
-        if is_comment(inst5):
+        if inst5[0] == 'label':
+            # the CFG needs these to know where jumps go
+            realcode.append(inst5)
+        elif is_comment(inst5):
             if inst5[0] == 'comment':
                 continue
             # not a "comment", but a data statement. We'll put all those in
@@ -40,12 +43,21 @@ def inst_equal(inst5, pattern, bindings=None):
                 bindings[varname] = i
             elif bindings[varname] != i:
                 return False
-        elif not (p == WILD or p == i or re.match("^%s$" % p, str(i))):
+        elif not (p == WILD or p == i or field_regex(p).match(str(i))):
             return False
     return True
 
-def match_sequential(block, pattern):
-    for i in range(0, len(block) - len(pattern)):
+# the compiled regular expression for each pattern field inst_equal has seen
+FIELD_REGEXES = {}
+
+def field_regex(p):
+    regex = FIELD_REGEXES.get(p)
+    if regex is None:
+        regex = FIELD_REGEXES[p] = re.compile("^%s$" % p)
+    return regex
+
+def match_sequential(block, pattern, start=0):
+    for i in xrange(start, len(block) - len(pattern)):
         window = block[i:i + len(pattern)]
         b = {}
         matches = all(node_equal(c, p, b) for c, p in izip(window, pattern))
@@ -64,39 +76,28 @@ def optimization(pattern):
     assert len(pattern) > 0
     
     def _opter(opt):    
-        def mod_opt(block):
-            assert len(block) > 0
-            
-            # find the pattern
-            match = match_sequential(block, pattern)
+        def mod_opt(node):
+            """Runs the optimization if its pattern matches the instructions
+            starting at node. Returns whether it did."""
+            # find the pattern, in node's block. Like match_sequential, it
+            # never takes in the last node of the block.
+            nodes = []
+            bindings = {}
+            for p in pattern:
+                if (node is None or node.outlink is not None or
+                    not node_equal(node, p, bindings)):
+                    # didn't even match the pattern, skip this one
+                    return False
+                nodes.append(node)
+                node = node.next
             
-            if match is False:
-                # didn't even match the pattern, skip this one
+            if node is None:
                 return False
             
-            # we'll use these to rebuild our block
-            first = block[0]
-            end = block[-1].next
-            
-            # match information
-            offset, nodes, bindings = match
             # we matched the pattern, so let's let run the actual optimization
-            result = opt(nodes, **bindings)
-            
-            if result is False:
-                return
-            
-            # since nodes were likely deleted, we need to rebuild our block
-            # for the main loop
-            newblock = []
-            n = first.prev is not None and first.prev.next or first
-            while n != end:
-                newblock.append(n)
-                n = n.next
-            
-            # return the modified block
-            return newblock
-            
+            return opt(nodes, **bindings) is not False
+        
+        mod_opt.pattern = pattern
         return mod_opt
     return _opter
 
@@ -230,16 +231,21 @@ optimizations = [sequential_pushes,
 # global optimizations ---------------------------------------------------
 
 def _paint_visited(node):
-    if node is None or hasattr(node, '_painted'):
-        return
-    
-    setattr(node, '_painted', True)
-    if node.outlink is not None:
-        if node.inst not in ('LD', 'LDA'):
-            _paint_visited(node.next)
-        _paint_visited(node.outlink)
-    else:
-        _paint_visited(node.next)
+    # keeps its own stack of nodes to visit, since a program's instructions
+    # can be far more than the Python stack is deep
+    stack = [node]
+    while stack:
+        node = stack.pop()
+        if node is None or hasattr(node, '_painted'):
+            continue
+        
+        setattr(node, '_painted', True)
+        if node.outlink is not None:
+            stack.append(node.outlink)
+            if node.inst not in ('LD', 'LDA'):
+                stack.append(node.next)
+        else:
+            stack.append(node.next)
 
 def remove_dead_code(cfg):
     _paint_visited(cfg)
@@ -251,11 +257,14 @@ def remove_dead_code(cfg):
     return retval
 
 def remove_dead_jumps(cfg):
+    # every one is removed in a single pass, rather than starting the
+    # global optimizations over after each
+    retval = False
     for cfgnode in cfg:
         if cfgnode.outlink is cfgnode.next and cfgnode.outlink is not None:
             cfgnode.remove()
-            return True
-    return False
+            retval = True
+    return retval
 
 def jump_based_on_boolean(cfg):
     # 3: JGT       1, 2(7)      * skip set to false
@@ -264,28 +273,36 @@ def jump_based_on_boolean(cfg):
     # 6: LDC       1, 1(0)      * compairson is good, set reg 1 to true
     # 7: JEQ       1, 0(7)      * if false, jump to next cond
 
+    # Every match is rewritten in a single pass. None of them jump outside
+    # their own window except the last jump, whose offset fix_jumps works
+    # out again afterwards, so rewriting one doesn't change another.
     block = list(cfg)    
-    match = match_sequential(block, [(JUMP_PAT, "$R1",   2, PC),
-                                     ('LDC',    "$R1",   0, WILD),
-                                     ('LDA',      PC,    1, PC),
-                                     ('LDC',    "$R1",   1, WILD),
-                                     ('(JEQ|JNE)', "$R1", "$A", "$B")
-                                     ])
-    if match is False:
-        return False
-
-    offset, nodes, b = match
-    if nodes[-1].inst == 'JEQ':
-        inverseinsts = dict(JEQ='JNE', JNE='JEQ', JLT='JGE', JGT='JLE', 
-                            JLE='JGT', JGE='JLT')
-        inverseinst = inverseinsts[nodes[0].inst]
-        nodes[-1].inst5 = (inverseinst, b["R1"], b["A"], b["B"], nodes[-1].comment)
-    else:
-        nodes[-1].inst5 = (nodes[-1].inst, b["R1"], b["A"], b["B"], nodes[-1].comment)
-    for n in nodes[:-1]:
-        n.remove()
-    
-    return True
+    start = 0
+    retval = False
+    while True:
+        match = match_sequential(block,
+                                 [(JUMP_PAT, "$R1",   2, PC),
+                                  ('LDC',    "$R1",   0, WILD),
+                                  ('LDA',      PC,    1, PC),
+                                  ('LDC',    "$R1",   1, WILD),
+                                  ('(JEQ|JNE)', "$R1", "$A", "$B")
+                                  ], start)
+        if match is False:
+            return retval
+        
+        offset, nodes, b = match
+        if nodes[-1].inst == 'JEQ':
+            inverseinsts = dict(JEQ='JNE', JNE='JEQ', JLT='JGE', JGT='JLE', 
+                                JLE='JGT', JGE='JLT')
+            inverseinst = inverseinsts[nodes[0].inst]
+            nodes[-1].inst5 = (inverseinst, b["R1"], b["A"], b["B"], nodes[-1].comment)
+        else:
+            nodes[-1].inst5 = (nodes[-1].inst, b["R1"], b["A"], b["B"], nodes[-1].comment)
+        for n in nodes[:-1]:
+            n.remove()
+        
+        start = offset + len(nodes)
+        retval = True
 
 
 global_optimizations = [remove_dead_jumps, 
@@ -296,13 +313,12 @@ global_optimizations = [remove_dead_jumps,
 # end optimizations ------------------------------------------------
 
 # main driver
-def optimize(code5):
-    data, code5 = reformat_code5(code5)
-    
-    # now we need to make the control flow diagram
-    cfg = construct_CFG(code5)
-    fix_jumps(cfg)
-    
+
+# The loops below are where the optimizer spends its time. Each is its own
+# function so that it shows up by name in profiles (see ice9.py --profile).
+
+def optimize_globally(cfg):
+    """Runs the global optimizations over the CFG until none apply."""
     optimizing = True
     while optimizing:
         optimizing = False
@@ -312,24 +328,59 @@ def optimize(code5):
                 fix_jumps(cfg)
         if not optimizing:
             break
-        
+
+def optimize_blocks(cfg):
+    """Runs the peephole optimizations over each block until none apply."""
+    # Rather than starting a block over after every change, this walks the
+    # instructions once, stepping back only far enough after a change to
+    # see the new matches it might have made. Every optimization removes an
+    # instruction, so the walk is linear in the length of the code.
+    backup = max(len(opt.pattern) for opt in optimizations)
     
-    # and finally we begin running some optimizations
-    for block in yield_blocks(cfg):
-        while True:
-            optimized = False
-            for opt in optimizations:
-                result = opt(block)
-                if result is not False:
-                    block = result
-                    optimized = True
-                    fix_jumps(cfg)
-                    break
-            
-            if not optimized:
-                # none of our optimizations optimized; we're done!
+    # the optimizations whose patterns can start with each instruction, so
+    # most of them aren't tried at all
+    candidates = {}
+    
+    # None of the peephole optimizations look at jumps, so their offsets are
+    # only worked out again once they're all done.
+    optimized_any = False
+    node = cfg
+    while node is not None:
+        before = node.prev
+        opts = candidates.get(node.inst)
+        if opts is None:
+            opts = candidates[node.inst] = [
+                opt for opt in optimizations
+                if inst_equal(node.inst5, (opt.pattern[0][0], WILD, WILD, WILD))]
+        
+        for opt in opts:
+            if opt(node):
+                optimized_any = True
                 break
+        else:
+            node = node.next
+            continue
+        
+        node = before if before is not None else cfg
+        for i in xrange(backup):
+            if node.prev is None:
+                break
+            node = node.prev
+    
+    if optimized_any:
+        fix_jumps(cfg)
 
+def optimize(code5):
+    data, code5 = reformat_code5(code5)
+    
+    # now we need to make the control flow diagram
+    cfg = construct_CFG(code5)
+    fix_jumps(cfg)
+    
+    optimize_globally(cfg)
+    
+    # and finally we begin running some optimizations
+    optimize_blocks(cfg)
     
     optimizedcode = [n.inst5 for n in cfg]
     return data + optimizedcode
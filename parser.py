@@ -1,8 +1,9 @@
 #!/usr/bin/env python
 import sys
 from ice9 import Ice9Error
-from lexer import lex_source
+from lexer import lex_tokens
 from tree import Tree
+from grammar import FIRST, FOLLOW, NULLABLE, lookahead_sets
 
 class Ice9SyntaxError(Ice9Error):
     def __init__(self, token_stream):
@@ -12,14 +13,23 @@ class Ice9SyntaxError(Ice9Error):
 
 class TokenStream:
     line = 1
+    position = 0
     stream = None
     ast = None
     current_node = None
     
     def __init__(self, token_stream):
+        """
+        token_stream is a sequence of (type, value, line, column) tokens,
+        as produced by lexer.lex_tokens. The sequence is never modified;
+        we just keep track of the position of the current token.
+        """
         self.ast = Tree(node_type='rule-expansion', value='root')
         self.current_node = self.ast
+        if type(token_stream) not in (list, tuple):
+            token_stream = list(token_stream)
         self.stream = token_stream
+        self.length = len(token_stream)
         # remove the SOF token
         self.next_type_is('SOF')
     
@@ -37,20 +47,19 @@ class TokenStream:
         self.current_node = self.current_node.parent
     
     def current_word(self):
-        if self.stream is None or len(self.stream) == 0:
-            return None
-        return self.stream[0]
+        if self.position < self.length:
+            return self.stream[self.position]
+        return None
     
     def expecting(self, expected):
         ct = self.current_word()
         if ct is None:
             return False
         
-        tokentype, tokenvalue = ct
         if type(expected) is tuple and len(expected) == 2:
-            return expected == (tokentype, tokenvalue)
+            return expected == ct[0:2]
         else:
-            return expected == tokenvalue
+            return expected == ct[1]
     
     def is_next(self, expected):
         """
@@ -58,7 +67,7 @@ class TokenStream:
         If it isn't, returns false.
         """
         if self.expecting(expected):
-            toktype, tokval = self.current_word()
+            toktype, tokval = self.current_word()[0:2]
             self.current_node.add_child(node_type='token', 
                                         value=tokval, 
                                         token_type=toktype,
@@ -93,12 +102,11 @@ class TokenStream:
         Checks the next type and pushes forward if it's found. Returns false
         if it isn't.
         """
-        tokentype, tokenvalue = self.current_word()
-        if tokentype == expected_type:
-            toktyp, tokval = self.current_word()
+        toktype, tokval = self.current_word()[0:2]
+        if toktype == expected_type:
             self.current_node.add_child(node_type='token', 
                                         value=tokval, 
-                                        token_type=toktyp,
+                                        token_type=toktype,
                                         line=self.line)
             self.next()
             return True
@@ -107,12 +115,10 @@ class TokenStream:
         
 
     def next(self):
-        while True:
-            self.stream.pop(0)
-            if self.current_word() == ('newline', '\n'):
-                self.line += 1
-            else:
-                break
+        self.position += 1
+        if self.position < self.length:
+            # tokens already know their line, so there are no newlines to skip
+            self.line = self.stream[self.position][2]
 
 
 # Recursive descent parser that (hopefully) implements the grammar.txt file.
@@ -121,18 +127,77 @@ class TokenStream:
 
 # code is entirely my own.
 
+# names of our rules in grammar.txt
+GRAMMAR_NAMES = {
+    'program': 'program',
+    'stms': 'stms',
+    'stm': 'stm',
+    'ice9_if': 'if',
+    'if_prime': 'ifprime',
+    'fi': 'ifprime2',
+    'ice9_do': 'do',
+    'fa': 'fa',
+    'proc': 'proc',
+    'proc_prime': 'procprime',
+    'proc_end': 'procend',
+    'id_list': 'idlist',
+    'var': 'var',
+    'var_list': 'varlist',
+    'forward': 'forward',
+    'dec_list': 'declist',
+    'ice9_type': 'type',
+    'type_id': 'typeid',
+    'end': 'end',
+    'lvalue_prime': 'lvalueprime',
+    'value_or_assignment': 'valueorassn',
+    'proc_call': 'proccall',
+}
+
+# rules which raise a syntax error, rather than just failing, when the very
+# first token doesn't fit
+STRICT_RULES = ('program', 'stms', 'if_prime', 'proc_prime', 'proc_end',
+                'type_id', 'proc_call')
+
 # voodo python magic here to add an extra parameter to all my grammar
 # rules via a sneaky decorator
 def grammar_rule(rule):
+    grammar_name = GRAMMAR_NAMES[rule.func_name]
+    first_values, first_types = lookahead_sets(FIRST[grammar_name])
+    nullable = NULLABLE[grammar_name]
+    # what can only come after the rule when it matches nothing
+    empty_values, empty_types = lookahead_sets(FOLLOW[grammar_name] -
+                                               FIRST[grammar_name])
+    strict = rule.func_name in STRICT_RULES
+    
     # adds an optional "mandatory" paramater to rules so they throw a
     # syntax error if it doesn't work out
     def modified_rule(stream, mandatory=False):
+        # predict from the lookahead, so we never build nodes for rules
+        # which can't possibly match
+        token = stream.current_word()
+        if not (token[1] in first_values or token[0] in first_types):
+            if not nullable:
+                if mandatory or strict:
+                    raise Ice9SyntaxError(stream)
+                return False
+            
+            if token[1] in empty_values or token[0] in empty_types:
+                # the empty expansion, without running the rule to find out
+                stream.current_node.add_child(node_type='rule-expansion',
+                                              value=rule.func_name,
+                                              line=stream.line, ntokens=0)
+                return True
+        
         stream.into_child(node_type='rule-expansion', value=rule.func_name)
+        start = stream.position
         retval = rule(stream)
         if mandatory and not retval:
             raise Ice9SyntaxError(stream)
         else:
             if retval:
+                # remember how many tokens we covered, for incremental
+                # reparsing
+                stream.current_node.ntokens = stream.position - start
                 stream.up_to_parent()
             else:
                 stream.backtrack()
@@ -305,44 +370,69 @@ def ice9_type(stream):
 def type_id(stream):
     return stream.next_type_is('ident')
 
-@grammar_rule
-def expr(stream):
-    return low(stream) and expr_prime(stream)
-
-@grammar_rule
-def expr_prime(stream):
-    for o in ('=', '!=', '>', '<', '>=', '<='):
-        if stream.is_next(o):
-            return low(stream, True)
-    return True
-
-@grammar_rule
-def low(stream):
-    return med(stream) and low_prime(stream)
-
-@grammar_rule
-def low_prime(stream):
-    if stream.is_next('+') or stream.is_next('-'):
-        return med(stream, True) and low_prime(stream)
-    return True 
-
-@grammar_rule
-def med(stream):
-    return high(stream) and med_prime(stream)
-
-@grammar_rule
-def med_prime(stream):
-    for o in ('*', '/', '%'):
-        if stream.is_next(o):
-            return high(stream, True) and med_prime(stream)
-    return True
+# Expressions are parsed by precedence climbing rather than through the
+# expr/low/med/high rules in grammar.txt, so each operator becomes a single
+# operator node with its operands as children, instead of a chain of rule
+# expansions for parse2ast to collapse. The operands are still end rules.
+
+# binary operators, and how tightly they bind
+BINARY_PRECEDENCE = {
+    '=': 1, '!=': 1, '>': 1, '<': 1, '>=': 1, '<=': 1,
+    '+': 2, '-': 2,
+    '*': 3, '/': 3, '%': 3,
+}
+
+# comparisons can't be chained
+COMPARISON_PRECEDENCE = 1
+
+UNARY_OPS = ('-', '?')
+
+def expr(stream, mandatory=False):
+    return climb(stream, COMPARISON_PRECEDENCE, mandatory)
+
+def climb(stream, min_precedence, mandatory=False):
+    """
+    Parses an expression whose binary operators all bind at least as
+    tightly as min_precedence. Operators of the same precedence associate
+    to the left.
+    """
+    start = stream.position
+    if not unary(stream, mandatory):
+        return False
+    
+    while True:
+        token = stream.current_word()
+        precedence = BINARY_PRECEDENCE.get(token[1])
+        if precedence is None or precedence < min_precedence:
+            return True
+        
+        # the operand we just parsed becomes the left side of the operator
+        parent = stream.current_node
+        left = parent.children.pop()
+        stream.into_child(node_type='operator', value=token[1])
+        stream.current_node.children.append(left)
+        left.parent = stream.current_node
+        
+        stream.next()
+        climb(stream, precedence + 1, True)
+        stream.current_node.ntokens = stream.position - start
+        stream.up_to_parent()
+        
+        if precedence == COMPARISON_PRECEDENCE:
+            return True
 
-@grammar_rule
-def high(stream):
-    if stream.is_next('-') or stream.is_next('?'):
-        return high(stream, True)
-    else:
-        return end(stream)
+def unary(stream, mandatory=False):
+    token = stream.current_word()
+    if token[1] in UNARY_OPS:
+        start = stream.position
+        stream.into_child(node_type='operator', value=token[1])
+        stream.next()
+        unary(stream, True)
+        stream.current_node.ntokens = stream.position - start
+        stream.up_to_parent()
+        return True
+    
+    return end(stream, mandatory)
 
 @grammar_rule
 def end(stream):
@@ -393,8 +483,15 @@ def proc_call(stream):
 
 
 def parse(source, rule=program):
-    stream = TokenStream(lex_source(source))
-    retval = rule(stream) and stream.next_type_is('EOF')
+    return parse_tokens(lex_tokens(source), rule)
+
+def parse_tokens(tokens, rule=program):
+    """
+    Parses an already lexed sequence of tokens (see lexer.lex_tokens).
+    The sequence itself is not modified.
+    """
+    stream = TokenStream(tokens)
+    retval = rule(stream, True) and stream.next_type_is('EOF')
     
     if retval:
         return stream.ast
@@ -1,77 +1,135 @@
 #!/usr/bin/env python
 
+import threading
+
 from ice9 import Ice9Error
 from tree import Tree
 from parser import parse
 from ast import parse2ast
+from symbols import SymbolTable
 
 class Ice9SemanticError(Ice9Error):
     def __init__(self, node, error_message):
         self.line = node.line
         self.error = error_message
 
-ice9_procs = None
-
-ice9_types = None
-
-ice9_symbols = None
+class Ice9SemanticErrors(Ice9SemanticError):
+    """Every semantic error in a program, when they're all collected."""
+    def __init__(self, errors):
+        self.errors = errors
+        self.line = errors[0].line
+        self.error = errors[0].error
+    
+    def __str__(self):
+        return "\n".join([str(e) for e in self.errors])
 
-def find_all_definitions(scopes, name):
-    """Returns an iterator on all the definitions of name in scopes."""
-    return [scope[name] for scope in scopes if name in scope]
+class SemanticContext(object):
+    """
+    Everything check_semantics learns about the program it's checking: the
+    procs, types and variables in scope, and its canonical types. Every
+    check gets a context of its own, so programs can be checked at the same
+    time in different threads.
+    """
+    
+    def __init__(self):
+        self.procs = SymbolTable({
+            'int': ['proc', 'int', ["param", "num", 'str']]
+        })
+        
+        self.types = SymbolTable({
+            'nil': 'base',
+            'int': 'base',
+            'str': 'base',
+            'bool': 'base',
+            'const': 'int',
+        })
+        
+        self.symbols = SymbolTable()
+        
+        # builtins live in a scope of their own, around the program's
+        for scopes in (self.procs, self.types, self.symbols):
+            scopes.enter()
+        
+        # Expanded types are canonical: base types are their names, arrays
+        # are ("array", element, size, size in words) and procs ("proc",
+        # return, param, ...) tuples, all made of canonical types. There's
+        # only ever one copy of each, so two types are equivalent exactly
+        # when they're the same object.
+        self.canonical_types = {}
+        
+        # every error found so far, when they're all being collected
+        self.errors = None
 
-def define(scopes, name, value):
-    """Define name to be value in the latest scope of scopes."""
-    assert len(scopes) > 0, 'The scope stack is empty. This should *not* happen.'
-    scopes[0][name] = value
+# the context of the check running in each thread
+current = threading.local()
 
 def add_scope():
     """Add a new scope."""
-    ice9_types.insert(0, dict())
-    ice9_symbols.insert(0, dict())
+    ctx = current.context
+    ctx.types.enter()
+    ctx.symbols.enter()
 
 def leave_scope():
     """Leave the last scope."""
-    ice9_types.pop(0)
-    ice9_symbols.pop(0)
-    
-    assert len(ice9_types) > 0 and len(ice9_symbols) > 0, \
-            'The scope stack is empty. This should *not* happen.'
+    ctx = current.context
+    ctx.types.leave()
+    ctx.symbols.leave()
 
-def first_definition(scope, name):
-    """
-    Returns the first definition of name in scope, or None if none exists.
-    """
-    for d in find_all_definitions(scope, name):
-        return d
+# the type of anything that failed to check, when collecting every error.
+# It isn't equivalent to any other type.
+ERROR_TYPE = ("error",)
+
+def canonical(typeval):
+    """Returns the one copy of the expanded type typeval."""
+    if type(typeval) is str:
+        return intern(typeval)
     
-    return None
+    canonical_types = current.context.canonical_types
+    try:
+        return canonical_types[typeval]
+    except KeyError:
+        canonical_types[typeval] = typeval
+        return typeval
 
 def expand_type(typeval):
-    """Keeps expanding out typeval until it hits a base."""
+    """
+    Expands typeval all the way down to base types, and returns it as a
+    canonical type. Types are expanded when they're defined, so this never
+    has to go through more than one type name.
+    """
+    ctx = current.context
     if type(typeval) is str:
-        subtype = first_definition(ice9_types, typeval)
+        subtype = ctx.types.lookup(typeval)
         if subtype is not None:
             if subtype == 'base':
-                return typeval
+                return canonical(typeval)
             else:
-                return expand_type(subtype)
+                return subtype
         else:
             raise ValueError('unknown type: %s' % typeval)
+    elif type(typeval) is tuple:
+        # already expanded
+        return typeval
     elif type(typeval) == list:
         if typeval[0] == "array":
-            return ["array", expand_type(typeval[1])] + typeval[2:]
+            element = expand_type(typeval[1])
+            # the whole array's size goes along with it, for type9_size
+            words = typeval[2]
+            if type(element) is tuple and element[0] == "array":
+                words *= element[3]
+            return canonical(("array", element, typeval[2], words))
         elif typeval[0] == "param":
             return expand_type(typeval[2])
         elif typeval[0] == "forward" or typeval[0] == "proc":
-            return ["proc"] + [expand_type(t) for t in typeval[1:]]
+            return canonical(("proc",) +
+                             tuple([expand_type(t) for t in typeval[1:]]))
         else:
             raise Exception, "You forgot to expand the type of " + typeval[0]
 
 
 def equivalent_types(type1, type2):
     """Returns true or false, if the types are equivalent."""
-    return expand_type(type1) == expand_type(type2)
+    return expand_type(type1) is expand_type(type2)
 
 
 def check_and_set_type(node, check_type):
@@ -80,20 +138,42 @@ def check_and_set_type(node, check_type):
     If the node has an ice9_type, check that ice9_type == check_type.
     If the types don't match, raise an exception.
     """
-    if hasattr(node, 'ice9_type'):
+    if node.ice9_type is not None:
         if equivalent_types(node.ice9_type, check_type):
             return True
         else:
             # FIXME: better error message
             raise Ice9SemanticError(), "types dont match"
     else:
-        setattr(node, 'ice9_type', check_type)
+        node.ice9_type = check_type
 
 
 def check(result, node, errormsg):
     if not result:
         raise Ice9SemanticError(node, errormsg)
 
+def report(error):
+    """
+    Raises the semantic error, unless every error is being collected, in
+    which case it's recorded and checking carries on.
+    """
+    errors = current.context.errors
+    if errors is None:
+        raise error
+    errors.append(error)
+
+def proc_part_type(node, typeval):
+    """
+    Expands typeval, the type of one of a proc's params or its return value.
+    If it isn't a type, that's reported and the error type is returned, so
+    whatever has it can still be defined.
+    """
+    try:
+        return expand_type(typeval)
+    except ValueError, e:
+        report(Ice9SemanticError(node, e))
+        return ERROR_TYPE
+
 def typenode_to_type(tnode):
     full_type = tnode.value
     for dimension_size in tnode.children:
@@ -107,49 +187,62 @@ def typenode_to_type(tnode):
     
     return full_type
 
+def declared_type(tnode):
+    """Returns the expanded type tnode describes."""
+    try:
+        return expand_type(typenode_to_type(tnode))
+    except ValueError, e:
+        check(False, tnode, e)
+
 def define_type(dtnode):
+    ctx = current.context
     # process the type early
     assert len(dtnode.children) == 1
     assert dtnode.children[0].node_type == 'type'
     try:
-        ice9_type = expand_type(typenode_to_type(dtnode.children[0]))
-    except ValueError, e:
-        check(False, dtnode.children[0], e)
+        ice9_type = declared_type(dtnode.children[0])
+    except Ice9SemanticError:
+        # define it anyway, so everything declared with it isn't an error too
+        ctx.types.define(dtnode.value, ERROR_TYPE)
+        raise
     dtnode.children.pop(0)
     
     typename = dtnode.value
     assert len(dtnode.children) == 0
-    check(typename not in ice9_types[0], dtnode, 
+    check(typename not in ctx.types.names, dtnode, 
           'type ' + typename + ' is already defined in the current scope')
     
-    define(ice9_types, typename, ice9_type)
+    ctx.types.define(typename, ice9_type)
     dtnode.kill()
 
 def define_var(varnode):
+    ctx = current.context
     # Need to find the var's type
     assert len(varnode.children) == 1
     assert varnode.children[0].node_type == 'type'
     try:
-        ice9_type = expand_type(typenode_to_type(varnode.children[0]))
-    except ValueError, e:
-        check(False, varnode.children[0], e)
+        ice9_type = declared_type(varnode.children[0])
+    except Ice9SemanticError:
+        # define it anyway, so every use of it isn't an error too
+        ctx.symbols.define(varnode.value, ERROR_TYPE)
+        raise
     varnode.children.pop(0)
     
     varname = varnode.value
     assert len(varnode.children) == 0
-    check(varname not in ice9_symbols[0],
+    check(varname not in ctx.symbols.names,
           varnode,
           'var(s) already defined in scope')
     
-    define(ice9_symbols, varname, ice9_type)
+    ctx.symbols.define(varname, ice9_type)
     
     scopenode = varnode.parent
     while scopenode.node_type != 'program' and scopenode.node_type != 'proc':
         scopenode = scopenode.parent
     
-    olddefs = getattr(scopenode, 'vars', [])
-    olddefs.append((varname, expand_type(ice9_type)))
-    setattr(scopenode, 'vars', olddefs)
+    if scopenode.vars is None:
+        scopenode.vars = []
+    scopenode.vars.append((varname, expand_type(ice9_type)))
     varnode.kill()
 
 def param(paramnode):
@@ -163,9 +256,10 @@ def param(paramnode):
     paramnode.children = []
     
 def ident(identnode):
+    ctx = current.context
     # represents a symbol lookup
     defn = None
-    defn = first_definition(ice9_symbols, identnode.value)
+    defn = ctx.symbols.lookup(identnode.value)
     check(defn is not None, identnode, "undeclared variable: %s" % identnode.value)
     check_and_set_type(identnode, expand_type(defn))
 
@@ -228,9 +322,17 @@ def operator(opnode):
             check_and_set_type(opnode, opnode.children[0].ice9_type)
         
 def array_reference(arrnode):
-    vartype = first_definition(ice9_symbols, arrnode.value)
-    assert vartype is not None
+    ctx = current.context
+    vartype = ctx.symbols.lookup(arrnode.value)
+    check(vartype is not None, arrnode,
+          "undeclared variable: %s" % arrnode.value)
     vartype = expand_type(vartype)
+    if vartype is ERROR_TYPE:
+        # its declaration has already been reported
+        arrnode.ice9_type = ERROR_TYPE
+        arrnode.node_type = 'ident'
+        return
+    
     for c in arrnode.children:
         check(equivalent_types(c.ice9_type, 'int'), c, 
               "expressions for array dereference must evaluate to ints")
@@ -241,6 +343,7 @@ def array_reference(arrnode):
     arrnode.node_type = 'ident'
 
 def assignment(setnode):
+    ctx = current.context
     cs = setnode.children
     
     check(cs[0].node_type == 'ident' or cs[0].node_type == 'array_reference',
@@ -250,7 +353,7 @@ def assignment(setnode):
           setnode,
           "incompatible types to binary operator :=")
     
-    check(first_definition(ice9_symbols, cs[0].value) != 'const',
+    check(ctx.symbols.lookup(cs[0].value) != 'const',
           cs[0], "the fa variable (%s) cannot be written to in the loop body" % cs[0].value)
     
     check(expand_type(cs[1].ice9_type) in ("int", "bool", "str"),
@@ -264,12 +367,14 @@ def assignment(setnode):
     check_and_set_type(setnode, 'nil')
 
 def forward(forwardnode):
+    ctx = current.context
     if len(forwardnode.children) >= 1 and forwardnode.children[0].node_type == 'type':
-        return_type = typenode_to_type(forwardnode.children.pop(0))
+        return_type = proc_part_type(forwardnode,
+                                     typenode_to_type(forwardnode.children.pop(0)))
     else:
         return_type = 'nil'
     
-    check(forwardnode.value not in ice9_procs[0], 
+    check(forwardnode.value not in ctx.procs.names, 
           forwardnode,
           "proc %s is already defined in the current scope" % forwardnode.value)
     
@@ -279,52 +384,59 @@ def forward(forwardnode):
     for c in forwardnode.children:
         assert c.node_type == 'param', "What's a non-param doing in a forward?"
         param(c)
-        forwardtype.append(["param", c.value, c.ice9_type])
+        forwardtype.append(["param", c.value, proc_part_type(c, c.ice9_type)])
     
-    define(ice9_procs, forwardnode.value, forwardtype)
+    ctx.procs.define(forwardnode.value, forwardtype)
     forwardnode.kill()
 
 def inherited_proc(procnode):
+    ctx = current.context
     add_scope()
     procname = procnode.value
     proctype = ["proc"]
     
-    if not hasattr(procnode, 'vars'):
-        setattr(procnode, 'vars', [])
+    if procnode.vars is None:
+        procnode.vars = []
     
+    # a param named twice is only reported once the proc and its return
+    # value are defined, so they don't go on to be reported as undeclared
+    duplicate = None
     for c in procnode.children:
         if c.node_type == 'param':
             param(c)
-            procnode.vars.append((c.value, expand_type(c.ice9_type)))
-            try:
-                proctype.append(["param", c.value, expand_type(c.ice9_type)])
-            except ValueError, e:
-                check(False, c, e)
-            check(c.value not in ice9_symbols[0], procnode,
-                  "var %s already defined in scope" % c.value)
-            define(ice9_symbols, c.value, c.ice9_type)
+            param_type = proc_part_type(c, c.ice9_type)
+            procnode.vars.append((c.value, param_type))
+            proctype.append(["param", c.value, param_type])
+            if c.value in ctx.symbols.names and duplicate is None:
+                duplicate = c.value
+            ctx.symbols.define(c.value, param_type)
     
     if procnode.children[0].node_type == 'type':
-        rettype = typenode_to_type(procnode.children.pop(0))
-        define(ice9_symbols, procname, rettype)
+        rettype = proc_part_type(procnode,
+                                 typenode_to_type(procnode.children.pop(0)))
+        ctx.symbols.define(procname, rettype)
     else:
         rettype = 'nil'
     proctype.insert(1, rettype)
     # check if we had a forward define it already.
     check_and_set_type(procnode, proctype)
-    if procname in ice9_procs[0]:
-        forward_defn_type = ice9_procs[0][procname]
+    if procname in ctx.procs.names:
+        forward_defn_type = ctx.procs.names[procname]
         check(type(forward_defn_type) == list and forward_defn_type[0] == 'forward',
               procnode,
               'proc %s is already defined' % procname)
-        check(equivalent_types(proctype, forward_defn_type),
+        # a param or return type that isn't a type has already been reported
+        check(equivalent_types(proctype, forward_defn_type) or
+              ERROR_TYPE in expand_type(proctype) + expand_type(forward_defn_type),
               procnode,
               "mismatch between forward and proc defns of %s" % procnode.value)
         forward_defn_type[0] = "proc"
-        define(ice9_procs, procname, proctype)
+        ctx.procs.define(procname, proctype)
     else:
-        define(ice9_procs, procname, proctype)
+        ctx.procs.define(procname, proctype)
     
+    check(duplicate is None, procnode,
+          "var %s already defined in scope" % duplicate)
 
 def synthesized_proc(procnode):
     leave_scope()
@@ -341,7 +453,8 @@ def izip_longest(*lists):
        yield r
 
 def proc_call(pcnode):
-    proctype = first_definition(ice9_procs, pcnode.value)
+    ctx = current.context
+    proctype = ctx.procs.lookup(pcnode.value)
     check(proctype is not None, pcnode, "unknown proc %s" % pcnode.value)
         
     check(len(pcnode.children) == len(proctype[2:]),
@@ -349,34 +462,40 @@ def proc_call(pcnode):
           "number of parameters mismatch in call to %s" % pcnode.value)
     
     for child, param in izip_longest(pcnode.children, proctype[2:]):
-        check(equivalent_types(child.ice9_type, param),
+        # a param of the error type has already been reported
+        check(expand_type(param) is ERROR_TYPE or
+              equivalent_types(child.ice9_type, param),
               pcnode,
               "parameter type mismatch")
     
     check_and_set_type(pcnode, proctype[1])
 
 def for_loop_inherited(fornode):
+    ctx = current.context
     add_scope()
     fornode.loopcount += 1
     varnode = fornode.children[0]
     assert varnode.node_type == 'ident'
     
-    define(ice9_symbols, varnode.value, 'const')
+    ctx.symbols.define(varnode.value, 'const')
     varnode.ice9_type = 'const'
 
 def for_loop_synthesized(fornode):
-    check_and_set_type(fornode, 'nil')
-    check(equivalent_types(fornode.children[1].ice9_type, 'int'),
-          fornode.children[1],
-          'expressions in fa must evaluate to ints')
-    check(equivalent_types(fornode.children[2].ice9_type, 'int'),
-          fornode.children[2],
-          'expressions in fa must evaluate to ints')
-    
-    varnode = fornode.children[0]
-    setattr(fornode, 'vars', [(varnode.value, expand_type(varnode.ice9_type))])
-    
-    leave_scope()
+    # the loop's scope is left even if it fails to check, when every error
+    # is being collected
+    try:
+        check_and_set_type(fornode, 'nil')
+        check(equivalent_types(fornode.children[1].ice9_type, 'int'),
+              fornode.children[1],
+              'expressions in fa must evaluate to ints')
+        check(equivalent_types(fornode.children[2].ice9_type, 'int'),
+              fornode.children[2],
+              'expressions in fa must evaluate to ints')
+        
+        varnode = fornode.children[0]
+        fornode.vars = [(varnode.value, expand_type(varnode.ice9_type))]
+    finally:
+        leave_scope()
 
 def do_loop_inherited(donode):
     donode.loopcount += 1
@@ -395,8 +514,8 @@ def cond(ifnode):
     check(len(ifnode.children) > 1, ifnode, 'if and do tests must evaluate to a boolean')
 
 def program(prgmnode):
-    if not hasattr(prgmnode, 'vars'):
-        setattr(prgmnode, 'vars', [])
+    if prgmnode.vars is None:
+        prgmnode.vars = []
 
 inherited_callbacks = {
     'define_type': define_type,
@@ -421,48 +540,90 @@ sythenisized_callbacks = {
     'cond': cond
 }
 
-def semantic_helper(ast):
-    if ast.parent is not None:
-        ast.loopcount = ast.parent.loopcount
-    
-    if ast.node_type in inherited_callbacks:
-        callback = inherited_callbacks[ast.node_type]
-        callback(ast)
-    
-    for n in list(ast.children):
-        semantic_helper(n)
-    
-    if ast.node_type in sythenisized_callbacks:
-        callback = sythenisized_callbacks[ast.node_type]
-        callback(ast)
-    
-    return True
+def run_callback(callback, node, errors):
+    """
+    Runs callback on node, adding a semantic error to errors rather than
+    raising it, unless it only follows from an error already found in one of
+    node's children. Either way node gets the error type, so its parent's
+    checks know not to report it again.
+    """
+    try:
+        callback(node)
+    except Ice9SemanticError, e:
+        if not any(c.ice9_type is ERROR_TYPE for c in node.children):
+            errors.append(e)
+        node.ice9_type = ERROR_TYPE
 
-def check_semantics(ast):
-    global ice9_procs, ice9_types, ice9_symbols
+def semantic_helper(ast, errors=None):
+    """
+    Runs the inherited callbacks on the way down the tree, and the
+    synthesized ones on the way back up. Keeps its own stack, so the tree
+    can be as deep as it likes.
+    """
+    # a node on the stack is still to be entered; a None above a node
+    # means its children are done
+    stack = [ast]
+    while stack:
+        node = stack.pop()
+        if node is None:
+            node = stack.pop()
+        else:
+            if node.parent is not None:
+                node.loopcount = node.parent.loopcount
+            callback = inherited_callbacks.get(node.node_type)
+            if callback is not None and errors is None:
+                callback(node)
+            elif callback is not None:
+                run_callback(callback, node, errors)
+            
+            children = list(node.children)
+            if children:
+                stack.append(node)
+                stack.append(None)
+                children.reverse()
+                stack.extend(children)
+                continue
+        
+        callback = sythenisized_callbacks.get(node.node_type)
+        if callback is not None and errors is None:
+            callback(node)
+        elif callback is not None:
+            run_callback(callback, node, errors)
     
-    ice9_procs = [dict(), dict({
-        'int': ['proc', 'int', ["param", "num", 'str']]
-    })]
+    return True
 
-    ice9_types = [dict(), dict({
-        'nil': 'base',
-        'int': 'base',
-        'str': 'base',
-        'bool': 'base',
-        'const': 'int',
-    })]
-    
-    ice9_symbols = [dict(), dict() ]
-    
-    ast.loopcount = 0
-    semantic_helper(ast)
-    
-    for k,v in ice9_procs[0].iteritems():
-        check(type(v) == list and v[0] != 'forward',
-              ast,
-              'proc %s has no body' % k)
-    
+def check_semantics(ast, all_errors=False):
+    """
+    Checks and types the AST. Normally the first semantic error is raised
+    straight away. With all_errors, checking carries on past each error, and
+    at the end they're all raised together as an Ice9SemanticErrors.
+    """
+    # the check may be running inside another one, in this thread
+    outer_context = getattr(current, 'context', None)
+    ctx = current.context = SemanticContext()
+    try:
+        if all_errors:
+            errors = ctx.errors = []
+        else:
+            errors = None
+        
+        ast.loopcount = 0
+        semantic_helper(ast, errors)
+        
+        for k,v in ctx.procs.names.iteritems():
+            try:
+                check(type(v) == list and v[0] != 'forward',
+                      ast,
+                      'proc %s has no body' % k)
+            except Ice9SemanticError, e:
+                if errors is None:
+                    raise
+                errors.append(e)
+    finally:
+        current.context = outer_context
+    
+    if errors:
+        raise Ice9SemanticErrors(errors)
     
     return ast
     
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+
+"""
+A compile server, so that compiling a small file doesn't mean starting
+Python and importing the whole compiler every time.
+
+The server listens on a Unix socket and compiles each request in a thread
+of its own. A request is a line of compile flags (the same as ice9.py's -o,
+-s, -d, -p, -a and -e) ending with the length of the source, followed by the
+source itself:
+
+    -s 21
+    write 1; write 2;
+
+The reply is a line with "ok" or "error" and the length of what follows,
+followed by the compiled program or the error message.
+"""
+
+import os
+import signal
+import socket
+import stat
+import SocketServer
+
+# what each flag passes to ice9.compile
+FLAGS = {
+    '-o': ('optimize', True),
+    '-s': ('optimize', False),
+    '-d': ('direct_ast', True),
+    '-p': ('direct_ast', False),
+    '-a': ('arena', True),
+    '-e': ('all_errors', True),
+}
+
+def write_message(f, header, body):
+    f.write("%s %d\n" % (header, len(body)))
+    f.write(body)
+    f.flush()
+
+def read_message(f):
+    """
+    Reads a message from the file f, returning the words of its header
+    (without the length) and its body. Raises EOFError if there's no message
+    at all.
+    """
+    header = f.readline()
+    if not header:
+        raise EOFError
+    words = header.split()
+    if not words:
+        raise ValueError("empty message")
+    length = int(words.pop())
+    body = f.read(length)
+    if len(body) != length:
+        raise ValueError("message ended early")
+    return words, body
+
+def compile_request(flags, source, cache=None):
+    """
+    Compiles source, returning the reply's status and body. If cache is a
+    cache.CompileCache, it's looked in first.
+    """
+    from ice9 import compile, Ice9Error
+    
+    options = {'cache': cache}
+    for flag in flags:
+        if flag not in FLAGS:
+            return "error", "unknown flag: %s" % flag
+        name, value = FLAGS[flag]
+        options[name] = value
+    
+    try:
+        return "ok", compile(source, **options)
+    except Ice9Error, e:
+        return "error", str(e)
+    except Exception:
+        # one bad program shouldn't bring the server down
+        import traceback
+        return "error", "internal compiler error:\n" + traceback.format_exc()
+
+class CompileHandler(SocketServer.StreamRequestHandler):
+    """Answers one compile request."""
+    
+    def handle(self):
+        try:
+            flags, source = read_message(self.rfile)
+        except EOFError:
+            # the client hung up without asking for anything
+            return
+        except ValueError, e:
+            write_message(self.wfile, "error", "bad request: %s" % e)
+            return
+        
+        status, body = compile_request(flags, source, self.server.cache)
+        write_message(self.wfile, status, body)
+
+class CompileServer(SocketServer.ThreadingMixIn, SocketServer.UnixStreamServer):
+    """
+    Compiles programs sent to the Unix socket at path, using the
+    cache.CompileCache cache if there is one.
+    """
+    daemon_threads = True
+    
+    def __init__(self, path, cache=None):
+        # import the whole compiler up front, so no request has to
+        import ice9, lexer, parser, ast, astparser, semantic, astoptimizer
+        import codegenerator, optimizer
+        
+        self.cache = cache
+        SocketServer.UnixStreamServer.__init__(self, path, CompileHandler)
+
+def stop(signum, frame):
+    raise KeyboardInterrupt
+
+def serve(path, cache=None):
+    """
+    Runs a compile server on the Unix socket at path until it's interrupted
+    or terminated. If cache is a cache.CompileCache, every compile shares it.
+    """
+    # a socket left behind by a server that didn't shut down cleanly
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            try:
+                sock.connect(path)
+            except socket.error:
+                os.remove(path)
+            else:
+                raise socket.error("a server is already running on %s" % path)
+        finally:
+            sock.close()
+    
+    server = CompileServer(path, cache)
+    signal.signal(signal.SIGTERM, stop)
+    try:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+    finally:
+        server.server_close()
+        os.remove(path)
+
+def request(path, source, flags=()):
+    """
+    Asks the compile server at path to compile source, with the given
+    ice9.py flags. Returns (True, the compiled program) or (False, the
+    error message).
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        f = sock.makefile('rwb')
+        try:
+            write_message(f, ' '.join(flags), source)
+            status, body = read_message(f)
+        finally:
+            f.close()
+    finally:
+        sock.close()
+    
+    return status == ['ok'], body
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+
+"""
+Scoped symbol tables, shared by semantic checking and code generation.
+"""
+
+class SymbolTable(object):
+    """
+    A stack of nested scopes of names. Entering a scope, defining a name and
+    looking one up are all constant time, however deeply scopes are nested;
+    leaving a scope costs one step per name defined in it.
+    """
+    
+    def __init__(self, names=None):
+        # every definition of each name, innermost last
+        self.definitions = {}
+        # the names defined in each scope, innermost last
+        self.scopes = [{}]
+        self.names = self.scopes[-1]
+        
+        if names is not None:
+            for name, value in names.iteritems():
+                self.define(name, value)
+    
+    def enter(self):
+        """Starts a new innermost scope."""
+        self.names = {}
+        self.scopes.append(self.names)
+    
+    def leave(self):
+        """Throws away the innermost scope."""
+        # the outermost scope is never left
+        assert len(self.scopes) > 1, \
+               'The scope stack is empty. This should *not* happen.'
+        
+        for name in self.scopes.pop():
+            definitions = self.definitions[name]
+            definitions.pop()
+            if not definitions:
+                del self.definitions[name]
+        self.names = self.scopes[-1]
+    
+    def define(self, name, value):
+        """Defines name to be value in the innermost scope."""
+        if name in self.names:
+            self.definitions[name][-1] = value
+        else:
+            self.definitions.setdefault(name, []).append(value)
+        self.names[name] = value
+    
+    def lookup(self, name):
+        """
+        Returns the innermost definition of name, or None if none exists.
+        """
+        definitions = self.definitions.get(name)
+        if definitions is None:
+            return None
+        return definitions[-1]
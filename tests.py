@@ -4,7 +4,7 @@ import os
 import sys
 from StringIO import StringIO
 from ice9 import Ice9Error
-from lexer import lex_source, Ice9LexicalError
+from lexer import lex_source, lex_tokens, Ice9LexicalError
 from parser import *
 from subprocess import Popen, PIPE
 
@@ -28,10 +28,29 @@ def make_community_test(test_id):
         inputtext = open(inputfile).read()
     else:
         inputtext = ""
-        
+    
     source = "# test #%d\n" % test_id + source
     return make_compile_test(source, expected, inputtext)
-    
+
+
+def usage_error(*args):
+    """
+    Runs ice9.main with the command line args, which should be a mistake.
+    Returns what it wrote to stderr before exiting with status 2.
+    """
+    stderr = sys.stderr
+    sys.stderr = StringIO()
+    try:
+        try:
+            ice9.main(*args)
+        except SystemExit, e:
+            if e.code != 2:
+                raise
+        else:
+            raise AssertionError("main didn't exit")
+        return sys.stderr.getvalue()
+    finally:
+        sys.stderr = stderr
 
 def make_compile_test(source, expected, pgrminput=""):
     """
@@ -75,9 +94,13 @@ def make_compile_test(source, expected, pgrminput=""):
             f.close()
             output = self._run_file("test.tm")
             return output
-            
+        
         
         def runTest(self):
+            # both front ends must agree on the AST
+            self.assertEqual(str(ice9.parse_source(source, direct_ast=False)),
+                             str(ice9.parse_source(source)))
+            
             unoptimized_output = self._run_source(source, False)
             
             assert unoptimized_output == expected, (
@@ -112,6 +135,31 @@ test_arith4 = make_compile_test("writes - - - 5;", "-5")
 test_arith5 = make_compile_test("writes - - 5;", "5")
 test_arith6 = make_compile_test("writes 0 - - - 5;", "-5")
 
+# expressions needing more registers than there are (fewer in a fa loop)
+test_arith7 = make_compile_test("""
+var a, b, c, d : int
+a := 1; b := 2; c := 3; d := 4;
+writes ((a - b) * (c - d)) - ((b * c) - (d * a)) * ((c / a) - (d - b)) -
+       (((a * b) - c) * ((d - a) * (b - c)));
+fa i := 1 to 1 ->
+  writes ((i - b) * (c - d)) - ((b * c) - (d * i)) * ((c / i) - (d - b)) -
+         (((i * b) - c) * ((d - i) * (b - c)));
+af
+""", "-4 -4")
+
+# operands are still evaluated left to right when a proc call could
+# change the other one
+test_arith8 = make_compile_test("""
+var x : int
+proc f() : int
+  x := x + 10;
+  f := 1;
+end
+x := 1;
+writes x + f();
+writes x + f() * 2;
+""", "2 13")
+
 # modulus
 test_mod1 = make_compile_test("writes 3 % 2;", "1")
 test_mod2 = make_compile_test("writes 3 % 1;", "0")
@@ -201,6 +249,17 @@ test_proc_earlyreturn2 = make_compile_test("""
     """,
     "1 "
 )
+test_proc_earlyreturn3 = make_compile_test("""
+    proc test() : int
+        test := 5;
+        writes 1;
+        return;
+    end
+    
+    writes test();
+    """,
+    "1 5 "
+)
 
 # return/exit stuff
 test_exit = make_compile_test("writes 1; exit; writes 2;", "1 ")
@@ -250,6 +309,16 @@ doublefa();
 "5 6 7 7 8 9")
 
 test_faexit = make_compile_test("fa i := 1 to 3 -> writes i; exit; af", "1 ")
+test_fabreak = make_compile_test("""
+var n : int
+n := 3;
+fa i := 1 to n - 1 ->
+    writes i;
+    break;
+af
+writes 9;
+""",
+"1 9")
 
 test_fa7 = make_compile_test("""
 fa i := 1 to 2 -> 
@@ -347,6 +416,28 @@ writes color[2];
 """,
 "2 3 0 2 3 4 2 3 4")
 
+test_arrays6 = make_compile_test("""
+# aliases of aliases are the same type as what they stand for
+type row = int[2]
+type grid = row[3]
+type board = grid
+var b : board
+var g : int[3][2]
+
+proc sum(x : grid) : int
+    sum := 0;
+    fa i := 0 to 2 ->
+        sum := sum + x[i][0] + x[i][1];
+    af
+end
+
+b[2][1] := 5;
+g[1][0] := 7;
+writes sum(b);
+writes sum(g);
+""",
+"5 7 ")
+
 test_array_out_of_bounds = make_compile_test(
     "var a : int[3] ; writes a[-1];",
     "Arrays bounds violation\n"
@@ -355,6 +446,18 @@ test_array_out_of_bounds = make_compile_test(
     "var a : int[3] ; writes a[3];",
     "Arrays bounds violation\n"
 )
+test_array_out_of_bounds_proc = make_compile_test("""
+var a : int[3][2]
+proc p(i, j : int)
+  a[i][j] := i + j;
+  writes a[i][j];
+end
+p(2, 1);
+p(1, 2);
+writes 7;
+""",
+"3 Arrays bounds violation\n"
+)
 
 test_strings1 = make_compile_test("""
 write 'test';
@@ -371,6 +474,15 @@ write test;
 """,
 "this is a test\n")
 
+test_string_array = make_compile_test("""
+var a : str[2];
+
+a[1] := "this is a test";
+
+write a[1];
+""",
+"this is a test\n")
+
 test_multi_push = make_compile_test("""
 proc foo ()
 	writes 0;
@@ -425,6 +537,863 @@ test_div_const = make_compile_test(
 )
 
 
+# lexer tests
+class LexerTest(unittest.TestCase):
+    def test_tokens(self):
+        self.assertEqual(lex_source("if x1 >= 'a' -> # comment\n"),
+                         [('SOF', 'start of file'),
+                          ('keyword', 'if'), ('ident', 'x1'),
+                          ('operator', '>='), ('str', "'a'"),
+                          ('operator', '->'), ('newline', '\n'),
+                          ('EOF', 'end of file')])
+    
+    def test_keyword_prefix(self):
+        self.assertEqual(lex_source("iff")[1], ('ident', 'iff'))
+    
+    def test_illegal_character(self):
+        try:
+            lex_source("write 1;\n\nwrite $;")
+        except Ice9LexicalError, e:
+            self.assertEqual(e.line, 3)
+        else:
+            self.fail("expected a lexical error")
+    
+    def test_positions(self):
+        self.assertEqual(list(lex_tokens("a := 1;\n  write a;")),
+                         [('SOF', 'start of file', 1, 1),
+                          ('ident', 'a', 1, 1), ('operator', ':=', 1, 3),
+                          ('int', '1', 1, 6), ('punc', ';', 1, 7),
+                          ('keyword', 'write', 2, 3), ('ident', 'a', 2, 9),
+                          ('punc', ';', 2, 10),
+                          ('EOF', 'end of file', 2, 11)])
+    
+    def test_syntax_error_line(self):
+        try:
+            parse("write 1;\n\n# comment\nwrite ;")
+        except Ice9SyntaxError, e:
+            self.assertEqual(str(e), "line 4: syntax error near ;")
+        else:
+            self.fail("expected a syntax error")
+
+
+# parser tests
+class ParserTest(unittest.TestCase):
+    def test_tokens_unchanged(self):
+        tokens = list(lex_tokens("var i : int; i := 1 + 2; write i;"))
+        before = list(tokens)
+        self.assert_(parse_tokens(tokens))
+        self.assertEqual(tokens, before)
+    
+    def test_stream_position(self):
+        stream = TokenStream(lex_tokens("write 1;"))
+        self.assertEqual(stream.current_word(), ('keyword', 'write', 1, 1))
+        self.assert_(stream.is_next('write'))
+        self.assert_(stream.expecting(('int', '1')))
+        self.assertEqual(stream.position, 2)
+    
+    def test_error_on_first_token(self):
+        try:
+            parse("proc f(a : int) : if true -> write 2; fi end")
+        except Ice9SyntaxError, e:
+            self.assertEqual(str(e), "line 1: syntax error near if")
+        else:
+            self.fail("expected a syntax error")
+    
+    def test_operator_nodes(self):
+        tree = parse("write - 1 - 2 - 3 * 4 < 5;")
+        operators = [n.value for n in tree.prefix_iter()
+                        if n.node_type == 'operator']
+        self.assertEqual(operators, ['<', '-', '-', '-', '*'])
+        for n in tree.prefix_iter():
+            self.failIf(n.value in ('expr', 'low', 'med', 'high'))
+    
+    def test_comparisons_dont_chain(self):
+        self.assertRaises(Ice9SyntaxError, parse, "write 1 < 2 < 3;")
+    
+    def test_empty_expansions(self):
+        # predicted from FOLLOW, but just like the rules would have made them
+        tree = parse("proc f()\n  x;\nend\nwrite 1;")
+        empty = [(n.value, n.line) for n in tree.prefix_iter()
+                    if n.node_type == 'rule-expansion' and n.ntokens == 0]
+        self.assertEqual(empty, [('dec_list', 1), ('lvalue_prime', 2),
+                                 ('value_or_assignment', 2)])
+
+class GrammarTest(unittest.TestCase):
+    def test_first(self):
+        from grammar import FIRST
+        self.assert_(('value', 'if') in FIRST['stm'])
+        self.assert_(('type', 'ident') in FIRST['expr'])
+        self.assert_(('value', 'else') in FIRST['ifprime2'])
+        self.failIf(('value', 'else') in FIRST['stm'])
+    
+    def test_nullable(self):
+        from grammar import NULLABLE
+        self.assert_(NULLABLE['declist'])
+        self.assert_(NULLABLE['lowprime'])
+        self.failIf(NULLABLE['stms'])
+    
+    def test_follow(self):
+        from grammar import FOLLOW
+        self.assert_(('value', 'fi') in FOLLOW['stms'])
+        self.assert_(('value', ')') in FOLLOW['expr'])
+        self.assertEqual(FOLLOW['program'], set([('type', 'EOF')]))
+
+# direct to AST parsing tests
+class ASTParserTest(unittest.TestCase):
+    def assertSameAST(self, source):
+        self.assertEqual(str(ice9.parse_source(source, direct_ast=False)),
+                         str(ice9.parse_source(source)))
+    
+    def assertSameError(self, source):
+        errors = []
+        for direct_ast in (False, True):
+            try:
+                ice9.parse_source(source, direct_ast)
+            except Ice9SyntaxError, e:
+                errors.append(str(e))
+        self.assertEqual(len(errors), 2)
+        self.assertEqual(errors[0], errors[1])
+    
+    def testDeclarations(self):
+        self.assertSameAST("var a, b : int[3][2], c : bool, d : int\n"
+                           "type t = int[4]\n"
+                           "forward f(x, y : int, z : t) : int\n"
+                           "proc f(x, y : int, z : t) : int\n"
+                           "  var q : bool\n"
+                           "  f := x;\n"
+                           "end\n"
+                           "write f(1, 2, a[0]);")
+    
+    def testStatements(self):
+        self.assertSameAST("if a < 1 -> ; [] b -> c := d := 3; [] else -> ; fi\n"
+                           "do ?x = 1 -> a[1][2] := - - 3 * (2 + read); od\n"
+                           "fa i := 1 to 10 -> write i; writes \"s\"; af\n"
+                           "break; exit; return; f(); ;")
+    
+    def testFailedLoop(self):
+        # a do with no condition falls through to the other statements
+        self.assertSameAST("do\nwrite 1;")
+        self.assertSameError("fa i := ; od")
+    
+    def testSyntaxErrors(self):
+        for source in ("write 1", "proc f() : if end", "var a : int[b]",
+                       "if x -> write 1; [] fi", "write 1 < 2 < 3;"):
+            self.assertSameError(source)
+    
+    def testDeepNesting(self):
+        # far deeper than the Python recursion limit
+        depth = 5000
+        source = ("var x : int\n" + "if x < 1 -> " * depth + "x := 1;" +
+                  " fi" * depth + "\n" + "write " + "(" * depth + "1" + 
+                  ")" * depth + " + 1" * depth + ";")
+        ast = ice9.parse_source(source, direct_ast=True)
+        
+        conds = [n for n in ast.prefix_iter() if n.node_type == 'cond']
+        self.assertEqual(len(conds), depth)
+        self.assertEqual(len(list(ast.postfix_iter())),
+                         len(list(ast.prefix_iter())))
+        self.assertEqual(str(ast).count('\n') + 1,
+                         len(list(ast.prefix_iter())))
+
+# tree walking tests
+class TreeTest(unittest.TestCase):
+    def setUp(self):
+        from tree import Tree
+        self.root = Tree(value='a')
+        b = self.root.add_child(value='b')
+        b.add_child(value='c')
+        b.add_child(value='d')
+        self.root.add_child(value='e')
+    
+    def testPrefix(self):
+        self.assertEqual([n.value for n in self.root.prefix_iter()],
+                         list('abcde'))
+    
+    def testPostfix(self):
+        # children are visited right to left
+        self.assertEqual([n.value for n in self.root.postfix_iter()],
+                         list('edcba'))
+    
+    def testChangeWhileWalking(self):
+        values = []
+        for n in self.root.prefix_iter():
+            values.append(n.value)
+            if n.value == 'b':
+                n.children = []
+        self.assertEqual(values, list('abe'))
+    
+    def testStalePositions(self):
+        b, e = self.root.children
+        c, d = b.children
+        # moves e, so its remembered position is out of date
+        from tree import Tree
+        self.root.children.insert(0, Tree(parent=self.root, value='f'))
+        self.assertEqual(e.child_index(), 2)
+        
+        b.remove_and_promote()
+        self.assertEqual([n.value for n in self.root.children], list('fcde'))
+        self.assertEqual(c.parent, self.root)
+        d.adopt_left_sibling()
+        self.assertEqual([n.value for n in self.root.prefix_iter()],
+                         list('afdce'))
+        
+        e.kill()
+        self.assertEqual(e.parent, None)
+        self.assertEqual([n.value for n in self.root.children], list('fd'))
+
+# symbol table tests
+class SymbolTableTest(unittest.TestCase):
+    def testScopes(self):
+        from symbols import SymbolTable
+        table = SymbolTable({'int': 'base'})
+        table.enter()
+        table.define('x', 'int')
+        table.enter()
+        self.assertEqual(table.lookup('x'), 'int')
+        self.assert_('x' not in table.names)
+        
+        table.define('x', 'bool')
+        table.define('x', 'str')
+        self.assertEqual(table.lookup('x'), 'str')
+        table.leave()
+        self.assertEqual(table.lookup('x'), 'int')
+        table.leave()
+        self.assertEqual(table.lookup('x'), None)
+        self.assertEqual(table.lookup('int'), 'base')
+        self.assertRaises(AssertionError, table.leave)
+        # and the table is still intact afterwards
+        self.assertEqual(table.lookup('int'), 'base')
+
+# semantic checking tests
+class SemanticTest(unittest.TestCase):
+    def check(self, source, direct_ast=False):
+        from semantic import check_semantics
+        return check_semantics(ice9.parse_source(source, direct_ast),
+                               all_errors=True)
+    
+    def errors(self, source):
+        from semantic import Ice9SemanticErrors
+        try:
+            self.check(source)
+        except Ice9SemanticErrors, e:
+            return [str(error) for error in e.errors]
+        self.fail("no semantic errors")
+    
+    def testAllErrors(self):
+        self.assertEqual(self.errors("var a : foo\n"
+                                     "var b : int\n"
+                                     "forward f()\n"
+                                     "b := true;\n"
+                                     "break;\n"
+                                     "write c;\n"),
+                         ["line 1: unknown type: foo",
+                          "line 4: incompatible types to binary operator :=",
+                          "line 5: breaks may only appear within a loop",
+                          "line 6: undeclared variable: c",
+                          "line 1: proc f has no body"])
+    
+    def testNoCascades(self):
+        # only the first mistake in each expression is reported
+        self.assertEqual(self.errors("var a : foo\n"
+                                     "write (a + 1) * 2 - c;\n"
+                                     "write 1 + true;"),
+                         ["line 1: unknown type: foo",
+                          "line 2: undeclared variable: c",
+                          "line 3: incompatible types to binary operator +"])
+    
+    def testUnknownTypesInProcs(self):
+        # the proc, its params and its return value are still defined
+        self.assertEqual(self.errors("proc f(x : foo) : int\n"
+                                     "  f := x + 1;\n"
+                                     "end\n"
+                                     "write f(1);"),
+                         ["line 1: unknown type: foo"])
+        self.assertEqual(self.errors("proc f(x : int) : bar\n"
+                                     "  f := x;\n"
+                                     "end\n"
+                                     "write f(1);"),
+                         ["line 1: unknown type: bar"])
+        self.assertEqual(self.errors("forward f(x : foo) : int\n"
+                                     "proc f(x : int) : int\n"
+                                     "  f := x;\n"
+                                     "end\n"
+                                     "write f(1);"),
+                         ["line 1: unknown type: foo"])
+    
+    def testDuplicateParam(self):
+        # the proc and its return value are still defined
+        self.assertEqual(self.errors("proc f(x : int, x : int) : int\n"
+                                     "  f := x;\n"
+                                     "end\n"
+                                     "write f(1, 2);"),
+                         ["line 1: var x already defined in scope"])
+    
+    def testBadForLoop(self):
+        # the loop's scope is still left, so its variable is gone after it
+        self.assertEqual(self.errors("var i : int\n"
+                                     "fa i := true to 2 -> write i; af\n"
+                                     "i := 3;"),
+                         ["line 2: expressions in fa must evaluate to ints"])
+    
+    def testUnknownArrayType(self):
+        self.assertEqual(self.errors("var a : zork[2]\n"
+                                     "var i : int\n"
+                                     "i := a[1] + a[i];\n"
+                                     "a[0] := 3;"),
+                         ["line 1: unknown type: zork"])
+    
+    def testUndeclaredArray(self):
+        self.assertEqual(self.errors("var a : int\n"
+                                     "write b;\n"
+                                     "write b[1];\n"
+                                     "b[2] := 3;"),
+                         ["line 2: undeclared variable: b",
+                          "line 3: undeclared variable: b",
+                          "line 4: undeclared variable: b"])
+    
+    def testArraySizes(self):
+        from codegenerator import type9_size
+        ast = self.check("type row = int[2]\n"
+                         "type grid = row[3]\n"
+                         "var g : grid\n"
+                         "var b : bool[4][5][6]\n"
+                         "var i : int\n"
+                         "i := 1;")
+        sizes = dict([(name, type9_size(t)) for name, t in ast.vars])
+        self.assertEqual(sizes, {'g': 6, 'b': 120, 'i': 1})
+    
+    def testFirstError(self):
+        from semantic import check_semantics, Ice9SemanticError
+        source = "write c;\nwrite d;"
+        try:
+            check_semantics(ice9.parse_source(source))
+        except Ice9SemanticError, e:
+            self.assertEqual(str(e), "line 1: undeclared variable: c")
+        else:
+            self.fail("no semantic error")
+    
+    def testDeepNesting(self):
+        # far deeper than the Python recursion limit
+        depth = 5000
+        source = ("var x : int\n" + "if x < 1 -> " * depth + "x := 1;" +
+                  " fi" * depth + "\n")
+        ast = self.check(source, direct_ast=True)
+        conds = [n for n in ast.prefix_iter() if n.node_type == 'cond']
+        self.assertEqual(len(conds), depth)
+        self.assertEqual(conds[-1].children[1].loopcount, 0)
+
+# deeply nested program tests
+class DeepNestingTest(unittest.TestCase):
+    def testCompile(self):
+        # far deeper than the Python recursion limit, all the way through
+        # the default compiler
+        depth = 10000
+        source = ("var x : int\nx := 3;\n" + "if x > 1 -> " * depth +
+                  "write " + "(" * depth + "-" * depth + "x" + " + 1)" * depth +
+                  ";" + " fi" * depth + "\n")
+        # too long a program for tm to load, so only check it compiles
+        for optimize in (False, True):
+            code = ice9.compile(source, optimize)
+            self.assert_(code.count('\n') > depth)
+
+# compiler pass statistics tests
+class PassStatsTest(unittest.TestCase):
+    source = "var x : int\nx := read;\nwrite x * 2;"
+    
+    def testStats(self):
+        stats = []
+        code = ice9.compile(self.source, stats=stats)
+        self.assertEqual(code, ice9.compile(self.source))
+        self.assertEqual([s['pass'] for s in stats],
+                         ['lex', 'parse', 'semantics',
+                          'optimize_ast', 'codegen', 'optimize', 'assemble',
+                          'code5str'])
+        self.assertEqual(stats[0]['size'], 15)
+        self.assertEqual(stats[-1]['size'], code.count('\n'))
+        for s in stats:
+            self.assert_(s['seconds'] >= 0 and s['peak_memory_kb'] >= 0)
+    
+    def testPassMemory(self):
+        # measured from where the pass started, not the process's old peak,
+        # so a pass that needs fresh pages shows up however high that is
+        import mmap
+        def allocate(size):
+            pages = mmap.mmap(-1, size)
+            for i in xrange(0, size, mmap.PAGESIZE):
+                pages[i] = 'x'
+            return pages
+        
+        allocate(96 << 20).close()
+        # unless asked to, the process's peak is left alone
+        peak = ice9.memory_status('VmHWM')
+        ice9.run_pass([], 'nothing', 'bytes', len, str)
+        self.assert_(ice9.memory_status('VmHWM') >= peak)
+        
+        ice9.RESET_PEAK_MEMORY = True
+        try:
+            stats = []
+            ice9.run_pass(stats, 'allocate', 'bytes', len, allocate, 32 << 20)
+            self.assert_(stats[0]['peak_memory_kb'] > 16 << 10)
+            
+            stats = []
+            ice9.run_pass(stats, 'nothing', 'bytes', len, str)
+            self.assert_(stats[0]['peak_memory_kb'] < 16 << 10)
+        finally:
+            ice9.RESET_PEAK_MEMORY = False
+    
+    def testFailedPass(self):
+        from semantic import Ice9SemanticError
+        stats = []
+        self.assertRaises(Ice9SemanticError, ice9.compile, "write y;",
+                          False, True, False, False, stats)
+        self.assertEqual([s['pass'] for s in stats], ['lex', 'parse'])
+    
+    def testProfile(self):
+        import pstats
+        import tempfile
+        fd, filename = tempfile.mkstemp()
+        os.close(fd)
+        
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            code = ice9.profile_compile(filename, 5, self.source)
+            summary = sys.stderr.getvalue()
+            functions = pstats.Stats(filename).stats.keys()
+        finally:
+            sys.stderr = stderr
+            os.remove(filename)
+        
+        self.assertEqual(code, ice9.compile(self.source))
+        self.assert_('function calls' in summary)
+        names = [name for f, line, name in functions]
+        for marker in ('optimize_globally', 'optimize_blocks', 'assemble'):
+            self.assert_(marker in names)
+    
+    def testProfileTop(self):
+        for top in ('abc', '-1'):
+            self.assertEqual(usage_error('--profile', '--profile-top=' + top),
+                             "--profile-top must be a number of functions\n")
+
+# concurrent compilation tests
+class ConcurrencyTest(unittest.TestCase):
+    def compile(self, job):
+        source, optimize = job
+        try:
+            return ice9.compile(source, optimize)
+        except Ice9Error, e:
+            return 'error: %s' % e
+    
+    def testConcurrentCompiles(self):
+        import threading
+        from glob import glob
+        from Queue import Queue, Empty
+        
+        files = glob('community_tests/tests/*.9') + glob('examples/*.9.txt')
+        files.sort()
+        jobs = [(open(f).read(), optimize) for f in files
+                for optimize in (True, False)]
+        expected = [self.compile(job) for job in jobs]
+        
+        queue = Queue()
+        for i, job in enumerate(jobs):
+            queue.put((i, job))
+        results = [None] * len(jobs)
+        def worker():
+            while True:
+                try:
+                    i, job = queue.get_nowait()
+                except Empty:
+                    return
+                results[i] = self.compile(job)
+        
+        # switch threads often, so compiles really are interleaved
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(10)
+        try:
+            threads = [threading.Thread(target=worker) for i in xrange(16)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+        finally:
+            sys.setcheckinterval(interval)
+        
+        self.assert_(len(jobs) > 300)
+        for i in xrange(len(jobs)):
+            self.assertEqual(results[i], expected[i])
+
+# batch compilation tests
+class BatchTest(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        self.dir = tempfile.mkdtemp()
+        self.files = []
+        for name in ('fib', 'fact', 'sieve'):
+            self.files.append(('examples/%s.9.txt' % name,
+                               os.path.join(self.dir, name + '.tm')))
+        self.bad = os.path.join(self.dir, 'bad.9')
+        open(self.bad, 'w').write('write x;')
+        self.files.insert(1, (self.bad, os.path.join(self.dir, 'bad.tm')))
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+    
+    def testBatch(self):
+        for processes in (1, 2):
+            results = list(ice9.compile_batch(self.files, processes,
+                                              optimize=False))
+            self.assertEqual(results,
+                             [(infile, None) for infile, o in self.files[:1]] +
+                             [(self.bad, 'line 1: undeclared variable: x')] +
+                             [(infile, None) for infile, o in self.files[2:]])
+            for infile, outfile in self.files:
+                if infile != self.bad:
+                    self.assertEqual(open(outfile).read(),
+                                     ice9.compile(open(infile).read(), False))
+            self.assert_(not os.path.exists(self.files[1][1]))
+    
+    def testManifest(self):
+        manifest = os.path.join(self.dir, 'manifest')
+        f = open(manifest, 'w')
+        f.write("# the good ones\n\n")
+        for infile, outfile in self.files:
+            if infile != self.bad:
+                f.write("%s %s\n" % (infile, outfile))
+        f.write(self.bad + "\n")
+        f.close()
+        
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            try:
+                ice9.main('--manifest=' + manifest, '--jobs=2')
+            except SystemExit, e:
+                self.assertEqual(e.code, 1)
+            else:
+                self.fail("main didn't exit")
+            errors = sys.stderr.getvalue()
+        finally:
+            sys.stderr = stderr
+        
+        self.assertEqual(errors, "%s: line 1: undeclared variable: x\n"
+                                 "1 of 4 files failed to compile\n" % self.bad)
+        for infile, outfile in self.files:
+            self.assertEqual(os.path.exists(outfile), infile != self.bad)
+    
+    def testJobs(self):
+        for jobs in ('abc', '0', '-2'):
+            self.assertEqual(usage_error('--batch', '--jobs=' + jobs),
+                             "--jobs must be a number of processes\n")
+
+# compile server tests
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        import threading
+        from server import CompileServer
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'ice9.sock')
+        self.server = CompileServer(self.path)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+    
+    def tearDown(self):
+        import shutil
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.dir)
+    
+    def testCompile(self):
+        from server import request
+        source = open('examples/fact.9.txt').read()
+        self.assertEqual(request(self.path, source),
+                         (True, ice9.compile(source)))
+        self.assertEqual(request(self.path, source, ['-s', '-d']),
+                         (True, ice9.compile(source, False, True)))
+    
+    def testErrors(self):
+        from server import request
+        self.assertEqual(request(self.path, 'write x;'),
+                         (False, 'line 1: undeclared variable: x'))
+        self.assertEqual(request(self.path, 'write 1;', ['-x']),
+                         (False, 'unknown flag: -x'))
+    
+    def testConcurrentRequests(self):
+        import threading
+        from server import request
+        sources = [open(f).read() for f in ('examples/fib.9.txt',
+                                            'examples/fact.9.txt',
+                                            'examples/ifact.9.txt')]
+        expected = [ice9.compile(s, False) for s in sources]
+        results = {}
+        def client(i):
+            results[i] = request(self.path, sources[i % 3], ['-s'])
+        
+        threads = [threading.Thread(target=client, args=(i,))
+                   for i in xrange(30)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        for i in xrange(30):
+            self.assertEqual(results[i], (True, expected[i % 3]))
+    
+    def testCache(self):
+        import tempfile
+        from cache import CompileCache
+        from server import request
+        self.server.cache = CompileCache(tempfile.mkdtemp(dir=self.dir))
+        source = 'write 1;'
+        self.server.cache.put(self.server.cache.key(source, False), 'cached')
+        self.assertEqual(request(self.path, source, ['-s']), (True, 'cached'))
+        self.assertEqual(request(self.path, source),
+                         (True, ice9.compile(source)))
+        self.assertEqual(len(self.server.cache.entries()), 2)
+
+# compile cache tests
+class CacheTest(unittest.TestCase):
+    def setUp(self):
+        import tempfile
+        from cache import CompileCache
+        self.dir = tempfile.mkdtemp()
+        self.cache = CompileCache(os.path.join(self.dir, 'cache'))
+    
+    def tearDown(self):
+        import shutil
+        shutil.rmtree(self.dir)
+    
+    def testCompile(self):
+        source = 'write 1 + 2;'
+        compiled = ice9.compile(source, cache=self.cache)
+        self.assertEqual(compiled, ice9.compile(source))
+        self.assertEqual(len(self.cache.entries()), 1)
+        
+        # a hit doesn't compile anything
+        key = self.cache.key(source, True)
+        self.cache.put(key, 'cached')
+        stats = []
+        self.assertEqual(ice9.compile(source, cache=self.cache, stats=stats),
+                         'cached')
+        self.assertEqual([s['pass'] for s in stats], ['cache'])
+        
+        self.assertNotEqual(self.cache.key(source, False), key)
+        self.assertEqual(ice9.compile(source, False, cache=self.cache),
+                         ice9.compile(source, False))
+        self.assertEqual(len(self.cache.entries()), 2)
+    
+    def testHitSkipsCompiler(self):
+        source = 'write 1;'
+        self.cache.put(self.cache.key(source, True), 'cached')
+        # in a fresh interpreter, the command line never loads the compiler
+        script = ("import sys, ice9\n"
+                  "try:\n"
+                  "    ice9.main('--cache=' + sys.argv[1])\n"
+                  "except SystemExit:\n"
+                  "    pass\n"
+                  "sys.stderr.write(str(sorted(m for m in ('lexer', 'parser',"
+                  " 'semantic') if m in sys.modules)))\n")
+        pipe = Popen([sys.executable, '-c', script, self.cache.directory],
+                     stdin=PIPE, stdout=PIPE, stderr=PIPE)
+        out, err = pipe.communicate(source)
+        self.assertEqual((out, err), ('cached', '[]'))
+    
+    def testHomeDirectory(self):
+        from cache import CompileCache
+        home = os.environ.get('HOME')
+        os.environ['HOME'] = self.dir
+        try:
+            cache = CompileCache('~/home-cache')
+        finally:
+            if home is None:
+                del os.environ['HOME']
+            else:
+                os.environ['HOME'] = home
+        self.assertEqual(cache.directory, os.path.join(self.dir, 'home-cache'))
+        self.assert_(os.path.isdir(cache.directory))
+        self.assert_(not os.path.exists('~'))
+    
+    def testFlags(self):
+        self.assertEqual(usage_error('--cache'),
+                         "--cache needs a directory: --cache=DIR\n")
+        self.assertEqual(usage_error('--cache-size=8'),
+                         "--cache-size needs a cache: --cache=DIR\n")
+        for size in ('abc', '-1', 'nan'):
+            self.assertEqual(usage_error('--cache=' + self.cache.directory,
+                                         '--cache-size=' + size),
+                             "--cache-size must be a number of megabytes\n")
+    
+    def testEviction(self):
+        self.cache.max_size = 100
+        for i, key in enumerate('abc'):
+            self.cache.put(key, 'x' * 40)
+            # the entries were last used a second apart
+            os.utime(self.cache.path(key), (1000 + i, 1000 + i))
+        
+        # only two fit; a was used least recently
+        self.assertEqual(self.cache.get('a'), None)
+        self.assertEqual(self.cache.get('b'), 'x' * 40)
+        self.cache.put('d', 'x' * 40)
+        self.assertEqual(self.cache.get('c'), None)
+        self.assertEqual(self.cache.get('b'), 'x' * 40)
+        self.assertEqual(self.cache.get('d'), 'x' * 40)
+        self.assertEqual(sorted(os.listdir(self.cache.directory)),
+                         ['b.tm', 'd.tm'])
+    
+    def testTempFiles(self):
+        import time
+        from cache import STALE_TEMP_AGE
+        self.cache.max_size = 100
+        # left behind by a compiler that died mid-write, and one still writing
+        for name in ('dead.tmp', 'writing.tmp'):
+            f = open(os.path.join(self.cache.directory, name), 'w')
+            f.write('x' * 40)
+            f.close()
+        dead = time.time() - STALE_TEMP_AGE - 1
+        os.utime(os.path.join(self.cache.directory, 'dead.tmp'), (dead, dead))
+        
+        self.cache.put('a', 'x' * 40)
+        self.assertEqual(sorted(os.listdir(self.cache.directory)),
+                         ['a.tm', 'writing.tmp'])
+        os.utime(self.cache.path('a'), (1000, 1000))
+        # the write in progress takes up room too
+        self.cache.put('b', 'x' * 40)
+        self.assertEqual(sorted(os.listdir(self.cache.directory)),
+                         ['b.tm', 'writing.tmp'])
+
+# array backed AST tests
+class ArenaTest(unittest.TestCase):
+    source = ("var a : int[3], b : bool\n"
+              "proc f(x : int) : int\n"
+              "  f := x * 2;\n"
+              "end\n"
+              "fa i := 0 to 2 -> a[i] := f(i) + 1; af\n"
+              "if a[2] > 4 -> b := true; [] else -> b := false; fi\n"
+              "write a[2];")
+    
+    def testSameAST(self):
+        self.assertEqual(str(ice9.parse_source(self.source, direct_ast=True)),
+                         str(ice9.parse_source(self.source, arena=True)))
+    
+    def testSameProgram(self):
+        for optimize in (False, True):
+            self.assertEqual(ice9.compile(self.source, optimize),
+                             ice9.compile(self.source, optimize, arena=True))
+    
+    def testChildList(self):
+        from arena import ASTArena
+        arena = ASTArena()
+        kids = [arena.new_node('literal', i) for i in range(4)]
+        root = arena.new_node('statements', children=kids)
+        self.assertEqual([c.parent for c in kids], [root] * 4)
+        
+        root.children.reverse()
+        self.assertEqual([c.value for c in root.children], [3, 2, 1, 0])
+        root.children.remove(kids[2])
+        root.children.insert(0, kids[2])
+        self.assertEqual([c.value for c in root.children], [2, 3, 1, 0])
+        self.assertEqual(root.children.pop().value, 0)
+        self.assertEqual([c.value for c in root.children[1:]], [3, 1])
+        
+        kids[1].kill()
+        self.assertEqual([c.value for c in root.children], [2, 3])
+        self.assertEqual(kids[1].parent, None)
+        
+        # indexing, appending and popping at either end don't walk the list
+        for i in range(4, 10):
+            root.children.append(arena.new_node('literal', i))
+        root.children[1] = kids[0]
+        self.assertEqual(root.children.pop(0).value, 2)
+        self.assertEqual(root.children.pop(-1).value, 9)
+        self.assertEqual((len(root.children), root.children[0].value,
+                          root.children[-1].value), (6, 0, 8))
+        self.assertRaises(IndexError, root.children.__getitem__, 6)
+        self.assertEqual([c.value for c in root.children], [0, 4, 5, 6, 7, 8])
+
+# incremental reparsing tests
+class IncrementalTest(unittest.TestCase):
+    source = ("var i : int\n"
+              "proc p()\n    writes 1;\nend\n"
+              "i := 3;\n"
+              "if i > 2 ->\n    write i;\nfi\n"
+              "write 2;\n")
+    
+    def assertSameTree(self, a, b):
+        self.assertEqual(str(a), str(b))
+        self.assertEqual(getattr(a, 'ntokens', None), getattr(b, 'ntokens', None))
+        self.assertEqual(len(a.children), len(b.children))
+        for x, y in zip(a.children, b.children):
+            self.assertSameTree(x, y)
+    
+    def assertParsed(self, parsed):
+        self.assertEqual(parsed.tokens, list(lex_tokens(parsed.source)))
+        self.assertSameTree(parsed.tree, parse(parsed.source))
+    
+    def assertReparses(self, start, end, text):
+        from incremental import IncrementalParse
+        parsed = IncrementalParse(self.source)
+        parsed.edit(start, end, text)
+        self.assertEqual(parsed.source,
+                         self.source[:start] + text + self.source[end:])
+        self.assertParsed(parsed)
+    
+    def test_edit_in_statement(self):
+        i = self.source.index('write i')
+        self.assertReparses(i + 6, i + 7, 'i + 1')
+    
+    def test_insert_lines(self):
+        i = self.source.index('i := 3;')
+        self.assertReparses(i, i, 'write 5;\n\nwrites 6;\n')
+    
+    def test_delete_statement(self):
+        i = self.source.index('i := 3;')
+        self.assertReparses(i, i + len('i := 3;\n'), '')
+    
+    def test_edit_in_proc(self):
+        i = self.source.index('writes 1')
+        self.assertReparses(i, i, 'var x : int\n')
+    
+    def test_edits_in_a_row(self):
+        # the lines each edit moves are only renumbered once they're asked
+        # for, so these all pile up
+        from incremental import IncrementalParse
+        i = self.source.index('i := 3;')
+        parsed = IncrementalParse(self.source[:i] + self.source[i:] * 20)
+        for k in xrange(20):
+            i = parsed.source.index('write i;', len(parsed.source) // 2)
+            parsed.edit(i, i, 'write %d;\n\n' % k)
+            i = parsed.source.index('i := 3;')
+            parsed.edit(i, i + len('i := 3;\n'), '')
+            i = parsed.source.index('write 2', len(parsed.source) // 3)
+            parsed.edit(i + 6, i + 7, '2 +\n 3')
+        self.assertParsed(parsed)
+    
+    def test_syntax_error(self):
+        from incremental import IncrementalParse
+        parsed = IncrementalParse(self.source)
+        i = self.source.index('write 2;')
+        self.assertRaises(Ice9SyntaxError, parsed.edit, i + 7, i + 8, '')
+    
+    def test_edit_after_syntax_error(self):
+        # the failed edit leaves nothing behind for the next one to trip on
+        from incremental import IncrementalParse
+        source = "var i : int\ni := 1;\nwrite 2;\nwrite i;\n"
+        parsed = IncrementalParse(source)
+        i = source.index('write 2;')
+        self.assertRaises(Ice9SyntaxError, parsed.edit, i + 7, i + 8, '')
+        i = parsed.source.index('write i;')
+        self.assertRaises(Ice9SyntaxError, parsed.edit, i + 7, i + 8, '')
+        i = parsed.source.index('write 2')
+        self.assertRaises(Ice9SyntaxError, parsed.edit, i + 7, i + 7, ';')
+        i = parsed.source.index('write i')
+        parsed.edit(i + 7, i + 7, ';')
+        self.assertEqual(parsed.source, source)
+        self.assertParsed(parsed)
+        self.assertSameTree(parsed.tree, parse_tokens(lex_tokens(source)))
+
+
 # for i in xrange(1, 258):
 #     globals()["community_test%d" % i] = make_community_test(i)
 
@@ -1,88 +1,165 @@
 #!/usr/bin/env python
 
-class Tree:
-    """Represents a generic tree."""
-    def __init__(self, parent=None, **kwargs):
-        self.parent = parent
-        self.children = []
-        
-        # extra attributes
-        for k,v in kwargs.iteritems():
-            setattr(self, k, v)
+class BaseTree(object):
+    """
+    Everything a tree node does, in terms of its fields. Tree keeps the
+    fields itself, and arena.NodeView looks them up in an ASTArena.
+    """
+    __slots__ = ()
+    
+    def child_index(self):
+        """
+        Returns where this node is in its parent's children, or None if it
+        isn't there. This searches them, so it's O(n) in the number of
+        siblings; Tree overrides it to usually be O(1).
+        """
+        try:
+            return self.parent.children.index(self)
+        except ValueError:
+            return None
     
     def kill(self):
+        """
+        Removes this node from its parent's children. Finding it there is
+        child_index(), but the children are a list, so every later sibling
+        is still shifted down one: O(n) in the number of siblings after it.
+        """
         if self.parent is None:
             raise ValueError('root of the tree cannnot die.')
         
-        if self in self.parent.children:
-            self.parent.children.remove(self)
+        i = self.child_index()
+        if i is not None:
+            del self.parent.children[i]
         self.parent = None
-
-    def add_child(self, **kwargs):
-        child = Tree(parent=self, **kwargs)
-        self.children.append(child)
-        return child
     
     def become_child(self):
         """
         Effectively removes the node from the tree by replacing it with its first child.
         """
+        child = self.children[0]
+        
         # hack to make sure we don't accidentally lose ice9 typing
-        if hasattr(self.children[0], 'ice9_type'):
-            assert not hasattr(self, 'ice9_type') or \
-                    self.ice9_type == self.children[0].ice9_type
-            setattr(self, 'ice9_type', self.children[0].ice9_type)
+        if child.ice9_type is not None:
+            assert self.ice9_type is None or self.ice9_type == child.ice9_type
+            self.ice9_type = child.ice9_type
         
-        if hasattr(self.children[0], 'loopcount'):
-            assert not hasattr(self, 'loopcount') or \
-                   self.loopcount == self.children[0].loopcount
-            setattr(self, 'loopcount', self.children[0].loopcount)
+        if child.loopcount is not None:
+            assert self.loopcount is None or self.loopcount == child.loopcount
+            self.loopcount = child.loopcount
         
-        self.line = self.children[0].line
-        self.node_type = self.children[0].node_type
-        self.value = self.children[0].value
-        self.children = self.children[0].children
+        self.line = child.line
+        self.node_type = child.node_type
+        self.value = child.value
+        self.children = child.children
         
         for c in self.children:
             c.parent = self
     
     def remove_and_promote(self):
         """
-        Kills this node and gives its children to its parent.
+        Kills this node and gives its children to its parent. Like kill(),
+        this shifts every later sibling along, so it's O(n) in the number of
+        them (plus the number of children moved).
         """
+        i = self.child_index()
         for c in self.children:
             c.parent = self.parent
-        i = self.parent.children.index(self)
-        spc = self.parent.children
-        self.parent.children = spc[:i] + self.children + spc[i+1:]
+        self.parent.children[i:i+1] = self.children
     
     def adopt_left_sibling(self):
-        i = self.parent.children.index(self)
+        """
+        Moves this node's left sibling to the front of its children. Both
+        lists shift along, so it's O(n) in the number of later siblings
+        plus this node's children.
+        """
+        i = self.child_index()
         # remove the left sibling
         left_sibling = self.parent.children.pop(i-1)
         # and move it to the front
         self.children.insert(0, left_sibling)
         left_sibling.parent = self
     
+    # The walks below keep their own stack of child iterators rather than
+    # recursing, so they work on trees of any depth and cost O(1) per node.
+    # Like a recursive walk, a node's children are only looked at once the
+    # walk gets to them, so the tree may be changed as it is walked.
+    
     def prefix_iter(self):
         yield self
-        for c in self.children:
-            for x in c.prefix_iter():
-                yield x
+        stack = [iter(self.children)]
+        while stack:
+            for child in stack[-1]:
+                yield child
+                stack.append(iter(child.children))
+                break
+            else:
+                stack.pop()
     
     def postfix_iter(self):
-        for child in self.children.__reversed__():
-            for x in child.postfix_iter():
-                yield x
-        yield self
-
+        stack = [(self, reversed(self.children))]
+        while stack:
+            for child in stack[-1][1]:
+                stack.append((child, reversed(child.children)))
+                break
+            else:
+                yield stack.pop()[0]
+    
     def __str__(self, tab=""):
         out = []
         print_attr = ('line', 'node_type', 'value', 'ice9_type', 'vars')
-        as_str = '\t'.join(s + ": " + str(getattr(self, s)) 
-                                          for s in print_attr if hasattr(self, s))
-        out.append(tab + as_str)
-        for child in self.children:
-            out.append(child.__str__(tab + "- "))
+        stack = [(self, tab)]
+        while stack:
+            node, tab = stack.pop()
+            as_str = '\t'.join(s + ": " + str(getattr(node, s))
+                                    for s in print_attr
+                                    if getattr(node, s) is not None)
+            out.append(tab + as_str)
+            stack += [(child, tab + "- ") for child in reversed(node.children)]
         return "\n".join(out)
 
+class Tree(BaseTree):
+    """Represents a generic tree."""
+    
+    # every attribute any pass uses, so nodes don't need a __dict__. Those
+    # a pass hasn't filled in yet are None.
+    __slots__ = ('node_type', 'value', 'line', 'parent', 'children',
+                 'ice9_type', 'loopcount', 'vars',
+                 # parse trees only
+                 'token_type', 'ntokens',
+                 # where the node last was in its parent's children
+                 'position')
+    
+    def __init__(self, parent=None, node_type=None, value=None, line=None,
+                 ice9_type=None, loopcount=None, vars=None, token_type=None,
+                 ntokens=None):
+        self.parent = parent
+        self.children = []
+        self.node_type = node_type
+        self.value = value
+        self.line = line
+        self.ice9_type = ice9_type
+        self.loopcount = loopcount
+        self.vars = vars
+        self.token_type = token_type
+        self.ntokens = ntokens
+        self.position = None
+    
+    def child_index(self):
+        # Nodes remember their position, so most of the time it doesn't have
+        # to be searched for. It goes stale when siblings to the left are
+        # added or removed, and then the search is O(n) again. The passes
+        # change a node's children right to left as they walk them, which
+        # keeps it current. Killing from the front leaves every later
+        # sibling's position too high, but the search starts at the front,
+        # so declarations killed in order are still found straight away.
+        siblings = self.parent.children
+        i = self.position
+        if i is None or i >= len(siblings) or siblings[i] is not self:
+            i = self.position = BaseTree.child_index(self)
+        return i
+    
+    def add_child(self, **kwargs):
+        child = Tree(parent=self, **kwargs)
+        child.position = len(self.children)
+        self.children.append(child)
+        return child